@@ -1,11 +1,15 @@
 """ Wrapper module for ascp usage. """
 
+import collections
 import os
 import re
 import subprocess
 import logging
 import sys
 import shutil
+import signal
+import threading
+import time
 
 # download example command(s):
 #
@@ -27,6 +31,18 @@ logger.addHandler(logging.NullHandler())
 ASCP_COMMAND = "ascp"
 ASCP_MIN_VERSION = '3.5'
 
+# The default target rate of the transfers, shared by all the sessions
+DEFAULT_RATE = '300M'
+
+# The progress lines of ascp, such as:
+#   file.bam    45%  120MB  98.5Mb/s    00:12 ETA
+PROGRESS_RE = re.compile(
+    r"(\d+)%\s+(\d+(?:\.\d+)?)\s*([KMGT]?B)\s+(\d+(?:\.\d+)?)\s*([KMGT]?b)/s"
+)
+
+# The multiples of the byte counts in the progress lines
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
 def is_ascp_installed():
     """
     Determine if the Aspera 'ascp' utility is installed and available for use.
@@ -119,53 +135,337 @@ def get_ascp_env(password):
 
     return environment
 
-def run_ascp(ascp_cmd, password, keyfile=None):
+def parse_rate(rate):
     """
-    Run the ascp command, returning True for success or False for failure.
+    Parse an ascp rate, such as '300M' (in bits per second, with an optional
+    K, M or G suffix), into kilobits per second.
     """
-    logger.debug("In run_ascp.")
+    match = re.match(r"^(\d+(?:\.\d+)?)([KMG]?)$", str(rate).strip(), re.IGNORECASE)
 
-    if keyfile:
-        if not os.path.exists(keyfile):
-            raise IOError(
-                "Can't use private key. No such file or directory: " + keyfile)
-        ascp_cmd = [ascp_cmd[0], "-i", keyfile] + ascp_cmd[1:]
+    if match is None:
+        raise ValueError("Invalid rate {}. Must be a number with an optional "
+                         "K, M or G suffix.".format(rate))
+
+    multiplier = {'': 0.001, 'K': 1, 'M': 1000, 'G': 1000000}[match.group(2).upper()]
+
+    return max(int(float(match.group(1)) * multiplier), 1)
+
+def parse_progress(line):
+    """
+    Parse a progress line of ascp, returning a (bytes, bits per second)
+    tuple, or None if the line doesn't report progress.
+    """
+    match = PROGRESS_RE.search(line)
+
+    if match is None:
+        return None
+
+    nbytes = float(match.group(2)) * UNITS[match.group(3)[:-1]]
+    rate = float(match.group(4)) * 1000 ** ' KMGT'.index(match.group(5)[:-1] or ' ')
+
+    return int(nbytes), rate
+
+class FaspRunner(object):
+    """
+    The FaspRunner class runs ascp transfers, with up to a given number of
+    sessions at the same time, sharing a target rate between them. The
+    output of each session is parsed as it is produced, and a session that
+    makes no progress for stall_timeout seconds is killed and retried.
+
+    The rate of a session can't be changed once ascp is running, so each
+    session is given its share of the target when it is launched: the target
+    divided by the number of sessions running (until every session has been
+    launched once, by the number of sessions), within the rate the running
+    sessions leave unused.
+    """
+    def __init__(self, sessions=1, rate=DEFAULT_RATE, stall_timeout=120, retries=2):
+        """
+        Constructor for the FaspRunner class.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self.sessions = sessions
+
+        # The target rate of all the sessions together, in kilobits per second
+        self.rate = parse_rate(rate)
+
+        self.stall_timeout = stall_timeout
+
+        self.retries = retries
+
+        # Optional callable invoked with the number of bytes transferred
+        # whenever a session reports progress
+        self.progress_callback = None
+
+        # The sessions running, the rate given to them, and the number of
+        # sessions launched so far
+        self._state = threading.Condition()
+        self._running = 0
+        self._allocated = 0
+        self._launched = 0
+
+    # Wait for a session to be available, and return the rate (in kilobits
+    # per second) of the session, which must be released with
+    # _release_session once the session is over.
+    def _acquire_session(self):
+        with self._state:
+            while self._running >= self.sessions:
+                self._state.wait()
+
+            self._running += 1
+
+            if self._launched < self.sessions:
+                share = self.rate // self.sessions
+            else:
+                share = self.rate // self._running
+
+            rate = max(min(share, self.rate - self._allocated), 1)
+
+            self._allocated += rate
+            self._launched += 1
+
+            return rate
+
+    # Make the session, and its rate, available to the next session.
+    # Arguments:
+    # rate = the rate of the session, as returned by _acquire_session
+    def _release_session(self, rate):
+        with self._state:
+            self._running -= 1
+            self._allocated -= rate
+            self._state.notify()
+
+    def set_sessions(self, sessions):
+        """
+        Change the number of sessions that may run at the same time, such as
+        to the number of workers when fewer files can be downloaded at once
+        than there are sessions.
+        """
+        self.logger.debug("In set_sessions: %s", sessions)
+
+        with self._state:
+            self.sessions = max(sessions, 1)
+            self._state.notify_all()
+
+    def download_file(self, server, username, password, remote_path, local_path,
+                      keyfile=None):
+        """
+        Download a single remote file, waiting for a session to be available.
+        Returns True if successful, False if not.
+        """
+        self.logger.debug("In download_file.")
+
+        check_ascp_version()
+
+        ascp_cmd = [
+            ASCP_COMMAND, "-T", "-v",
+            username + "@" + server + ":" + remote_path,
+            local_path
+        ]
+
+        return self.run(ascp_cmd, password, keyfile)
+
+    def upload_file(self, server, username, password, local_file, remote_path,
+                    keyfile=None):
+        """
+        Upload a single file, waiting for a session to be available.
+        Returns True if successful, False if not.
+        """
+        self.logger.debug("In upload_file.")
+
+        check_ascp_version()
+
+        # Check that local file exists
+        if not os.path.isfile(local_file):
+            self.logger.warning("Local file %s does not exist.", local_file)
+            return False
+
+        remote_clause = username + "@" + server + ":" + remote_path
+        ascp_cmd = [
+            ASCP_COMMAND, "-T", "-v",
+            local_file, remote_clause
+        ]
+
+        return self.run(ascp_cmd, password, keyfile)
+
+    def run(self, ascp_cmd, password, keyfile=None):
+        """
+        Run the ascp command in one of the sessions. Unless the command sets
+        its rate (with -l), the session's share of the target rate is added
+        when it is launched. A session that stalls is killed and run again
+        (up to retries times), resuming the transfer. Returns True for
+        success or False for failure.
+        """
+        self.logger.debug("In run.")
+
+        if keyfile:
+            if not os.path.exists(keyfile):
+                raise IOError(
+                    "Can't use private key. No such file or directory: " + keyfile)
+            ascp_cmd = [ascp_cmd[0], "-i", keyfile] + ascp_cmd[1:]
+
+        for attempt in range(self.retries + 1):
+            rate = self._acquire_session()
+
+            try:
+                if "-l" in ascp_cmd:
+                    session_cmd = ascp_cmd
+                else:
+                    session_cmd = [ascp_cmd[0], "-l", "{}K".format(rate)] + ascp_cmd[1:]
+
+                result = self._run_session(session_cmd, password)
+            finally:
+                self._release_session(rate)
+
+            if result != "stalled":
+                return result
+
+            if attempt < self.retries:
+                self.logger.warning("Retrying the stalled transfer.")
+
+                # Resume the transfer rather than starting over
+                if "-k" not in ascp_cmd:
+                    ascp_cmd = [ascp_cmd[0], "-k", "1"] + ascp_cmd[1:]
+
+        self.logger.error("The transfer stalled %s times. Giving up.", self.retries + 1)
+
+        return False
+
+    # Run a single ascp session, parsing its output as it is produced.
+    # Returns True for success, False for failure, or "stalled" if the
+    # session was killed because it stopped making progress.
+    # Arguments:
+    # ascp_cmd = the ascp command line
+    # password = the password of the Aspera user
+    def _run_session(self, ascp_cmd, password):
+        self.logger.debug("Command: %s", " ".join(ascp_cmd))
 
-    try:
-        logger.debug("Command: %s", " ".join(ascp_cmd))
         process = subprocess.Popen(
             ascp_cmd,
             stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            env=get_ascp_env(password)
+            stdin=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+            env=get_ascp_env(password),
+            # So that a session can be killed along with any children
+            start_new_session=True
         )
 
-        logger.info("Beginning transfer.")
-        (s_out, s_err) = process.communicate()
-        rc = process.returncode
-        logger.info("Invocation of ascp complete. Return code: %s.", str(rc))
+        def kill():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+            process.wait()
+
+        # The last lines of output other than progress, to report errors
+        lines = collections.deque(maxlen=50)
 
-        success = False
+        # The progress reported by ascp, updated by the reader thread
+        state = {'bytes': 0, 'rate': 0.0, 'updated': time.time()}
+        state_lock = threading.Lock()
+
+        def read_output():
+            pending = b''
+
+            # Progress lines end with a carriage return rather than a newline
+            for data in iter(lambda: os.read(process.stdout.fileno(), 4096), b''):
+                *complete, pending = re.split(rb"[\r\n]", pending + data)
+
+                for line in complete:
+                    line = line.decode('utf-8', 'replace').strip()
+
+                    if not line:
+                        continue
+
+                    progress = parse_progress(line)
+
+                    if progress is None:
+                        lines.append(line)
+                        continue
+
+                    with state_lock:
+                        if progress[0] > state['bytes']:
+                            state['bytes'] = progress[0]
+                            state['updated'] = time.time()
+
+                        state['rate'] = progress[1]
+
+        reader = threading.Thread(target=read_output, daemon=True)
+        reader.start()
+
+        self.logger.info("Beginning transfer.")
+
+        reported = 0
+        stalled = False
+
+        try:
+            while True:
+                try:
+                    process.wait(timeout=1)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+
+                with state_lock:
+                    nbytes = state['bytes']
+                    rate = state['rate']
+                    idle = time.time() - state['updated']
+
+                if nbytes > reported:
+                    self.logger.debug("%s bytes transferred at %.0f b/s.", nbytes, rate)
+
+                    if self.progress_callback is not None:
+                        self.progress_callback(nbytes - reported)
+
+                    reported = nbytes
+
+                if idle > self.stall_timeout:
+                    self.logger.warning("No progress from ascp in %s seconds. " +
+                                        "Killing it.", self.stall_timeout)
+                    stalled = True
+                    kill()
+                    break
+        except BaseException:
+            # Such as the cancellation of the downloads by the callback
+            kill()
+            raise
+        finally:
+            reader.join()
+            process.stdout.close()
+
+        if stalled:
+            return "stalled"
+
+        rc = process.returncode
+        self.logger.info("Invocation of ascp complete. Return code: %s.", str(rc))
 
         if rc == 0:
-            logger.info("Aspera ascp utility returned successful exit value.")
-            success = True
+            self.logger.info("Aspera ascp utility returned successful exit value.")
+
+            if self.progress_callback is not None and state['bytes'] > reported:
+                self.progress_callback(state['bytes'] - reported)
+
+            return True
+
+        output = "\n".join(lines)
+
+        if re.search(r"failed to authenticate", output):
+            self.logger.error("Aspera authentication failure.")
         else:
-            if re.match(r"^.*failed to authenticate", s_err):
-                logger.error("Aspera authentication failure.")
-            else:
-                if s_err is not None:
-                    logger.error("Unexpected STDERR from ascp: %s", s_err)
+            self.logger.error("Unexpected output from ascp: %s", output)
 
-                if s_out is not None:
-                    logger.error("Unexpected STDOUT from ascp: %s", s_out)
+        return False
 
-    except subprocess.CalledProcessError as cpe:
-        logger.error("Encountered an error when running ascp: %s", cpe)
+def run_ascp(ascp_cmd, password, keyfile=None):
+    """
+    Run the ascp command, returning True for success or False for failure.
+    """
+    logger.debug("In run_ascp.")
 
-    return success
+    return FaspRunner().run(ascp_cmd, password, keyfile)
 
 def download_file(server, username, password, remote_path, local_path,
                   keyfile=None):
@@ -175,14 +475,8 @@ def download_file(server, username, password, remote_path, local_path,
     """
     logger.debug("In download_file.")
 
-    check_ascp_version()
-    ascp_cmd = [
-        ASCP_COMMAND, "-T", "-v", "-l", "300M",
-        username + "@" + server + ":" + remote_path,
-        local_path
-    ]
-
-    return run_ascp(ascp_cmd, password, keyfile)
+    return FaspRunner().download_file(server, username, password, remote_path,
+                                      local_path, keyfile)
 
 def upload_file(server, username, password, local_file, remote_path,
                 keyfile=None):
@@ -191,14 +485,6 @@ def upload_file(server, username, password, local_file, remote_path,
     Return True if successful, False if not.
     """
     logger.debug("In upload_file.")
-    check_ascp_version()
-
-    # Check that local file exists
-    if not os.path.isfile(local_file):
-        logger.warning("Local file %s does not exist.", local_file)
-        return False
-
-    remote_clause = username + "@" + server + ":" + remote_path
-    ascp_cmd = [ASCP_COMMAND, "-T", "-v", "-l", "300M", local_file, remote_clause]
 
-    return run_ascp(ascp_cmd, password, keyfile)
+    return FaspRunner().upload_file(server, username, password, local_file,
+                                    remote_path, keyfile)
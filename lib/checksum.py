@@ -0,0 +1,58 @@
+"""
+Computes MD5 checksums of local files. The functions are at the module level
+so that they can be used by the worker processes of a process pool.
+"""
+
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Large reads keep the number of system calls, and the per-call overhead of
+# hashing, low when checksumming large files.
+BLOCKSIZE = 8 * 1024 * 1024
+
+class ChecksumMismatch(Exception):
+    """
+    Raised when the checksum of a file, or the checksum a server holds for
+    it, doesn't match the one expected.
+    """
+
+def file_md5(file_path, blocksize=BLOCKSIZE):
+    """
+    Return the hexadecimal MD5 digest of the file at file_path. The file is
+    read in large blocks into a single reusable buffer.
+    """
+    logger.debug("In file_md5: %s", file_path)
+
+    md5 = hashlib.md5()
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+
+    with open(file_path, 'rb', buffering=0) as filehandle:
+        while True:
+            count = filehandle.readinto(buf)
+
+            if not count:
+                break
+
+            md5.update(view[:count])
+
+    return md5.hexdigest()
+
+def verify_file(entry):
+    """
+    Check a single (file_path, md5) pair. Returns 'ok' if the file matches
+    the MD5, 'mismatch' if it does not and 'missing' if the file does not
+    exist.
+    """
+    file_path, original_md5 = entry
+
+    if not os.path.isfile(file_path):
+        return 'missing'
+
+    if file_md5(file_path) == original_md5:
+        return 'ok'
+
+    return 'mismatch'
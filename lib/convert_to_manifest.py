@@ -3,10 +3,13 @@ Contains the functions to convert any of the three valid inputs into a
 manifest data structure that the manifest processor requires.
 """
 
-import urllib
+import bz2
 import csv
+import gzip
 import io
+import itertools
 import logging
+import lzma
 import sys
 
 # Let the user customize if not using the main portal for making tokens
@@ -14,17 +17,50 @@ from conf import portal_url, portal_port
 
 logger = logging.getLogger(__name__)
 
-def file_to_manifest(file):
+def file_to_manifest(file, cache_dir=None):
     """
     Takes in a local file which contains manifest data and converts it to the
     data stucture that is expected for the function download_manifest() in
     process_manifest.py
+
+    If cache_dir is given, the parsed manifest is kept in a binary cache in
+    that directory (see manifest_cache.py), which later calls use instead of
+    parsing the file again for as long as the file is unchanged.
     """
     logger.debug("In file_to_manifest.")
 
-    with open(file) as tsv:
+    if cache_dir is not None:
+        from manifest_cache import load_manifest
+        return load_manifest(file, cache_dir, file_to_manifest)
+
+    with _open_file(file) as tsv:
         return tsv_to_manifest(tsv)
 
+# Leading bytes that identify the compression formats of manifest files
+# that can be read without decompressing them to disk first.
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open)
+]
+
+def _open_file(file):
+    """
+    Opens a local manifest file as text. Files compressed with gzip, bzip2 or
+    xz are detected by their contents and decompressed as they are read.
+    """
+    logger.debug("In _open_file: %s", file)
+
+    with open(file, 'rb') as filehandle:
+        magic = filehandle.read(6)
+
+    for prefix, opener in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            logger.debug("Manifest is compressed with %s.", opener.__module__)
+            return opener(file, 'rt', encoding='utf-8', newline='')
+
+    return open(file)
+
 def url_to_manifest(url):
     """
     Takes in a URL where a TSV manifest file is hosted and creates the same data
@@ -33,9 +69,30 @@ def url_to_manifest(url):
     """
     logger.debug("In url_to_manifest.")
 
-    response = urllib.request.urlopen(url)
+    with _open_url(url) as tsv:
+        return tsv_to_manifest(tsv)
+
+def _open_url(url, data=None):
+    """
+    Requests the url, allowing the server to gzip compress the response, and
+    returns a text stream over the response body. The body is decompressed
+    and decoded incrementally as the stream is read, so rows can be parsed
+    while the rest of the response is still arriving.
+    """
+    logger.debug("In _open_url: %s", url)
 
-    return tsv_to_manifest(io.TextIOWrapper(response))
+    import urllib.request
+
+    req = urllib.request.Request(url, data=data, headers={'Accept-Encoding': 'gzip'})
+    response = urllib.request.urlopen(req)
+
+    if response.headers.get('Content-Encoding', '').lower() == 'gzip':
+        logger.debug("Response is gzip compressed.")
+        body = gzip.GzipFile(fileobj=response)
+    else:
+        body = response
+
+    return io.TextIOWrapper(body, encoding='utf-8', newline='')
 
 def tsv_to_manifest(tsv_object):
     """
@@ -56,12 +113,45 @@ def tsv_to_manifest(tsv_object):
             manifest.append({
                 'id':row[0],
                 'md5':row[1],
+                'size':_parse_size(row[2]),
                 'urls':row[3]
             })
             ids[row[0]] = 1
 
     return manifest
 
+def manifest_to_file(manifest, file):
+    """
+    Writes manifest entries out as a TSV manifest file, in the same format
+    that file_to_manifest() reads, so that the file can be used as the input
+    of a later run.
+    """
+    logger.debug("In manifest_to_file.")
+
+    with open(file, 'w', newline='') as tsv:
+        writer = csv.writer(tsv, delimiter="\t", lineterminator="\n")
+        writer.writerow(['id', 'md5', 'size', 'urls'])
+
+        for mfile in manifest:
+            size = mfile.get('size')
+
+            writer.writerow([
+                mfile['id'],
+                mfile['md5'],
+                '' if size is None else size,
+                mfile['urls']
+            ])
+
+def _parse_size(size):
+    """
+    Convert the size column of a manifest to an integer, or None if the size
+    is absent or not a number.
+    """
+    try:
+        return int(size)
+    except ValueError:
+        return None
+
 def token_to_manifest(token):
     """
     Takes in a token that correspondes to a cart/manifest entity. This is then
@@ -72,6 +162,10 @@ def token_to_manifest(token):
     """
     logger.debug("In token_to_manifest.")
 
+    # Only needed for remote manifests, and slow to import
+    import urllib.parse
+    import urllib.request
+
     portal = "{0}:{1}".format(portal_url, portal_port)
     token_route = "{0}/client/token".format(portal)
     proxies = {}
@@ -88,27 +182,33 @@ def token_to_manifest(token):
 
     # Pull the data generated by the portal within the token_to_manifest()
     # function in query.py. Essentially builds a minimal manifest file as a
-    # string.
-    res = urllib.request.urlopen(token_route, data=params).read().decode('utf-8')
+    # string, which is parsed line by line as it is received.
+    manifest = []
+    ids = {}
 
-    if '\t' not in res:
-        sys.exit(res)
+    with _open_url(token_route, data=params) as res:
+        first_line = res.readline()
 
-    files = res.split('\n')
+        # Anything other than manifest rows is an error message from the portal
+        if '\t' not in first_line:
+            sys.exit(first_line + res.read())
 
-    manifest = []
-    ids = {}
+        for file in itertools.chain([first_line], res):
+            file = file.rstrip('\r\n')
 
-    for file in files:
-        file_data = file.split('\t')
+            if not file:
+                continue
 
-        if file_data[0] not in ids:
-            manifest.append({
-                'id':file_data[0],
-                'md5':file_data[1],
-                'urls':file_data[2]
-            })
-            ids[file_data[0]] = 1
+            file_data = file.split('\t')
+
+            if file_data[0] not in ids:
+                manifest.append({
+                    'id':file_data[0],
+                    'md5':file_data[1],
+                    'size':None,
+                    'urls':file_data[2]
+                })
+                ids[file_data[0]] = 1
 
     proxy = urllib.request.ProxyHandler({})
     opener = urllib.request.build_opener(proxy)
@@ -4,8 +4,11 @@ Handles the downloading of data from FTP sites.
 
 import os
 import logging
+import threading
 from ftplib import FTP
 
+from streaming import WriteBehindFile
+
 class PortalFTP:
     """
     The PortalFTP class provides for simple retrieval of data from FTP servers.
@@ -20,8 +23,18 @@ class PortalFTP:
 
         self.blocksize = blocksize
 
-        # A dictionary to store connections keyed by hostname
-        self.connections = {}
+        # Optional callable invoked with the size of every block transferred
+        self.progress_callback = None
+
+        # Whether downloaded files are synced to disk once complete
+        self.fsync = False
+
+        # Seconds to wait for the server to connect or send more data
+        self.timeout = 60
+
+        # Per-thread dictionaries to store connections keyed by hostname.
+        # ftplib connections can't be shared by concurrent callers.
+        self._local = threading.local()
 
     def download_file(self, url, local_path):
         """
@@ -53,39 +66,89 @@ class PortalFTP:
         else:
             self._handle_chunked_download(url, local_path, current_byte, remote_file_size)
 
-    def _handle_chunked_download(self, url, file_name, current_byte, file_size):
-        self.logger.debug("In _handle_chunked_download: %s", url)
+    def stream_file(self, url, writer):
+        """
+        Download the remote file, passing its contents to writer.write() as
+        they arrive instead of saving them to a local file.
+        """
+        self.logger.debug("In stream_file. URL: %s", url)
 
-        res = self._get_url_obj(url)
+        if not url.startswith('ftp://'):
+            raise Exception("Invalid FTP url. Must start with ftp://")
 
-        blocksize = self.blocksize
+        remote_file_size = self._get_file_size(url)
+
+        self._transfer(url, writer, 0, remote_file_size)
+
+    def _handle_chunked_download(self, url, file_name, current_byte, file_size):
+        self.logger.debug("In _handle_chunked_download: %s", url)
 
-        with open(file_name, 'ab') as file:
+        with WriteBehindFile(file_name, 'ab', fsync=self.fsync) as file:
 
             print(
                 "Downloading file via FTP: {0} | total bytes = {1}"
                     .format(file_name, file_size)
             )
 
-            if blocksize > file_size:
-                _generate_status_message("block size greater than " + \
-                    "total file size. Pulling in entire file.")
+            self._transfer(url, file, current_byte, file_size)
 
-            self._get_buffer(res, current_byte, file_size, file)
+    # Transfer the file, from the given position onwards, to a writable
+    # object (a local file or a stream).
+    # Arguments:
+    # url = path to location of the file on the FTP server
+    # file = object the data is written to
+    # current_byte = the byte position to retrieve data from
+    # file_size = the size of the remote file
+    def _transfer(self, url, file, current_byte, file_size):
+        self.logger.debug("In _transfer: %s", url)
+
+        res = self._get_url_obj(url)
+
+        if res == "error":
+            raise Exception("Unable to retrieve {}".format(url))
+
+        blocksize = self.blocksize
+
+        if blocksize > file_size:
+            _generate_status_message("block size greater than " + \
+                "total file size. Pulling in entire file.")
 
+        try:
+            self._get_buffer(res, current_byte, file_size, file)
+        except Exception:
+            # An interrupted transfer leaves the connection unusable
+            self._drop_ftp_connection(self._parse_ftp_url(url)['host'])
+            raise
 
     def _get_ftp_connection(self, host):
         self.logger.debug("In _get_ftp_connection. Host: %s", host)
 
-        if host not in self.connections:
-            ftp = FTP(host)
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+
+        connections = self._local.connections
+
+        if host not in connections:
+            ftp = FTP(host, timeout=self.timeout)
             ftp.login()
-            self.connections[host] = ftp
+            connections[host] = ftp
 
-        conn = self.connections[host]
+        conn = connections[host]
 
         return conn
 
+    def _drop_ftp_connection(self, host):
+        self.logger.debug("In _drop_ftp_connection. Host: %s", host)
+
+        connections = getattr(self._local, 'connections', {})
+        ftp = connections.pop(host, None)
+
+        if ftp is not None:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+
     # Get a network object of the file that can be iterated over.
     # Arguments:
     # url = path to location of the file on the web
@@ -142,6 +205,10 @@ class PortalFTP:
             file.write(data)
 
             current_byte += len(data)
+
+            if self.progress_callback is not None:
+                self.progress_callback(len(data))
+
             _generate_status_message("{0}  [{1:.2f}%]".format(current_byte, current_byte * 100 / max_range))
 
         res(callback, self.blocksize, start_pos)
@@ -2,21 +2,29 @@
 Handles the downloading of data from Google Cloud Platform (Google Storage).
 """
 
+import base64
 import os
 from os import path
 
 import logging
+import threading
 
 from google.cloud import storage
+from google.resumable_media import DataCorruption
 from google_auth_oauthlib import flow
 
+from checksum import BLOCKSIZE, ChecksumMismatch, file_md5
+from segments import SEGMENT_SIZE, SegmentJournal, download_segments, has_journal
+from streaming import CallbackSink, WriteBehindFile
+
 class GCP:
     """
     The GCP class provides for simple retrieval of data from Google Storage.
     """
-    def __init__(self, project_id, client_secrets_path):
+    def __init__(self, project_id, client_secrets_path, read_only=True):
         """
-        Constructor for the GCP class.
+        Constructor for the GCP class. Unless read_only is False, the
+        authorization only allows objects to be read.
         """
         self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
 
@@ -31,9 +39,14 @@ class GCP:
 
         self._client_secrets_path = client_secrets_path
 
+        if read_only:
+            scope = 'https://www.googleapis.com/auth/devstorage.read_only'
+        else:
+            scope = 'https://www.googleapis.com/auth/devstorage.read_write'
+
         appflow = flow.InstalledAppFlow.from_client_secrets_file(
             client_secrets_path,
-            scopes=['https://www.googleapis.com/auth/devstorage.read_only']
+            scopes=[scope]
         )
 
         self.logger.debug("Running flow for Google authorization.")
@@ -41,6 +54,21 @@ class GCP:
 
         self.credentials = appflow.credentials
 
+        # The storage client, shared by all the downloads
+        self._client = None
+        self._client_lock = threading.Lock()
+
+        # Optional callable invoked with the size of every block transferred
+        self.progress_callback = None
+
+        # Whether downloaded files are synced to disk once complete
+        self.fsync = False
+
+        # Objects larger than a slice are downloaded in this many concurrent
+        # slices (see segments.py)
+        self.segments = 1
+        self.segment_size = SEGMENT_SIZE
+
     @property
     def client_secrets_path(self):
         return self._client_secrets_path
@@ -49,13 +77,170 @@ class GCP:
     def project_id(self):
         return self._project_id
 
-    def download_file(self, gs_remote_path, local_path):
+    def download_file(self, gs_remote_path, local_path, expected_md5=None):
         """
         Given a remote GCP object's URL, starting with gs://, download it and
         save it to the specified local path.
+
+        If expected_md5 is given and Google Storage holds an MD5 checksum for
+        the object, the two are compared before anything is downloaded,
+        raising an exception if they differ. The storage library checks the
+        downloaded data against the object's checksum, so True is returned if
+        the checksums matched, meaning the file doesn't need to be read again
+        to validate it. Returns False otherwise.
+
+        Large objects are downloaded in slices fetched concurrently if
+        enabled, or if the partial file was started that way. Sliced
+        downloads are checked against the object's MD5 checksum or, for
+        objects without one, its CRC32C checksum.
         """
         self.logger.debug("In download_file.")
 
+        blob = self._get_blob(gs_remote_path)
+
+        server_md5 = None
+
+        if expected_md5 is not None:
+            server_md5 = self._blob_md5(blob)
+
+            if server_md5 is not None and server_md5 != expected_md5:
+                raise ChecksumMismatch("The MD5 checksum of {0} ({1}) doesn't match {2}."
+                                       .format(gs_remote_path, server_md5, expected_md5))
+
+        if has_journal(local_path) or (
+                self.segments > 1 and blob.size > self.segment_size):
+            self._handle_sliced_download(blob, local_path)
+
+            return server_md5 is not None
+
+        self.logger.info("Downloading %s to %s.", blob.name, local_path)
+
+        try:
+            with WriteBehindFile(local_path, 'wb', fsync=self.fsync) as filehandle:
+                def on_data(data):
+                    filehandle.write(data)
+
+                    if self.progress_callback is not None:
+                        self.progress_callback(len(data))
+
+                blob.download_to_file(CallbackSink(on_data), client=self.get_client())
+        except DataCorruption as e:
+            # The storage library checked the data against the object's
+            # checksum. The corrupted data must not be resumed from.
+            os.remove(local_path)
+            raise ChecksumMismatch("The data of {0} doesn't match the object's checksum: {1}"
+                                   .format(gs_remote_path, e)) from e
+
+        return server_md5 is not None
+
+    # Download the blob in slices fetched concurrently (see segments.py),
+    # then check the file against the checksums of the blob.
+    # Arguments:
+    # blob = the blob, with its metadata loaded
+    # local_path = path of the partial file
+    def _handle_sliced_download(self, blob, local_path):
+        self.logger.debug("In _handle_sliced_download.")
+
+        # A new generation of the object means its content changed
+        journal = SegmentJournal(local_path, blob.size, self.segment_size,
+                                 str(blob.generation))
+
+        self.logger.info("Downloading %s to %s in %s slices.", blob.name,
+                         local_path, journal.count)
+
+        client = self.get_client()
+
+        def fetch_range(start, end, write):
+            def on_data(data):
+                write(data)
+
+                if self.progress_callback is not None:
+                    self.progress_callback(len(data))
+
+            # The checksums of the blob cover the whole object, not a slice,
+            # so they are checked once the file is complete.
+            blob.download_to_file(
+                CallbackSink(on_data), client=client, start=start, end=end - 1,
+                if_generation_match=blob.generation, checksum=None
+            )
+
+        download_segments(journal, fetch_range, max(self.segments, 1), self.fsync)
+
+        server_md5 = self._blob_md5(blob)
+
+        if server_md5 is not None:
+            local_md5 = file_md5(local_path)
+
+            if local_md5 != server_md5:
+                os.remove(local_path)
+                raise ChecksumMismatch("The MD5 checksum of {0} ({1}) doesn't match the "
+                                       "object's ({2}).".format(local_path, local_md5, server_md5))
+        elif blob.crc32c:
+            local_crc32c = self._file_crc32c(local_path)
+
+            if local_crc32c is not None and local_crc32c != blob.crc32c:
+                os.remove(local_path)
+                raise ChecksumMismatch("The CRC32C checksum of {0} doesn't match the "
+                                       "object's.".format(local_path))
+
+    # Return the CRC32C checksum of a local file, base64 encoded like the
+    # checksums of blobs, or None if the google-crc32c package (a dependency
+    # of the storage library) isn't available.
+    # Arguments:
+    # local_path = path of the file
+    def _file_crc32c(self, local_path):
+        try:
+            import google_crc32c
+        except ImportError:
+            self.logger.warning("Unable to compute CRC32C checksums.")
+            return None
+
+        crc32c = google_crc32c.Checksum()
+
+        with open(local_path, 'rb') as filehandle:
+            for block in iter(lambda: filehandle.read(BLOCKSIZE), b''):
+                crc32c.update(block)
+
+        return base64.b64encode(crc32c.digest()).decode('ascii')
+
+    # Return the MD5 checksum of the blob as a hexadecimal string, or None if
+    # the blob has none (such as composite objects, which only have a CRC32C).
+    # Arguments:
+    # blob = the blob, with its metadata loaded
+    def _blob_md5(self, blob):
+        if not blob.md5_hash:
+            return None
+
+        return base64.b64decode(blob.md5_hash).hex()
+
+    def server_md5(self, gs_remote_path):
+        """
+        Return the MD5 checksum Google Storage holds for the object, or None.
+        """
+        self.logger.debug("In server_md5.")
+
+        return self._blob_md5(self._get_blob(gs_remote_path))
+
+    def stream_file(self, gs_remote_path, writer):
+        """
+        Download the remote GCP object, passing its contents to
+        writer.write() instead of saving them to a local file.
+        """
+        self.logger.debug("In stream_file.")
+
+        blob = self._get_blob(gs_remote_path)
+
+        self.logger.info("Streaming %s.", blob.name)
+
+        blob.download_to_file(writer, client=self.get_client())
+
+    def _parse_gs_url(self, gs_remote_path):
+        """
+        Split a gs://bucket_name/path url into the bucket name and the
+        object path.
+        """
+        self.logger.debug("In _parse_gs_url.")
+
         # Get the bucket from the gs_remote_path, which should be in the
         # form of gs://bucket_name/path
         if gs_remote_path.startswith('gs://'):
@@ -72,12 +257,41 @@ class GCP:
 
         self.logger.debug("Object path: %s", obj_path)
 
-        client = storage.Client(project=self.project_id, credentials=self.credentials)
+        return bucket_name, obj_path
+
+    def _get_blob(self, gs_remote_path):
+        """
+        Retrieve the blob, with its metadata loaded, for a gs:// url.
+        """
+        self.logger.debug("In _get_blob.")
+
+        bucket_name, obj_path = self._parse_gs_url(gs_remote_path)
+
+        bucket = self.get_client().get_bucket(bucket_name)
 
-        bucket = client.get_bucket(bucket_name)
+        blob = bucket.get_blob(obj_path)
 
-        blob = bucket.blob(obj_path)
+        if blob is None:
+            raise Exception("No such object: {}".format(gs_remote_path))
 
-        self.logger.info("Downloading %s to %s.", obj_path, local_path)
+        return blob
+
+    def get_client(self):
+        """
+        Return the storage client, creating it the first time it is needed.
+        """
+        with self._client_lock:
+            if self._client is None:
+                self.logger.debug("Creating the storage client.")
+                self._client = storage.Client(project=self.project_id,
+                                              credentials=self.credentials)
+
+            return self._client
+
+    def _get_file_size(self, gs_remote_path):
+        """
+        Retrieve the size of a remote GCP object without downloading it.
+        """
+        self.logger.debug("In _get_file_size.")
 
-        blob.download_to_filename(local_path)
+        return self._get_blob(gs_remote_path).size
@@ -0,0 +1,217 @@
+"""
+Tracks the health of the hosts the files are downloaded from, across all the
+files of a run, with a circuit breaker per host.
+
+A host starts out "closed" (usable). After failure_threshold connection
+failures in a row, it is "open": its URLs are skipped, so that the files are
+fetched from their other URLs without first waiting out a connection timeout
+on the failing host. Once open_seconds have passed, the host is "half-open":
+a single download is let through to probe it. If that download succeeds the
+host is closed again; if not, it stays open for twice as long as before (up
+to max_open_seconds).
+
+Only failures to reach a host count. An error reported by a host that could
+be reached (such as a missing file) says nothing about its health, and
+neither does a local error (such as a full disk) while the file is written.
+"""
+
+import errno
+import ftplib
+import logging
+import socket
+import ssl
+import sys
+import threading
+import time
+import urllib.error
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# The errors raised when a host can't be reached or stops responding
+NETWORK_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    socket.gaierror,
+    socket.herror,
+    ssl.SSLError,
+    ftplib.error_temp,
+    EOFError
+)
+
+# The error numbers of the other OSErrors meaning the host is unreachable
+NETWORK_ERRNOS = (errno.ENETUNREACH, errno.ENETDOWN, errno.EHOSTUNREACH, errno.EHOSTDOWN)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+def host_of(url):
+    """
+    Return the key of the host of a URL: its scheme and network location,
+    such as 'http://downloads.example.org' or 's3://bucket'.
+    """
+    parsed = urlparse(url)
+
+    return "{0}://{1}".format(parsed.scheme.lower(), parsed.netloc.lower())
+
+def is_host_failure(exception):
+    """
+    Whether the exception (or one of the exceptions that caused it) means
+    that the host couldn't be reached, or stopped responding.
+    """
+    network_errors = NETWORK_ERRORS
+
+    # Those of the requests library, used by the Google Storage client, which
+    # is only looked for once it is in use, to keep the startup fast
+    requests = sys.modules.get('requests')
+    if requests is not None:
+        network_errors += (requests.ConnectionError, requests.Timeout)
+
+    while exception is not None:
+        # The host answered, even if it was with an error
+        if isinstance(exception, urllib.error.HTTPError):
+            return False
+
+        # Errors about local files, such as the partial file being written
+        if getattr(exception, 'filename', None) is not None:
+            return False
+
+        if isinstance(exception, urllib.error.URLError):
+            # The reason is the error of the connection, or a description of
+            # a URL that can't be used
+            if not isinstance(exception.reason, BaseException):
+                return False
+
+            exception = exception.reason
+            continue
+
+        if isinstance(exception, network_errors):
+            return True
+
+        if isinstance(exception, OSError) and exception.errno in NETWORK_ERRNOS:
+            return True
+
+        exception = exception.__cause__ or exception.__context__
+
+    return False
+
+class HostHealth(object):
+    """
+    The HostHealth class keeps the circuit breakers of the hosts. It is safe
+    to use from several threads.
+    """
+    def __init__(self, failure_threshold=3, open_seconds=30, max_open_seconds=600):
+        """
+        Constructor for the HostHealth class.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self.failure_threshold = failure_threshold
+
+        self.open_seconds = open_seconds
+
+        self.max_open_seconds = max_open_seconds
+
+        self._lock = threading.Lock()
+
+        # The breakers, keyed by host
+        self._hosts = {}
+
+    def _get_breaker(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = {
+                'state': CLOSED,
+                'failures': 0,
+                'open_seconds': self.open_seconds,
+                'changed': time.time()
+            }
+
+        return self._hosts[host]
+
+    def state(self, url):
+        """
+        Return the state of the breaker of the host of the URL.
+        """
+        with self._lock:
+            return self._get_breaker(host_of(url))['state']
+
+    def states(self):
+        """
+        Return a dictionary of the state of the breaker of every host seen.
+        """
+        with self._lock:
+            return {host: breaker['state'] for host, breaker in self._hosts.items()}
+
+    def allow(self, url):
+        """
+        Whether a download from the URL should be attempted. Returns True for
+        the single probe of a host whose breaker has just become half-open.
+        """
+        host = host_of(url)
+
+        with self._lock:
+            breaker = self._get_breaker(host)
+
+            if breaker['state'] == CLOSED:
+                return True
+
+            # A probe that never reported back doesn't keep the host shut
+            if time.time() - breaker['changed'] < breaker['open_seconds']:
+                return False
+
+            self.logger.info("Probing %s.", host)
+
+            breaker['state'] = HALF_OPEN
+            breaker['changed'] = time.time()
+
+            return True
+
+    def record_success(self, url):
+        """
+        Record that a download from the URL worked, closing the breaker.
+        """
+        host = host_of(url)
+
+        with self._lock:
+            breaker = self._get_breaker(host)
+
+            if breaker['state'] != CLOSED:
+                self.logger.info("%s is available again.", host)
+
+            breaker['state'] = CLOSED
+            breaker['failures'] = 0
+            breaker['open_seconds'] = self.open_seconds
+            breaker['changed'] = time.time()
+
+    def record_failure(self, url):
+        """
+        Record that the host of the URL couldn't be reached, opening the
+        breaker if it failed too many times in a row, or if it was probed.
+        """
+        host = host_of(url)
+
+        with self._lock:
+            breaker = self._get_breaker(host)
+
+            breaker['failures'] += 1
+
+            # Such as a download started before the breaker opened
+            if breaker['state'] == OPEN:
+                return
+
+            if breaker['state'] == HALF_OPEN:
+                breaker['open_seconds'] = min(breaker['open_seconds'] * 2,
+                                              self.max_open_seconds)
+            elif breaker['failures'] < self.failure_threshold:
+                return
+
+            self.logger.warning("%s failed %s times in a row. Skipping it for " +
+                                "%s seconds.", host, breaker['failures'],
+                                breaker['open_seconds'])
+
+            breaker['state'] = OPEN
+            breaker['changed'] = time.time()
@@ -0,0 +1,317 @@
+"""
+A compact binary cache of parsed manifest files, so that repeated runs on a
+very large manifest don't have to parse its TSV (and build a dictionary per
+row) every time.
+
+The cache of a manifest file is named after the SHA-256 hash of the file's
+contents, so it is used for as long as the file is unchanged (wherever the
+file is), and a changed file gets a new cache. The cache is memory-mapped
+rather than read: loading it takes constant time, and the entries are
+decoded from the mapping only when they are accessed, by ManifestRecord
+objects that can be used like the dictionaries of a parsed manifest.
+
+The cache file holds, after a header:
+
+- the records: one fixed-width record per entry, with the offset and length
+  of its id, its MD5 checksum as 16 bytes, its size and the position of its
+  urls in the url table.
+- the url table: for every url, the index of its prefix (everything up to
+  the last '/') and the offset and length of the rest of the url. Prefixes
+  are shared by all the urls of a directory.
+- the prefix table: the offset and length of every distinct prefix.
+- the string heap, holding the text of the ids, urls and prefixes.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+from collections.abc import Mapping, Sequence
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PCMF'
+
+VERSION = 1
+
+# The file name extension of the caches
+CACHE_SUFFIX = '.manifest'
+
+# magic, version, SHA-256 of the manifest file, number of records, number of
+# urls, number of prefixes, and the offsets of the url table, the prefix
+# table and the string heap
+HEADER = struct.Struct('<4sI32sIIIQQQ')
+
+# id offset, id length, MD5, size (-1 if unknown), first url, url count, flags
+RECORD = struct.Struct('<QI16sqIIB')
+
+# The id offset and length, at the start of a record
+RECORD_ID = struct.Struct('<QI')
+
+# prefix index, suffix offset, suffix length
+URL = struct.Struct('<IQI')
+
+# offset, length
+PREFIX = struct.Struct('<QI')
+
+# Set for records whose MD5 isn't 32 hexadecimal digits, and is kept in the
+# string heap instead (its offset and length in place of the 16 bytes)
+MD5_IN_HEAP = 1
+MD5_HEAP = struct.Struct('<QI4x')
+
+MD5_RE = re.compile(r"^[0-9a-f]{32}$")
+
+KEYS = ('id', 'md5', 'size', 'urls')
+
+def default_cache_dir():
+    """
+    Return the default directory of the caches, in the user's cache
+    directory.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(base, 'portal_client')
+
+def file_digest(path):
+    """
+    Return the SHA-256 hash of the contents of a file, in hexadecimal.
+    """
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def cache_path(cache_dir, digest):
+    """
+    Return the path of the cache of the manifest file with the given hash.
+    """
+    return os.path.join(cache_dir, digest + CACHE_SUFFIX)
+
+def write_cache(manifest, path, digest):
+    """
+    Write the cache of a parsed manifest (a list of dictionaries) to path.
+    digest is the SHA-256 hash of the manifest file, in hexadecimal. The
+    cache is replaced atomically.
+    """
+    logger.debug("In write_cache: %s", path)
+
+    heap = bytearray()
+
+    def add_string(text):
+        data = text.encode('utf-8')
+        offset = len(heap)
+        heap.extend(data)
+        return offset, len(data)
+
+    records = bytearray()
+    urls = bytearray()
+    url_count = 0
+    prefixes = {}
+
+    for mfile in manifest:
+        id_offset, id_length = add_string(mfile['id'])
+
+        flags = 0
+        md5 = mfile['md5']
+
+        if MD5_RE.match(md5):
+            md5_field = bytes.fromhex(md5)
+        else:
+            flags |= MD5_IN_HEAP
+            md5_field = MD5_HEAP.pack(*add_string(md5))
+
+        size = mfile.get('size')
+
+        record_urls = mfile['urls'].split(',')
+
+        records += RECORD.pack(id_offset, id_length, md5_field,
+                               -1 if size is None else size,
+                               url_count, len(record_urls), flags)
+
+        for url in record_urls:
+            prefix, sep, suffix = url.rpartition('/')
+            prefix += sep
+
+            if prefix not in prefixes:
+                prefixes[prefix] = len(prefixes)
+
+            urls += URL.pack(prefixes[prefix], *add_string(suffix))
+            url_count += 1
+
+    prefix_table = bytearray()
+
+    for prefix in prefixes:
+        prefix_table += PREFIX.pack(*add_string(prefix))
+
+    urls_offset = HEADER.size + len(records)
+    prefixes_offset = urls_offset + len(urls)
+    heap_offset = prefixes_offset + len(prefix_table)
+
+    header = HEADER.pack(MAGIC, VERSION, bytes.fromhex(digest), len(records) // RECORD.size,
+                         url_count, len(prefixes), urls_offset, prefixes_offset,
+                         heap_offset)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+
+    with open(tmp_path, 'wb') as cache:
+        for section in (header, records, urls, prefix_table, heap):
+            cache.write(section)
+
+    os.replace(tmp_path, path)
+
+class ManifestRecord(Mapping):
+    """
+    An entry of a cached manifest, which reads like the dictionary of a
+    parsed manifest entry (with the keys 'id', 'md5', 'size' and 'urls').
+    Its values are decoded from the cache when they are accessed.
+    """
+    __slots__ = ('_manifest', '_index')
+
+    def __init__(self, manifest, index):
+        self._manifest = manifest
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._manifest._value(self._index, key)
+
+    def __iter__(self):
+        return iter(KEYS)
+
+    def __len__(self):
+        return len(KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class CachedManifest(Sequence):
+    """
+    The CachedManifest class gives access to the entries of a cache, as a
+    read-only list of ManifestRecord objects.
+    """
+    def __init__(self, path, digest=None):
+        """
+        Constructor for the CachedManifest class. Raises ValueError if the
+        file isn't a cache of this version, or (if digest is given) isn't
+        the cache of the manifest file with that hash.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self.path = path
+
+        with open(path, 'rb') as cache:
+            # An empty file can't be mapped
+            if os.fstat(cache.fileno()).st_size < HEADER.size:
+                raise ValueError("{} is not a manifest cache.".format(path))
+
+            self._mm = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, source_digest, self._count, self._url_count, prefix_count,
+         self._urls_offset, self._prefixes_offset, self._heap_offset) = \
+            HEADER.unpack_from(self._mm, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a manifest cache of version {}.".format(path, VERSION))
+
+        if digest is not None and source_digest.hex() != digest:
+            raise ValueError("{} is the cache of another manifest.".format(path))
+
+        if self._heap_offset > len(self._mm):
+            raise ValueError("{} is truncated.".format(path))
+
+        # The prefixes are few, and used by every url
+        self._prefixes = [
+            self._string(*PREFIX.unpack_from(self._mm, self._prefixes_offset + index * PREFIX.size))
+            for index in range(prefix_count)
+        ]
+
+    def _string(self, offset, length):
+        start = self._heap_offset + offset
+
+        return self._mm[start:start + length].decode('utf-8')
+
+    def _value(self, index, key):
+        offset = HEADER.size + index * RECORD.size
+
+        # The id is read the most, and on its own
+        if key == 'id':
+            return self._string(*RECORD_ID.unpack_from(self._mm, offset))
+
+        (_, _, md5, size, url_start, url_count, flags) = RECORD.unpack_from(self._mm, offset)
+
+        if key == 'md5':
+            if flags & MD5_IN_HEAP:
+                return self._string(*MD5_HEAP.unpack(md5))
+
+            return md5.hex()
+
+        if key == 'size':
+            return None if size < 0 else size
+
+        if key == 'urls':
+            urls = []
+
+            for position in range(url_start, url_start + url_count):
+                prefix, offset, length = URL.unpack_from(
+                    self._mm, self._urls_offset + position * URL.size
+                )
+                urls.append(self._prefixes[prefix] + self._string(offset, length))
+
+            return ','.join(urls)
+
+        raise KeyError(key)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+
+        if index < 0:
+            index += self._count
+
+        if not 0 <= index < self._count:
+            raise IndexError("manifest index out of range")
+
+        return ManifestRecord(self, index)
+
+    def __iter__(self):
+        return (ManifestRecord(self, index) for index in range(self._count))
+
+    def __len__(self):
+        return self._count
+
+def load_manifest(file, cache_dir, parse):
+    """
+    Return the entries of a manifest file from its cache in cache_dir. If
+    there is no usable cache, the file is parsed with parse(file) and the
+    cache is written for the next runs.
+    """
+    logger.debug("In load_manifest: %s", file)
+
+    digest = file_digest(file)
+    path = cache_path(cache_dir, digest)
+
+    try:
+        manifest = CachedManifest(path, digest)
+        logger.debug("Loaded %s entries from %s.", len(manifest), path)
+        return manifest
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring the manifest cache %s: %s", path, e)
+
+    manifest = parse(file)
+
+    try:
+        write_cache(manifest, path, digest)
+    except OSError as e:
+        logger.warning("Unable to write the manifest cache %s: %s", path, e)
+
+    return manifest
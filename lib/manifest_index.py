@@ -0,0 +1,126 @@
+"""
+Keeps an index, stored in the destination directory (in the same database as
+the index of verified files, see stat_cache.py), of the manifest entries that
+were synced to the destination: the id, MD5 checksum and local path of every
+entry of the last synced manifest that was downloaded successfully.
+
+When a new version of the manifest is synced, it is compared with the index
+by id and MD5 checksum, so that only the entries that are new, or whose
+checksum changed, have to be downloaded, and the files of the entries that
+left the manifest can be removed.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+
+from stat_cache import INDEX_NAME
+
+logger = logging.getLogger(__name__)
+
+def diff_manifest(previous, manifest):
+    """
+    Compare a manifest with the entries of the index, a dictionary of
+    (md5, path) tuples keyed by id. Returns a dictionary with the lists of
+    manifest entries that are 'added', 'changed' (a different checksum) and
+    'unchanged', and the list of the ids that were 'removed'.
+    """
+    logger.debug("In diff_manifest.")
+
+    diff = {'added': [], 'changed': [], 'unchanged': [], 'removed': []}
+
+    ids = set()
+
+    for mfile in manifest:
+        ids.add(mfile['id'])
+
+        if mfile['id'] not in previous:
+            diff['added'].append(mfile)
+        elif previous[mfile['id']][0] != mfile['md5']:
+            diff['changed'].append(mfile)
+        else:
+            diff['unchanged'].append(mfile)
+
+    diff['removed'] = [manifest_id for manifest_id in previous if manifest_id not in ids]
+
+    return diff
+
+class ManifestIndex(object):
+    """
+    The ManifestIndex class records the synced entries of a destination.
+    """
+    def __init__(self, destination):
+        """
+        Constructor for the ManifestIndex class.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self._destination = destination
+
+        self._lock = threading.Lock()
+
+        index_path = os.path.join(destination, INDEX_NAME)
+        self.logger.debug("Opening index %s.", index_path)
+
+        self._conn = sqlite3.connect(index_path, check_same_thread=False)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS manifest_index (" +
+                "id TEXT PRIMARY KEY, md5 TEXT, path TEXT)"
+            )
+
+    def entries(self):
+        """
+        Return the synced entries, as a dictionary of (md5, path) tuples
+        keyed by id.
+        """
+        self.logger.debug("In entries.")
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, md5, path FROM manifest_index"
+            ).fetchall()
+
+        # Paths are stored relative to the destination.
+        return {
+            manifest_id: (md5, os.path.join(self._destination, path))
+            for manifest_id, md5, path in rows
+        }
+
+    def record(self, entries):
+        """
+        Record entries that were synced, given as (id, md5, path) tuples.
+        """
+        self.logger.debug("In record: %s entries", len(entries))
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO manifest_index VALUES (?, ?, ?)",
+                [(manifest_id, md5, os.path.relpath(path, self._destination))
+                 for manifest_id, md5, path in entries]
+            )
+
+    def remove(self, ids):
+        """
+        Remove the entries with the given ids.
+        """
+        self.logger.debug("In remove: %s entries", len(ids))
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM manifest_index WHERE id = ?",
+                [(manifest_id,) for manifest_id in ids]
+            )
+
+    def close(self):
+        """
+        Close the index.
+        """
+        self.logger.debug("In close.")
+
+        with self._lock:
+            self._conn.close()
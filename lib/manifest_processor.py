@@ -6,13 +6,40 @@ import hashlib
 import logging
 import os
 import shutil
-import aspera
-
-from portal_http import PortalHTTP
-from s3 import S3
-from ftp import PortalFTP
-
-from boto.utils import get_instance_metadata
+import threading
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+from checksum import ChecksumMismatch, file_md5, verify_file
+from host_health import HostHealth, is_host_failure
+from peer_cache import peer_url
+from session import DownloadResult, DownloadCancelled
+from scheduling import scheduling_policy
+from segments import JOURNAL_SUFFIX, SEGMENT_SIZE, partial_bytes
+from streaming import BoundedWriter
+
+# The protocol modules (and the libraries they depend on) are only imported
+# once a manifest needs them, which keeps the startup of the client fast.
+
+# Suffixes of the sidecar files kept next to partial downloads (the HTTP
+# validators of portal_http.META_SUFFIX, the temporary file they are written
+# to, and the journal of a segmented download), removed once a file is
+# complete.
+PARTIAL_SIDECARS = ('.meta', '.meta.tmp', JOURNAL_SUFFIX)
+
+# The endpoint the transfers of each protocol client are counted against
+CLIENT_ENDPOINTS = {
+    'fasp_runner': 'FASP',
+    'http_client': 'HTTP',
+    'peer_client': 'PEER',
+    'ftp_client': 'FTP',
+    'aws_s3': 'S3',
+    'gcp_client': 'GS'
+}
+
+# The settings of the processor that are passed on to the protocol clients
+CLIENT_SETTINGS = ('fsync', 'segments', 'segment_size', 'timeout')
 
 class ManifestProcessor(object):
 
@@ -25,16 +52,24 @@ class ManifestProcessor(object):
 
         self.logger.addHandler(logging.NullHandler())
 
-        # Create the HTTP client
-        self.http_client = PortalHTTP(blocksize=blocksize)
+        self.blocksize = blocksize
+
+        # The protocol clients, created the first time each is needed
+        self._clients = {}
+        self._clients_lock = threading.RLock()
 
-        # Create the FTP client
-        self.ftp_client = PortalFTP(blocksize=blocksize)
+        # The locks the clients are created under, and the exceptions raised
+        # by the clients that could not be created, keyed by name
+        self._client_locks = {}
+        self._client_errors = {}
 
-        # Create the AWS S3 client
-        self.aws_s3 = S3(blocksize=blocksize)
+        # Set to interrupt the downloads in progress
+        self._cancelled = threading.Event()
 
-        self.blocksize = blocksize
+        # The locks of the files being downloaded, with the number of
+        # downloads using each, keyed by path
+        self._path_locks = {}
+        self._path_locks_lock = threading.Lock()
 
         self.username = username
 
@@ -44,44 +79,194 @@ class ManifestProcessor(object):
         # retrieved/downloaded.
         self.validation = True
 
-        if google_client_secrets is not None and google_project_id is not None:
+        # Whether downloaded files are synced to disk once complete
+        self.fsync = False
+
+        # The number of concurrent byte ranges large files are downloaded in
+        self.segments = 1
+        self.segment_size = SEGMENT_SIZE
+
+        # Seconds to wait for a host to connect or respond
+        self.timeout = 60
+
+        # The number of concurrent Aspera sessions and their total rate
+        self.fasp_sessions = 1
+        self.fasp_rate = None
+
+        # The number of files downloaded at the same time by the current run,
+        # which no more Aspera sessions than can be used by
+        self._workers = None
+
+        # The default endpoint priorities depend on whether we are on EC2,
+        # which is only worth checking once per run.
+        self._default_priorities = None
+
+        # Indexes of verified files, keyed by destination directory
+        self._stat_caches = {}
+        self._stat_caches_lock = threading.Lock()
+
+        # Optionally processes files once they are downloaded
+        self.post_processor = None
+
+        # Other nodes (host:port) serving their verified files, which are
+        # tried before the URLs of the manifest (see peer_cache.py)
+        self.peers = []
+
+        # Optionally spreads the files across several destinations
+        self.placement = None
+
+        # The circuit breakers of the hosts, shared by all the downloads
+        self.host_health = HostHealth()
+
+        # Optionally counts the transfers and their outcomes (see metrics.py)
+        self.metrics = None
+
+        # An S3-compatible service to use instead of Amazon S3
+        self.s3_endpoint_url = None
+
+        # GCP is only available when its credentials were provided
+        self._google_client_secrets = google_client_secrets
+        self._google_project_id = google_project_id
+        self._google_read_only = True
+
+    def _get_client(self, name, factory):
+        """
+        Return the named protocol client, creating it with the factory the
+        first time it is requested. A client is created under a lock of its
+        own, so that a slow factory (such as the interactive authorization
+        of GCP) only holds up the downloads that need that client. If the
+        factory fails, the same exception is raised on every later request
+        rather than creating the client again.
+        """
+        with self._clients_lock:
+            if name in self._clients:
+                return self._clients[name]
+
+            lock = self._client_locks.setdefault(name, threading.Lock())
+
+        with lock:
+            with self._clients_lock:
+                if name in self._clients:
+                    return self._clients[name]
+
+            if name in self._client_errors:
+                raise self._client_errors[name]
+
+            self.logger.debug("Creating %s.", name)
+
+            try:
+                client = factory()
+            except Exception as e:
+                self._client_errors[name] = e
+                raise
+
+            # Report transferred blocks back to the processor
+            if hasattr(client, 'progress_callback'):
+                endpoint = CLIENT_ENDPOINTS.get(name)
+
+                def progress(nbytes):
+                    self._transfer_progress(nbytes, endpoint)
+
+                client.progress_callback = progress
+
+            with self._clients_lock:
+                for setting in CLIENT_SETTINGS:
+                    if hasattr(client, setting):
+                        setattr(client, setting, getattr(self, setting))
+
+                self._clients[name] = client
+
+            return client
+
+    @property
+    def fasp_runner(self):
+        def create():
+            import aspera
+            return aspera.FaspRunner(sessions=self._fasp_session_count(),
+                                     rate=self.fasp_rate or aspera.DEFAULT_RATE)
+
+        return self._get_client('fasp_runner', create)
+
+    @property
+    def http_client(self):
+        def create():
+            from portal_http import PortalHTTP
+            return PortalHTTP(blocksize=self.blocksize)
+
+        return self._get_client('http_client', create)
+
+    @property
+    def peer_client(self):
+        def create():
+            from portal_http import PortalHTTP
+            return PortalHTTP(blocksize=self.blocksize)
+
+        return self._get_client('peer_client', create)
+
+    @property
+    def ftp_client(self):
+        def create():
+            from ftp import PortalFTP
+            return PortalFTP(blocksize=self.blocksize)
+
+        return self._get_client('ftp_client', create)
+
+    @property
+    def aws_s3(self):
+        def create():
+            from s3 import S3
+            return S3(blocksize=self.blocksize, endpoint_url=self.s3_endpoint_url)
+
+        return self._get_client('aws_s3', create)
+
+    @property
+    def gcp_client(self):
+        if self._google_client_secrets is None or self._google_project_id is None:
+            return None
+
+        def create():
             self.logger.info("Create GCP client.")
             from gcp import GCP
-            self.gcp_client = GCP(google_project_id, google_client_secrets)
+            return GCP(self._google_project_id, self._google_client_secrets,
+                       read_only=self._google_read_only)
+
+        return self._get_client('gcp_client', create)
 
     def _get_fasp_obj(self, url, file_name):
         self.logger.debug("In _get_fasp_obj: %s", url)
 
-        if url.startswith('fasp://'):
-            url = url[7:]
+        fasp_path = url
+        if fasp_path.startswith('fasp://'):
+            fasp_path = fasp_path[7:]
 
-        self.logger.debug("URL: %s", url)
+        self.logger.debug("URL: %s", fasp_path)
 
-        server = url.split('/')[0]
+        server = fasp_path.split('/')[0]
         self.logger.debug("Aspera server: %s", server)
 
-        remote_path = url
+        remote_path = fasp_path
         remote_path = remote_path.lstrip(server)
         self.logger.debug("Remote path: %s", remote_path)
 
         result = None
 
         try:
-            success = aspera.download_file(server, self.username, self.password,
-                                           remote_path, file_name)
+            success = self.fasp_runner.download_file(
+                server, self.username, self.password, remote_path, file_name
+            )
 
             if not success:
                 self.logger.error("Aspera transfer failed.")
                 result = "error"
         except Exception as e:
-            self.logger.error(e)
+            self._download_failed(url, e)
             result = "error"
 
         self.logger.debug("Returning %s", result)
 
         return result
 
-    def _get_gcp_obj(self, url, file_name):
+    def _get_gcp_obj(self, url, file_name, md5=None):
         self.logger.debug("In _get_gcp_obj: %s", url)
 
         if not url.startswith('gs://'):
@@ -91,9 +276,14 @@ class ManifestProcessor(object):
         result = None
 
         try:
-            self.gcp_client.download_file(url, file_name)
-        except Exception as e:
+            # Validated against the server's checksum of the object
+            if self.gcp_client.download_file(url, file_name, expected_md5=md5):
+                result = "validated"
+        except ChecksumMismatch as e:
             self.logger.error(e)
+            result = "mismatch"
+        except Exception as e:
+            self._download_failed(url, e)
             result = "error"
 
         self.logger.debug("Returning %s", result)
@@ -112,7 +302,7 @@ class ManifestProcessor(object):
         try:
             self.ftp_client.download_file(url, file_name)
         except Exception as e:
-            self.logger.error(e)
+            self._download_failed(url, e)
             result = "error"
 
         self.logger.debug("Returning %s", result)
@@ -131,14 +321,33 @@ class ManifestProcessor(object):
         try:
             self.http_client.download_file(url, file_name)
         except Exception as e:
-            self.logger.error(e)
+            self._download_failed(url, e)
+            result = "error"
+
+        self.logger.debug("Returning %s", result)
+
+        return result
+
+    def _get_peer_obj(self, url, file_name):
+        self.logger.debug("In _get_peer_obj: %s", url)
+
+        result = None
+
+        try:
+            self.peer_client.download_file(url, file_name)
+        except urllib.error.HTTPError as e:
+            # Most files aren't on every peer, which isn't worth an error
+            self.logger.info("%s isn't available from the peer: %s", url, e)
+            result = "error"
+        except Exception as e:
+            self._download_failed(url, e)
             result = "error"
 
         self.logger.debug("Returning %s", result)
 
         return result
 
-    def _get_s3_obj(self, url, file_name):
+    def _get_s3_obj(self, url, file_name, md5=None):
         self.logger.debug("In _get_s3_obj: %s", url)
 
         if not url.startswith('s3://'):
@@ -148,15 +357,84 @@ class ManifestProcessor(object):
         result = None
 
         try:
-            self.aws_s3.download_file(url, file_name)
-        except Exception as e:
+            # Validated against the server's checksum of the object
+            if self.aws_s3.download_file(url, file_name, expected_md5=md5):
+                result = "validated"
+        except ChecksumMismatch as e:
             self.logger.error(e)
+            result = "mismatch"
+        except Exception as e:
+            self._download_failed(url, e)
             result = "error"
 
         self.logger.debug("Returning %s", result)
 
         return result
 
+    # Log the failure of a download, and count it against the health of the
+    # host if the host couldn't be reached.
+    # Arguments:
+    # url = the URL the file was being downloaded from
+    # exception = the exception raised by the download
+    def _download_failed(self, url, exception):
+        self.logger.error(exception)
+
+        if is_host_failure(exception):
+            self.host_health.record_failure(url)
+
+    def set_metrics(self, metrics):
+        """
+        Set a Metrics object (see metrics.py) to count the transfers in.
+        """
+        self.logger.debug("In set_metrics.")
+
+        self.metrics = metrics
+
+    def set_peers(self, peers):
+        """
+        Set the peers (a list of host:port) to try to get each file from,
+        by its MD5 checksum, before the URLs of the manifest. Files from the
+        peers are validated like any others.
+        """
+        self.logger.debug("In set_peers: %s", peers)
+
+        self.peers = list(peers)
+
+    def set_placement(self, placement):
+        """
+        Set a Placement (see placement.py) to spread the downloaded files
+        across several destinations. The destination passed to the download
+        methods is then only used for the indexes of the run.
+        """
+        self.logger.debug("In set_placement.")
+
+        self.placement = placement
+
+    # Return the destination a manifest entry was placed in, or the given
+    # destination if the files aren't spread across several destinations
+    # or the entry wasn't placed yet.
+    # Arguments:
+    # mfile = the manifest entry
+    # destination = the destination directory
+    def _placed_destination(self, mfile, destination):
+        if self.placement is None:
+            return destination
+
+        return self.placement.lookup(mfile['id']) or destination
+
+    def set_post_processor(self, post_processor):
+        """
+        Set a PostProcessor (see postprocess.py) to hand every newly
+        downloaded and validated file to.
+        """
+        self.logger.debug("In set_post_processor.")
+
+        self.post_processor = post_processor
+
+    def _post_process(self, file_name, manifest_id):
+        if self.post_processor is not None:
+            self.post_processor.submit(file_name, manifest_id)
+
     def disable_validation(self):
         """
         Method to turn off MD5 checksum checking after a file is downloaded.
@@ -168,98 +446,1093 @@ class ManifestProcessor(object):
 
         self.validation = False
 
-    def download_manifest(self, manifest, destination, priorities):
+    def enable_fsync(self):
+        """
+        Method to sync every downloaded file to disk once its transfer is
+        complete, so that a crash of the node can't lose the data of a file
+        that was reported as downloaded. Slows down the downloads.
+        """
+        self.logger.debug("In enable_fsync.")
+
+        self._set_client_setting('fsync', True)
+
+    def enable_segments(self, segments, segment_size=SEGMENT_SIZE):
+        """
+        Method to download files larger than segment_size bytes (from HTTP
+        servers that support byte ranges, and from S3) as that many segments
+        fetched concurrently, which helps when a single connection can't use
+        the available bandwidth.
+        """
+        self.logger.debug("In enable_segments: %s", segments)
+
+        self._set_client_setting('segments', segments)
+        self._set_client_setting('segment_size', segment_size)
+
+    def set_timeout(self, timeout):
+        """
+        Method to set the number of seconds to wait for an HTTP or FTP host
+        to accept a connection or to send more data, before giving up on it.
+        """
+        self.logger.debug("In set_timeout: %s", timeout)
+
+        self._set_client_setting('timeout', timeout)
+
+    def set_s3_endpoint_url(self, endpoint_url):
+        """
+        Method to use an S3-compatible service (such as http://localhost:9000)
+        for s3:// URLs instead of Amazon S3. Must be called before any file
+        is downloaded from S3.
+        """
+        self.logger.debug("In set_s3_endpoint_url: %s", endpoint_url)
+
+        self.s3_endpoint_url = endpoint_url
+
+    def enable_gcp_writes(self):
+        """
+        Method to request the authorization to write to Google Storage, for
+        a gs:// destination. Must be called before the GCP client is used.
+        """
+        self.logger.debug("In enable_gcp_writes.")
+
+        self._google_read_only = False
+
+    def authorize_gcp(self):
+        """
+        Method to obtain the authorization to use Google Storage right away,
+        which prompts for a code on the console, rather than when the first
+        gs:// file is needed. Returns the GCP client, or None if the GCP
+        credentials weren't provided.
+        """
+        self.logger.debug("In authorize_gcp.")
+
+        return self.gcp_client
+
+    def set_fasp_options(self, sessions=1, rate=None):
+        """
+        Method to set the number of Aspera sessions that may run at the same
+        time, and the target rate (such as '1G') shared by those sessions.
+        Must be called before any file is downloaded.
+        """
+        self.logger.debug("In set_fasp_options: %s, %s", sessions, rate)
+
+        self.fasp_sessions = sessions
+        self.fasp_rate = rate
+
+    # Return the number of Aspera sessions that may run at the same time.
+    def _fasp_session_count(self):
+        if self._workers is None:
+            return self.fasp_sessions
+
+        return max(min(self.fasp_sessions, self._workers), 1)
+
+    # Set the number of files the run downloads at the same time, so that
+    # the rate of the Aspera sessions is only shared by those that can run.
+    # Arguments:
+    # workers = the number of concurrent downloads
+    def _set_workers(self, workers):
+        self._workers = workers
+
+        with self._clients_lock:
+            runner = self._clients.get('fasp_runner')
+
+        if runner is not None:
+            runner.set_sessions(self._fasp_session_count())
+
+    # Change a setting of the processor and of the protocol clients already
+    # created.
+    # Arguments:
+    # name = the name of the setting, one of CLIENT_SETTINGS
+    # value = the new value of the setting
+    def _set_client_setting(self, name, value):
+        setattr(self, name, value)
+
+        with self._clients_lock:
+            for client in self._clients.values():
+                if hasattr(client, name):
+                    setattr(client, name, value)
+
+    def download_manifest(self, manifest, destination, priorities, workers=1,
+                          scheduling='manifest'):
         """
         Downloads each URL from the manifest.
         Arguments:
         manifest = manifest list
         destination = the destination directory to save downloaded files
         priorities = the protocol priorities
+        workers = the number of files to download concurrently
+        scheduling = the name of the scheduling policy that determines the
+                     order in which files are started (see scheduling.py)
+        Returns a list of failure codes, one per manifest entry, in manifest
+        order.
         """
         self.logger.debug("In download_manifest.")
 
         # Build a list of elements to indicate how many and why the files failed
+        # 0 = downloaded successfully (or already present)
         # 1 = no valid URL in manifest
         # 2 = URL exists, but not accessible at the location specified
         # 3 = MD5 check failed for file (file is corrupted or the wrong MD5 is attached to the file)
+        manifest = list(manifest)
+        failed_files = [None] * len(manifest)
+
+        # Remember where each entry sits in the manifest so that the results
+        # are reported in manifest order regardless of the scheduling.
+        positions = {id(mfile): index for index, mfile in enumerate(manifest)}
+
+        self._set_workers(workers)
+
+        def download(mfile):
+            return self._download_manifest_file(mfile, destination, priorities)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(download, mfile): positions[id(mfile)]
+                for mfile in scheduling_policy(scheduling)(manifest)
+            }
+
+            for future, index in futures.items():
+                failed_files[index] = future.result().status
+
+        return failed_files
+
+    def sync_manifest(self, manifest, destination, priorities, workers=1,
+                      scheduling='manifest', prune=False):
+        """
+        Brings the destination up to date with a new version of a manifest.
+        The manifest is compared, by id and MD5 checksum, with the index of
+        the manifest last synced to the destination (see manifest_index.py),
+        and only the entries that are new, that changed, or whose file is
+        missing are downloaded. Entries that failed are retried by the next
+        sync.
+        Arguments:
+        manifest = manifest list
+        destination = the destination directory to save downloaded files
+        priorities = the protocol priorities
+        workers = the number of files to download concurrently
+        scheduling = the name of the scheduling policy (see scheduling.py)
+        prune = whether to remove the files of the entries that are no longer
+                in the manifest
+        Returns a dictionary with the failure codes (see download_manifest)
+        of the manifest entries in manifest order, under 'codes', the ids of
+        the entries that were 'added', 'changed', 'missing' and 'removed',
+        the number of entries 'unchanged', and the paths 'pruned'.
+        """
+        self.logger.debug("In sync_manifest.")
+
+        from manifest_index import ManifestIndex, diff_manifest
+
+        manifest = list(manifest)
+
+        index = ManifestIndex(destination)
+
+        try:
+            previous = index.entries()
+            diff = diff_manifest(previous, manifest)
+
+            # Unchanged entries are only checked for the presence of their file
+            missing = [
+                mfile for mfile in diff['unchanged']
+                if not os.path.exists(previous[mfile['id']][1])
+            ]
+
+            pending = diff['added'] + diff['changed'] + missing
+
+            self.logger.info("Syncing %s new, %s changed and %s missing entries.",
+                             len(diff['added']), len(diff['changed']), len(missing))
+
+            codes = self.download_manifest(pending, destination, priorities,
+                                           workers=workers, scheduling=scheduling)
+
+            statuses = {mfile['id']: code for mfile, code in zip(pending, codes)}
+
+            # The local path of every entry of the manifest
+            paths = {}
+            for mfile in manifest:
+                url_list = self._get_prioritized_endpoint(mfile['urls'], priorities)
+
+                if url_list:
+                    paths[mfile['id']] = self._get_file_name(
+                        url_list, self._placed_destination(mfile, destination)
+                    )
+
+            index.record([
+                (mfile['id'], mfile['md5'], paths[mfile['id']])
+                for mfile in pending if statuses[mfile['id']] == 0
+            ])
+
+            pruned = []
+
+            if prune:
+                # The files of the entries that left the manifest, or that
+                # changed to another path, unless another entry uses them
+                in_use = set(paths.values())
+                stale = [previous[manifest_id][1] for manifest_id in diff['removed']]
+                stale += [
+                    previous[mfile['id']][1] for mfile in diff['changed']
+                    if statuses[mfile['id']] == 0
+                ]
+
+                for path in stale:
+                    if path not in in_use and self._prune_file(path):
+                        pruned.append(path)
+
+                index.remove(diff['removed'])
+        finally:
+            index.close()
+
+        return {
+            'codes': [statuses.get(mfile['id'], 0) for mfile in manifest],
+            'added': [mfile['id'] for mfile in diff['added']],
+            'changed': [mfile['id'] for mfile in diff['changed']],
+            'missing': [mfile['id'] for mfile in missing],
+            'unchanged': len(diff['unchanged']) - len(missing),
+            'removed': diff['removed'],
+            'pruned': pruned
+        }
+
+    # Remove a file that is no longer in the synced manifest, along with its
+    # record in the index of verified files. Returns True if it was removed.
+    # Arguments:
+    # path = the path of the file
+    def _prune_file(self, path):
+        self.logger.info("Pruning %s.", path)
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            self.logger.error("Unable to prune %s: %s", path, e)
+            return False
+
+        # The files are directly in the destination they were placed in
+        stat_cache = self._get_stat_cache(os.path.dirname(path))
+
+        if stat_cache is not None:
+            stat_cache.forget(path)
+
+        return True
+
+    def download_queue(self, queue, destination, priorities, workers=1):
+        """
+        Downloads entries claimed from a work queue shared with other
+        processes (see work_queue.py) until every entry is done or failed.
+        Entries leased by other processes are waited for, and claimed if
+        their lease expires. The leases of the entries being downloaded are
+        renewed in the background.
+        Arguments:
+        queue = the WorkQueue to claim entries from
+        destination = the destination directory to save downloaded files
+        priorities = the protocol priorities
+        workers = the number of files to download concurrently
+        Returns the failure codes (see download_manifest) of the entries
+        downloaded by this process.
+        """
+        self.logger.debug("In download_queue.")
+
+        self._set_workers(workers)
+
+        stop = threading.Event()
+
+        def renew_leases():
+            while not stop.wait(queue.lease_seconds / 3.0):
+                queue.renew()
+
+        def work():
+            codes = []
+
+            while True:
+                mfile = queue.claim()
+
+                if mfile is None:
+                    if not queue.unfinished():
+                        return codes
+
+                    # The entries left are leased, maybe by a process that
+                    # died, whose leases can be claimed once they expire
+                    if self._cancelled.wait(queue.lease_seconds / 3.0):
+                        return codes
+
+                    continue
+
+                try:
+                    code = self._download_manifest_file(mfile, destination, priorities).status
+                except Exception:
+                    queue.complete(mfile['id'], 2)
+                    raise
+
+                queue.complete(mfile['id'], code)
+                codes.append(code)
+
+        renewer = threading.Thread(target=renew_leases, daemon=True)
+        renewer.start()
+
         failed_files = []
 
-        # iterate over the manifest data structure, one ID/file at a time
-        for mfile in manifest:
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(work) for _ in range(workers)]
 
-            url_list = self._get_prioritized_endpoint(mfile['urls'], priorities)
+                for future in futures:
+                    failed_files.extend(future.result())
+        finally:
+            stop.set()
+            renewer.join()
 
-            # Handle private data or simply nodes that are not correct and lack
-            # endpoint data
-            if not url_list:
-                print("No valid URL found in the manifest for file ID {0}".format(mfile['id']))
-                failed_files.append(1)
-                continue
+        return failed_files
+
+    def _download_manifest_file(self, mfile, destination, priorities):
+        """
+        Download a single manifest entry, returning a DownloadResult whose
+        status is the failure code of the entry (see download_manifest).
+        """
+        self.logger.debug("In _download_manifest_file: %s", mfile['id'])
+
+        result = DownloadResult(mfile['id'])
+        start = time.time()
+
+        if self.metrics is not None:
+            self.metrics.file_started(mfile['id'])
+
+        try:
+            result.status = self._fetch_manifest_file(mfile, destination, priorities, result)
+        finally:
+            result.duration = time.time() - start
+
+            if self.placement is not None:
+                self.placement.release(mfile['id'])
+
+            if self.metrics is not None:
+                self.metrics.file_finished(result)
 
-            url_file_element = url_list[0].split('/')[-1]
-            file_name = os.path.join(destination, url_file_element)
+        return result
+
+    def _fetch_manifest_file(self, mfile, destination, priorities, result):
+        url_list = self._get_prioritized_endpoint(mfile['urls'], priorities)
+
+        # Handle private data or simply nodes that are not correct and lack
+        # endpoint data
+        if not url_list:
+            print("No valid URL found in the manifest for file ID {0}".format(mfile['id']))
+            return DownloadResult.NO_URL
+
+        file_name = self._get_file_name(url_list, destination)
+
+        # Spread the files across the destinations
+        if self.placement is not None:
+            destination = self.placement.place(mfile, os.path.basename(file_name))
+            file_name = self._get_file_name(url_list, destination)
+
+        result.path = file_name
+
+        # Entries whose URLs share a file name would write the same partial
+        # file, so they are downloaded one after the other
+        self._lock_path(file_name)
+
+        try:
+            return self._fetch_file(mfile, file_name, url_list, destination, result)
+        finally:
+            self._unlock_path(file_name)
+
+    # Wait until no other download is using the path, and take it.
+    # Arguments:
+    # path = the path of the file to download
+    def _lock_path(self, path):
+        with self._path_locks_lock:
+            lock, users = self._path_locks.get(path, (None, 0))
+
+            if lock is None:
+                lock = threading.Lock()
 
-            # Only need to download if the file is not present
-            if os.path.exists(file_name):
+            self._path_locks[path] = (lock, users + 1)
+
+        lock.acquire()
+
+    # Release a path taken with _lock_path.
+    # Arguments:
+    # path = the path of the downloaded file
+    def _unlock_path(self, path):
+        with self._path_locks_lock:
+            lock, users = self._path_locks[path]
+
+            if users == 1:
+                del self._path_locks[path]
+            else:
+                self._path_locks[path] = (lock, users - 1)
+
+        lock.release()
+
+    # Download a manifest entry to its path, unless a valid file is already
+    # there, and return its failure code (see download_manifest).
+    # Arguments:
+    # mfile = the manifest entry
+    # file_name = the path of the file
+    # url_list = the prioritized URLs of the entry
+    # destination = the destination directory of the file
+    # result = the DownloadResult of the entry
+    def _fetch_file(self, mfile, file_name, url_list, destination, result):
+        # Only need to download if the file is not present (and intact)
+        if os.path.exists(file_name):
+            if self._existing_file_matches(file_name, mfile['md5'], destination):
                 self.logger.info("File %s already exists. Skipping.", file_name)
-                failed_files.append(0)
+                return DownloadResult.SUCCESS
+
+            print("Existing file {0} failed the MD5 check. Downloading it again."
+                  .format(file_name))
+        else:
+            self.logger.debug("File not present. Proceeding.")
+
+        tmp_file_name = "{0}.partial".format(file_name)
+
+        # Bytes retrieved by an earlier attempt don't count towards this one
+        initial_bytes = partial_bytes(tmp_file_name)
+
+        res, endpoint = ("" for i in range(2))
+        endpoints = []
+
+        # Whether a server's checksum of the file didn't match the manifest
+        checksum_failed = False
+
+        # Files the peers have verified are fetched from them before the WAN
+        peer_urls = []
+        if mfile['md5']:
+            peer_urls = [peer_url(peer, mfile['md5']) for peer in self.peers]
+
+        for url in peer_urls + url_list:
+            if self._cancelled.is_set():
+                return DownloadResult.CANCELLED
+
+            if url in peer_urls:
+                endpoint = "PEER"
+            else:
+                endpoint = url.split(':')[0].upper()
+            endpoints.append(endpoint)
+
+            # Route around hosts that keep failing
+            if not self.host_health.allow(url):
+                self.logger.info("Skipping %s, as its host is failing.", url)
+                res = "error"
+                continue
+
+            # Allows the S3 and GCP clients to validate the transfer with the
+            # server's checksum of the object
+            md5 = mfile['md5'] if self.validation else None
+
+            if endpoint == "PEER":
+                res = self._get_peer_obj(url, tmp_file_name)
+            elif endpoint == "FASP":
+                res = self._get_fasp_obj(url, tmp_file_name)
+            elif endpoint == "GS":
+                res = self._get_gcp_obj(url, tmp_file_name, md5)
+            elif endpoint == "HTTP" or endpoint == "HTTPS":
+                res = self._get_http_obj(url, tmp_file_name)
+            elif endpoint == "FTP":
+                res = self._get_ftp_obj(url, tmp_file_name)
+            elif endpoint == "S3":
+                res = self._get_s3_obj(url, tmp_file_name, md5)
             else:
-                self.logger.debug("File not present. Proceeding.")
-
-                tmp_file_name = "{0}.partial".format(file_name)
-
-                res, endpoint = ("" for i in range(2))
-                endpoints = []
-
-                for url in url_list:
-                    endpoint = url.split(':')[0].upper()
-                    endpoints.append(endpoint)
-
-                    if endpoint == "FASP":
-                        res = self._get_fasp_obj(url, tmp_file_name)
-                    elif endpoint == "GS":
-                        res = self._get_gcp_obj(url, tmp_file_name)
-                    elif endpoint == "HTTP" or endpoint == "HTTPS":
-                        res = self._get_http_obj(url, tmp_file_name)
-                    elif endpoint == "FTP":
-                        res = self._get_ftp_obj(url, tmp_file_name)
-                    elif endpoint == "S3":
-                        res = self._get_s3_obj(url, tmp_file_name)
-                    else:
-                        res = "error"
-
-                    # If we get an error, continue to the next url in the list
-                    if res == "error":
-                        continue
-
-                # If all attempts resulted in error, move on to next file
-                if res == "error":
-                    print("Skipping file ID {0} as none of the URLs {1} succeeded."
-                          .format(mfile['id'], endpoints))
-                    failed_files.append(2)
+                res = "error"
+
+            # Another URL may have an intact copy of the file
+            if res == "mismatch":
+                checksum_failed = True
+                res = "error"
+
+            # If we get an error, continue to the next url in the list
+            if res != "error":
+                self.host_health.record_success(url)
+                result.endpoint = endpoint
+                result.url = url
+                break
+
+            if self.metrics is not None:
+                self.metrics.url_failed(endpoint)
+
+        if os.path.exists(tmp_file_name):
+            result.bytes = max(partial_bytes(tmp_file_name) - initial_bytes, 0)
+
+        if self._cancelled.is_set():
+            return DownloadResult.CANCELLED
+
+        # If all attempts resulted in error, move on to next file
+        if res == "error" and checksum_failed:
+            print("MD5 check failed for the file ID {0} on the server. "
+                  "Data may be corrupted.".format(mfile['id']))
+            return DownloadResult.CHECKSUM_FAILED
+
+        if res == "error":
+            print("Skipping file ID {0} as none of the URLs {1} succeeded."
+                  .format(mfile['id'], endpoints))
+            return DownloadResult.UNREACHABLE
+
+        if res == "validated":
+            self.logger.debug("Validated with the server's checksum. Renaming %s to %s",
+                              tmp_file_name, file_name)
+            self._move_into_place(tmp_file_name, file_name)
+            self._record_verified(file_name, mfile['md5'], destination)
+            self._post_process(file_name, mfile['id'])
+            return DownloadResult.SUCCESS
+
+        if self.validation:
+            # Now that the download is complete, verify the checksum,
+            # and then establish the final file
+            if self._checksum_matches(tmp_file_name, mfile['md5']):
+                self.logger.debug("Renaming %s to %s", tmp_file_name, file_name)
+                self._move_into_place(tmp_file_name, file_name)
+                self._record_verified(file_name, mfile['md5'], destination)
+                self._post_process(file_name, mfile['id'])
+                return DownloadResult.SUCCESS
+
+            print("\r")
+            msg = "MD5 check failed for the file ID {0}. " + \
+                  "Data may be corrupted."
+            print(msg.format(mfile['id']))
+            return DownloadResult.CHECKSUM_FAILED
+
+        self.logger.debug(
+            "Skipping checksumming. Renaming %s to %s", tmp_file_name, file_name
+        )
+        self._move_into_place(tmp_file_name, file_name)
+        self._post_process(file_name, mfile['id'])
+
+        return DownloadResult.SUCCESS
+
+    # Move a completed download to its final name, and remove the sidecar
+    # files the protocol clients keep next to partial downloads.
+    # Arguments:
+    # tmp_file_name = the partial file
+    # file_name = the final name of the file
+    def _move_into_place(self, tmp_file_name, file_name):
+        shutil.move(tmp_file_name, file_name)
+
+        for suffix in PARTIAL_SIDECARS:
+            try:
+                os.remove(tmp_file_name + suffix)
+            except FileNotFoundError:
+                pass
+
+    def stream_manifest(self, manifest, priorities, sink_factory, workers=1,
+                        max_pending=16):
+        """
+        Streams each file of the manifest into a sink (see streaming.py)
+        instead of saving it in a destination directory.
+        Arguments:
+        manifest = manifest list
+        priorities = the protocol priorities
+        sink_factory = callable that returns the sink for a manifest entry
+        workers = the number of files to stream concurrently
+        max_pending = the number of blocks buffered for a sink
+        Returns a list of failure codes (see download_manifest), in manifest
+        order. A sink failing to process a file is reported with the code 5.
+        """
+        self.logger.debug("In stream_manifest.")
+
+        def stream(mfile):
+            return self.stream_manifest_file(
+                mfile, priorities, sink_factory, max_pending=max_pending
+            ).status
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(stream, manifest))
+
+    def stream_manifest_file(self, mfile, priorities, sink_factory, max_pending=16):
+        """
+        Streams a single manifest entry into the sink returned by
+        sink_factory(mfile), hashing the data on the way. Returns a
+        DownloadResult. The file is reported as failed if its checksum does
+        not match once all of it has been passed to the sink.
+        """
+        self.logger.debug("In stream_manifest_file: %s", mfile['id'])
+
+        result = DownloadResult(mfile['id'])
+        start = time.time()
+
+        if self.metrics is not None:
+            self.metrics.file_started(mfile['id'])
+
+        try:
+            result.status = self._stream_manifest_file(
+                mfile, priorities, sink_factory, max_pending, result
+            )
+        finally:
+            result.duration = time.time() - start
+
+            if self.metrics is not None:
+                self.metrics.file_finished(result)
+
+        return result
+
+    def _stream_manifest_file(self, mfile, priorities, sink_factory, max_pending, result):
+        url_list = self._get_prioritized_endpoint(mfile['urls'], priorities)
+
+        if not url_list:
+            print("No valid URL found in the manifest for file ID {0}".format(mfile['id']))
+            return DownloadResult.NO_URL
+
+        sink = None
+        endpoints = []
+
+        for url in url_list:
+            if self._cancelled.is_set():
+                break
+
+            endpoint = url.split(':')[0].upper()
+            endpoints.append(endpoint)
+
+            client = self._get_stream_client(endpoint)
+
+            if client is None:
+                self.logger.warning("Streaming is not supported for %s urls.", endpoint)
+                continue
+
+            if sink is None:
+                sink = sink_factory(mfile)
+
+            md5 = hashlib.md5()
+
+            def consume(data):
+                md5.update(data)
+                sink.write(data)
+
+            writer = BoundedWriter(consume, max_pending=max_pending)
+
+            try:
+                client.stream_file(url, writer)
+                writer.close()
+            except Exception as e:
+                self.logger.error(e)
+
+                try:
+                    writer.close()
+                except Exception:
+                    pass
+
+                # Once the sink has been given data, it can't start over with
+                # another url.
+                if writer.bytes_written == 0:
                     continue
 
-                if self.validation:
-                    # Now that the download is complete, verify the checksum,
-                    # and then establish the final file
-                    if self._checksum_matches(tmp_file_name, mfile['md5']):
-                        self.logger.debug("Renaming %s to %s", tmp_file_name, file_name)
-                        shutil.move(tmp_file_name, file_name)
-                        failed_files.append(0)
-                    else:
-                        print("\r")
-                        msg = "MD5 check failed for the file ID {0}. " + \
-                              "Data may be corrupted."
-                        print(msg.format(mfile['id']))
-                        failed_files.append(3)
+                print("Streaming of file ID {0} failed: {1}".format(mfile['id'], e))
+                sink.finish(False)
+                result.bytes = writer.bytes_written
+
+                if writer.error is not None:
+                    return DownloadResult.SINK_FAILED
+
+                if self._cancelled.is_set():
+                    return DownloadResult.CANCELLED
+
+                return DownloadResult.UNREACHABLE
+
+            result.endpoint = endpoint
+            result.url = url
+            result.bytes = writer.bytes_written
+
+            valid = not self.validation or md5.hexdigest() == mfile['md5']
+
+            if not valid:
+                msg = "MD5 check failed for the file ID {0}. " + \
+                      "Data may be corrupted."
+                print(msg.format(mfile['id']))
+
+            if not sink.finish(valid):
+                if valid:
+                    print("Processing of file ID {0} failed.".format(mfile['id']))
+                    return DownloadResult.SINK_FAILED
+
+                return DownloadResult.CHECKSUM_FAILED
+
+            return DownloadResult.SUCCESS
+
+        if sink is not None:
+            sink.finish(False)
+
+        if self._cancelled.is_set():
+            return DownloadResult.CANCELLED
+
+        print("Skipping file ID {0} as none of the URLs {1} succeeded."
+              .format(mfile['id'], endpoints))
+
+        return DownloadResult.UNREACHABLE
+
+    def upload_manifest(self, manifest, store, priorities, workers=1, max_pending=16):
+        """
+        Stores each file of the manifest in an object store (see
+        object_store.py) instead of a destination directory. Files already
+        in the store are skipped, files that the store can copy itself are
+        copied server-side, and the others are streamed into the store.
+        Arguments:
+        manifest = manifest list
+        store = the S3Store or GCSStore to store the files in
+        priorities = the protocol priorities
+        workers = the number of files to store concurrently
+        max_pending = the number of blocks buffered for an upload
+        Returns a list of failure codes (see download_manifest), in manifest
+        order. A failure to upload a file is reported with the code 5.
+        """
+        self.logger.debug("In upload_manifest.")
+
+        def upload(mfile):
+            return self.upload_manifest_file(
+                mfile, store, priorities, max_pending=max_pending
+            ).status
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(upload, manifest))
+
+    def upload_manifest_file(self, mfile, store, priorities, max_pending=16):
+        """
+        Stores a single manifest entry in an object store, returning a
+        DownloadResult.
+        """
+        self.logger.debug("In upload_manifest_file: %s", mfile['id'])
+
+        url_list = self._get_prioritized_endpoint(mfile['urls'], priorities)
+
+        if not url_list:
+            print("No valid URL found in the manifest for file ID {0}".format(mfile['id']))
+            return DownloadResult(mfile['id'], status=DownloadResult.NO_URL)
+
+        # Named after the file of the highest priority url, as in a directory
+        name = url_list[0].split('/')[-1]
+        md5 = mfile['md5'] if self.validation else None
+
+        result = self._copy_manifest_file(mfile, store, name, md5, url_list)
+
+        if result is not None:
+            return result
+
+        def sink_factory(mfile):
+            return store.sink(name, md5)
+
+        return self.stream_manifest_file(mfile, priorities, sink_factory,
+                                         max_pending=max_pending)
+
+    # Skip a file already in the store, or have the store copy it from one of
+    # its urls. Returns a DownloadResult (with the code 5 if the store can't
+    # be queried, or 3 if the checksum of a source object doesn't match), or
+    # None if the file must be streamed into the store.
+    # Arguments:
+    # mfile = the manifest entry
+    # store = the object store
+    # name = the name the file is stored under
+    # md5 = the checksum to validate the file with, or None
+    # url_list = the prioritized urls of the manifest entry
+    def _copy_manifest_file(self, mfile, store, name, md5, url_list):
+        result = DownloadResult(mfile['id'], path=store.url(name))
+
+        # Such as a bucket this client isn't allowed to read
+        try:
+            exists = store.has_object(name, md5)
+        except Exception as e:
+            self.logger.error("Unable to look up %s: %s", result.path, e)
+            result.status = DownloadResult.SINK_FAILED
+            return result
+
+        if exists:
+            self.logger.info("%s already exists. Skipping.", result.path)
+            result.status = DownloadResult.SUCCESS
+            return result
+
+        # Whether the checksum of a source object didn't match the manifest
+        checksum_failed = False
+
+        for url in url_list:
+            if self._cancelled.is_set() or not store.can_copy(url):
+                continue
+
+            if not self.host_health.allow(url):
+                continue
+
+            start = time.time()
+
+            try:
+                copied = store.copy(url, name, md5)
+            except ChecksumMismatch as e:
+                # Known from the source's metadata, before any data is moved
+                self.logger.error(e)
+                checksum_failed = True
+                continue
+            except Exception as e:
+                self._download_failed(url, e)
+                continue
+
+            self.host_health.record_success(url)
+
+            if not copied:
+                continue
+
+            result.endpoint = url.split(':')[0].upper()
+            result.url = url
+            result.duration = time.time() - start
+            result.status = DownloadResult.SUCCESS
+
+            # Nothing was transferred through the client
+            if self.metrics is not None:
+                self.metrics.file_started(mfile['id'])
+                self.metrics.file_finished(result)
+
+            return result
+
+        # Rather than streaming an object already known to be corrupted
+        if checksum_failed:
+            print("MD5 check failed for the file ID {0} on the server. "
+                  "Data may be corrupted.".format(mfile['id']))
+            result.status = DownloadResult.CHECKSUM_FAILED
+            return result
+
+        return None
+
+    # Function to get the client able to stream urls of an endpoint, or None
+    # if the endpoint can't be streamed (FASP).
+    # Arguments:
+    # endpoint = the endpoint (protocol) of the url
+    def _get_stream_client(self, endpoint):
+        if endpoint == "HTTP" or endpoint == "HTTPS":
+            return self.http_client
+        if endpoint == "FTP":
+            return self.ftp_client
+        if endpoint == "S3":
+            return self.aws_s3
+        if endpoint == "GS":
+            return self.gcp_client
+
+        return None
+
+    def cancel(self):
+        """
+        Cancel the downloads in progress. Transfers are interrupted at their
+        next block, and their partial files are kept so that a later run can
+        resume them.
+        """
+        self.logger.debug("In cancel.")
+
+        self._cancelled.set()
+
+    def _transfer_progress(self, nbytes, endpoint=None):
+        """
+        Called by the protocol clients whenever a block of data has been
+        transferred.
+        """
+        if self.metrics is not None and endpoint is not None:
+            self.metrics.transferred(endpoint, nbytes)
+
+        if self._cancelled.is_set():
+            raise DownloadCancelled("Download cancelled.")
+
+    def plan_manifest(self, manifest, destination, priorities, workers=16):
+        """
+        Determines, without downloading any data, what a download of the
+        manifest would involve. The remote size of each file is probed
+        concurrently using the clients for the prioritized endpoints.
+        Returns a list with one dictionary per manifest entry (in manifest
+        order) with the keys: id, path, status, endpoint, url, size and
+        partial. The status is one of 'ok', 'present' (already downloaded),
+        'no_url' or 'unreachable'.
+        Arguments:
+        manifest = manifest list
+        destination = the destination directory to save downloaded files
+        priorities = the protocol priorities
+        workers = the number of concurrent metadata probes
+        """
+        self.logger.debug("In plan_manifest.")
+
+        def probe(mfile):
+            return self._probe_file(mfile, destination, priorities)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(probe, manifest))
+
+    def _probe_file(self, mfile, destination, priorities):
+        self.logger.debug("In _probe_file: %s", mfile['id'])
+
+        probe = {
+            'id': mfile['id'],
+            'path': None,
+            'status': 'no_url',
+            'endpoint': None,
+            'url': None,
+            'size': None,
+            'partial': 0
+        }
+
+        url_list = self._get_prioritized_endpoint(mfile['urls'], priorities)
+
+        if not url_list:
+            return probe
+
+        file_name = self._get_file_name(url_list, self._placed_destination(mfile, destination))
+        probe['path'] = file_name
+
+        if os.path.exists(file_name):
+            probe['status'] = 'present'
+            return probe
+
+        # Bytes already retrieved by an earlier run won't be transferred again.
+        probe['partial'] = partial_bytes("{0}.partial".format(file_name))
+
+        for url in url_list:
+            try:
+                size = self._get_file_size(url)
+            except Exception as e:
+                self.logger.debug("Unable to probe %s: %s", url, e)
+                continue
+
+            probe['status'] = 'ok'
+            probe['endpoint'] = url.split(':')[0].upper()
+            probe['url'] = url
+            # Fall back to the manifest's size for endpoints that can't be probed
+            probe['size'] = size if size is not None else mfile.get('size')
+
+            return probe
+
+        probe['status'] = 'unreachable'
+
+        return probe
+
+    # Function to get the size of a remote file with the client for the
+    # protocol of the url. Returns None for FASP urls, as sizes of those
+    # can't be determined without ascp.
+    # Arguments:
+    # url = the url of the remote file
+    def _get_file_size(self, url):
+        self.logger.debug("In _get_file_size: %s", url)
+
+        endpoint = url.split(':')[0].upper()
+
+        if endpoint == "HTTP" or endpoint == "HTTPS":
+            size = self.http_client._get_file_size(url)
+        elif endpoint == "FTP":
+            size = self.ftp_client._get_file_size(url)
+        elif endpoint == "S3":
+            size = self.aws_s3._get_file_size(url)
+        elif endpoint == "GS":
+            if self.gcp_client is None:
+                raise Exception("GCP client is not configured.")
+            size = self.gcp_client._get_file_size(url)
+        elif endpoint == "FASP":
+            size = None
+        else:
+            raise Exception("Unsupported protocol: {}".format(endpoint))
+
+        return size
+
+    def verify_manifest(self, manifest, destination, priorities, workers=None):
+        """
+        Checks the files of the manifest that are already in the destination
+        against the MD5 checksums in the manifest, without downloading
+        anything. The files are checksummed concurrently in a pool of worker
+        processes. Returns a list of (manifest entry, status) tuples in
+        manifest order, where status is one of 'ok', 'mismatch', 'missing'
+        or 'no_url'.
+        Arguments:
+        manifest = manifest list
+        destination = the destination directory holding the downloaded files
+        priorities = the protocol priorities
+        workers = the number of worker processes (defaults to the number of CPUs)
+        """
+        self.logger.debug("In verify_manifest.")
+
+        manifest = list(manifest)
+        entries = []
+        statuses = {}
+
+        for index, mfile in enumerate(manifest):
+            url_list = self._get_prioritized_endpoint(mfile['urls'], priorities)
+
+            if not url_list:
+                statuses[index] = 'no_url'
+            else:
+                file_name = self._get_file_name(
+                    url_list, self._placed_destination(mfile, destination)
+                )
+                entries.append((index, (file_name, mfile['md5'])))
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(verify_file, [entry[1] for entry in entries])
+
+            for (index, (file_name, md5)), status in zip(entries, results):
+                statuses[index] = status
+
+                # Later runs can then trust the files without checksumming
+                # them, and must no longer trust those that failed
+                if status == 'ok':
+                    self._record_verified(file_name, md5, os.path.dirname(file_name))
                 else:
-                    self.logger.debug(
-                        "Skipping checksumming. Renaming %s to %s", tmp_file_name, file_name
-                    )
-                    shutil.move(tmp_file_name, file_name)
-                    failed_files.append(0)
+                    self._forget_verified(file_name, os.path.dirname(file_name))
 
-        return failed_files
+        return [(mfile, statuses[index]) for index, mfile in enumerate(manifest)]
+
+    def _get_stat_cache(self, destination):
+        """
+        Return the index of verified files for the destination, or None if
+        the index can't be used (for instance, if the destination isn't
+        writable).
+        """
+        with self._stat_caches_lock:
+            if destination not in self._stat_caches:
+                import sqlite3
+                from stat_cache import StatCache
+
+                try:
+                    self._stat_caches[destination] = StatCache(destination)
+                except sqlite3.Error as e:
+                    self.logger.warning("Unable to use the index of verified " + \
+                                        "files in %s: %s", destination, e)
+                    self._stat_caches[destination] = None
+
+            return self._stat_caches[destination]
+
+    # Function to determine if a file that is already in the destination is
+    # intact. Files that were verified earlier and haven't changed since are
+    # trusted, others are checksummed (and recorded if they match). Without
+    # validation, the presence of the file is enough.
+    # Arguments:
+    # file_name = the path of the file in the destination
+    # original_md5 = the MD5 checksum from the manifest
+    # destination = the destination directory
+    def _existing_file_matches(self, file_name, original_md5, destination):
+        self.logger.debug("In _existing_file_matches: %s", file_name)
+
+        if not self.validation:
+            return True
+
+        stat_cache = self._get_stat_cache(destination)
+
+        if stat_cache is not None and stat_cache.is_verified(file_name, original_md5):
+            return True
+
+        if self._checksum_matches(file_name, original_md5):
+            self._record_verified(file_name, original_md5, destination)
+            return True
+
+        self._forget_verified(file_name, destination)
+
+        return False
+
+    def _record_verified(self, file_name, original_md5, destination):
+        stat_cache = self._get_stat_cache(destination)
+
+        if stat_cache is not None:
+            stat_cache.record(file_name, original_md5)
+
+    def _forget_verified(self, file_name, destination):
+        stat_cache = self._get_stat_cache(destination)
+
+        if stat_cache is not None:
+            stat_cache.forget(file_name)
+
+    # Function to determine the local path a manifest entry is saved to,
+    # which is named after the file of the highest priority url.
+    # Arguments:
+    # url_list = the prioritized urls of the manifest entry
+    # destination = the destination directory
+    def _get_file_name(self, url_list, destination):
+        url_file_element = url_list[0].split('/')[-1]
+
+        return os.path.join(destination, url_file_element)
 
     # Function to get the URL for the prioritized endpoint that the user requests.
     # Note that priorities can be a list of ordered priorities.
@@ -276,14 +1549,18 @@ class ManifestProcessor(object):
         # If the user didn't provide a set of priorities, then prioritize based on
         # whether on an EC2 instance.
         if eps[0] == "":
+            if self._default_priorities is None:
+                from boto.utils import get_instance_metadata
 
-            md = get_instance_metadata(timeout=0.5, num_retries=1)
+                md = get_instance_metadata(timeout=0.5, num_retries=1)
 
-            if md:
-                eps = ['S3', 'HTTP', 'FTP']
-            else:
-                # If none provided, use this order
-                eps = ['HTTP', 'FTP', 'S3']
+                if md:
+                    self._default_priorities = ['S3', 'HTTP', 'FTP']
+                else:
+                    # If none provided, use this order
+                    self._default_priorities = ['HTTP', 'FTP', 'S3']
+
+            eps = self._default_priorities
 
         # Go through and build a list starting with the higher priorities first.
         for ep in eps:
@@ -300,15 +1577,9 @@ class ManifestProcessor(object):
     # original_md5 = MD5 provided by OSDF data
     def _checksum_matches(self, file_path, original_md5):
         self.logger.debug("In checksum_matches. Checking %s.", file_path)
-        md5 = hashlib.md5()
-
-        # Read the file in chunks and build a final MD5
-        with open(file_path, 'rb') as filehandle:
-            for chunk in iter(lambda: filehandle.read(4096), b""):
-                md5.update(chunk)
 
         valid = False
-        if md5.hexdigest() == original_md5:
+        if file_md5(file_path) == original_md5:
             valid = True
 
         self.logger.debug("Checksum valid? %s", str(valid))
@@ -0,0 +1,277 @@
+"""
+Metrics of a run, for monitoring long transfers with Prometheus. The metrics
+can be served over HTTP by a MetricsServer (scraped by Prometheus directly),
+or written periodically to a file by a TextfileWriter, for the textfile
+collector of the node exporter. Both use the Prometheus text format.
+
+The metrics are:
+
+- portal_client_transferred_bytes_total{endpoint}: bytes received.
+- portal_client_active_transfers: files being downloaded right now.
+- portal_client_files_total{code}: files finished, by failure code (see
+  ManifestProcessor.download_manifest; 0 is success).
+- portal_client_transfer_seconds_total{endpoint} and
+  portal_client_transfer_files_total{endpoint}: time spent on, and number
+  of, the completed transfers of each endpoint, from which the throughput
+  of an endpoint can be computed.
+- portal_client_endpoint_throughput_bytes_per_second{endpoint}: the average
+  throughput of the completed transfers of each endpoint.
+- portal_client_url_failures_total{endpoint}: attempts that failed and fell
+  back to the next URL of the file.
+- portal_client_retries_total: downloads of files that had already been
+  attempted in the run.
+
+HTTPS transfers are counted under the HTTP endpoint.
+"""
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+def _endpoint_label(endpoint):
+    return 'HTTP' if endpoint == 'HTTPS' else endpoint
+
+class Metrics(object):
+    """
+    The Metrics class holds the counters of a run. It is safe to use from
+    several threads.
+    """
+    def __init__(self):
+        """
+        Constructor for the Metrics class.
+        """
+        self._lock = threading.Lock()
+
+        self._bytes = {}
+        self._active = 0
+        self._files = {}
+        self._transfer_seconds = {}
+        self._transfer_files = {}
+        self._transfer_bytes = {}
+        self._url_failures = {}
+        self._retries = 0
+
+        # The ids of the files attempted so far, to count the retries
+        self._attempted = set()
+
+        self.started = time.time()
+
+    def transferred(self, endpoint, nbytes):
+        """
+        Count bytes received from an endpoint.
+        """
+        with self._lock:
+            self._bytes[endpoint] = self._bytes.get(endpoint, 0) + nbytes
+
+    def file_started(self, manifest_id):
+        """
+        Count the start of the download of a file.
+        """
+        with self._lock:
+            self._active += 1
+
+            if manifest_id in self._attempted:
+                self._retries += 1
+            else:
+                self._attempted.add(manifest_id)
+
+    def file_finished(self, result):
+        """
+        Count the end of the download of a file, from its DownloadResult.
+        """
+        with self._lock:
+            self._active -= 1
+
+            code = str(result.status)
+            self._files[code] = self._files.get(code, 0) + 1
+
+            # Only files that were transferred say anything about throughput
+            if result.endpoint is not None and result.bytes:
+                endpoint = _endpoint_label(result.endpoint)
+
+                self._transfer_seconds[endpoint] = \
+                    self._transfer_seconds.get(endpoint, 0.0) + result.duration
+                self._transfer_files[endpoint] = self._transfer_files.get(endpoint, 0) + 1
+                self._transfer_bytes[endpoint] = \
+                    self._transfer_bytes.get(endpoint, 0) + result.bytes
+
+    def url_failed(self, endpoint):
+        """
+        Count an attempt to download a file from a URL that failed.
+        """
+        endpoint = _endpoint_label(endpoint)
+
+        with self._lock:
+            self._url_failures[endpoint] = self._url_failures.get(endpoint, 0) + 1
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format.
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+
+            for labels, value in samples:
+                if labels:
+                    label_text = ",".join(
+                        '{0}="{1}"'.format(key, str(val).replace('\\', '\\\\').replace('"', '\\"'))
+                        for key, val in sorted(labels.items())
+                    )
+                    lines.append("{0}{{{1}}} {2}".format(name, label_text, value))
+                else:
+                    lines.append("{0} {1}".format(name, value))
+
+        with self._lock:
+            metric("portal_client_transferred_bytes_total", "counter",
+                   "Bytes received, by endpoint.",
+                   [({'endpoint': key}, value) for key, value in sorted(self._bytes.items())])
+
+            metric("portal_client_active_transfers", "gauge",
+                   "Files being downloaded.", [({}, self._active)])
+
+            metric("portal_client_files_total", "counter",
+                   "Files finished, by failure code (0 is success).",
+                   [({'code': key}, value) for key, value in sorted(self._files.items())])
+
+            metric("portal_client_transfer_seconds_total", "counter",
+                   "Time spent on completed transfers, by endpoint.",
+                   [({'endpoint': key}, "{:.3f}".format(value))
+                    for key, value in sorted(self._transfer_seconds.items())])
+
+            metric("portal_client_transfer_files_total", "counter",
+                   "Completed transfers, by endpoint.",
+                   [({'endpoint': key}, value)
+                    for key, value in sorted(self._transfer_files.items())])
+
+            metric("portal_client_endpoint_throughput_bytes_per_second", "gauge",
+                   "Average throughput of the completed transfers, by endpoint.",
+                   [({'endpoint': key},
+                     "{:.1f}".format(value / self._transfer_seconds[key]
+                                     if self._transfer_seconds[key] else 0.0))
+                    for key, value in sorted(self._transfer_bytes.items())])
+
+            metric("portal_client_url_failures_total", "counter",
+                   "Download attempts that failed over to the next URL, by endpoint.",
+                   [({'endpoint': key}, value)
+                    for key, value in sorted(self._url_failures.items())])
+
+            metric("portal_client_retries_total", "counter",
+                   "Downloads of files that had already been attempted.",
+                   [({}, self._retries)])
+
+            metric("portal_client_start_time_seconds", "gauge",
+                   "When the run started, in seconds since the epoch.",
+                   [({}, "{:.0f}".format(self.started))])
+
+        return "\n".join(lines) + "\n"
+
+class MetricsServer(object):
+    """
+    The MetricsServer class serves the metrics over HTTP, at /metrics, from a
+    background thread.
+    """
+    def __init__(self, metrics, port, address='127.0.0.1'):
+        """
+        Constructor for the MetricsServer class. The server starts at once.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+
+        self.logger.info("Serving metrics on %s:%s.", address, self.port)
+
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def close(self):
+        """
+        Stop serving the metrics.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+class TextfileWriter(object):
+    """
+    The TextfileWriter class rewrites a file with the metrics every interval
+    seconds, from a background thread. The file is replaced atomically, so
+    that the node exporter never reads a partly written file.
+    """
+    def __init__(self, metrics, path, interval=15):
+        """
+        Constructor for the TextfileWriter class. The writes start at once.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self._metrics = metrics
+
+        self.path = path
+
+        self.interval = interval
+
+        self._stop = threading.Event()
+
+        self.write()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                self.logger.error("Unable to write the metrics to %s: %s", self.path, e)
+
+    def write(self):
+        """
+        Write the metrics to the file now.
+        """
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+
+        with open(tmp_path, 'w') as textfile:
+            textfile.write(self._metrics.render())
+
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        """
+        Stop the periodic writes, writing the final values of the metrics.
+        """
+        self._stop.set()
+        self._thread.join()
+
+        self.write()
@@ -0,0 +1,408 @@
+"""
+Object stores (S3 buckets, or Google Storage buckets) as destinations, given
+as s3://bucket/prefix or gs://bucket/prefix. Each file of the manifest is
+stored as an object named after the file, under the prefix.
+
+Files whose source is in the same kind of store are copied by the store
+itself (server-side), so that their data never goes through the client.
+Other files are streamed from their source into the store, in a multipart
+(or resumable) upload, without being staged on a local disk. Either way, the
+file is only created if it is valid: a copy only happens if the checksum the
+source store holds for the object matches the manifest, and an upload is
+only completed once the data streamed matched the manifest's checksum.
+"""
+
+import base64
+import io
+import logging
+
+from checksum import ChecksumMismatch
+
+logger = logging.getLogger(__name__)
+
+SCHEMES = ('s3', 'gs')
+
+# The size of the parts of the uploads (S3 parts must be at least 5 MB)
+PART_SIZE = 16 * 1024 * 1024
+
+# S3 copies larger than this must be done in parts
+COPY_LIMIT = 5 * 1024 * 1024 * 1024
+
+# The size of the parts of a multipart S3 copy
+COPY_PART_SIZE = 512 * 1024 * 1024
+
+# The metadata entry holding the MD5 checksum of an object whose ETag isn't
+# its checksum (objects uploaded in several parts)
+MD5_METADATA = 'md5'
+
+def is_store_uri(destination):
+    """
+    Whether the destination is an object store URI rather than a directory.
+    """
+    return destination.split('://', 1)[0].lower() in SCHEMES and '://' in destination
+
+def parse_store_uri(uri):
+    """
+    Split an s3:// or gs:// URI into its scheme, bucket name and key (the
+    rest of the path, without a leading '/').
+    """
+    scheme, sep, rest = uri.partition('://')
+
+    if not sep or scheme.lower() not in SCHEMES:
+        raise ValueError("Invalid object store URI {}. Must start with s3:// or gs://."
+                         .format(uri))
+
+    bucket_name, _, key = rest.partition('/')
+
+    if not bucket_name:
+        raise ValueError("Invalid object store URI {}. No bucket given.".format(uri))
+
+    return scheme.lower(), bucket_name, key
+
+def open_store(uri, endpoint_url=None, gcp=None):
+    """
+    Return the store for a destination URI. S3 stores connect to
+    endpoint_url (an S3-compatible service) if given; Google Storage stores
+    need a GCP client (see gcp.py) authorized to write.
+    """
+    scheme, _, _ = parse_store_uri(uri)
+
+    if scheme == 's3':
+        return S3Store(uri, endpoint_url=endpoint_url)
+
+    if gcp is None:
+        raise ValueError("Google Storage destinations require the GCP credentials.")
+
+    return GCSStore(uri, gcp.get_client())
+
+class _Store(object):
+    """
+    What the stores have in common: the naming of the objects.
+    """
+    def __init__(self, uri):
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self.uri = uri
+
+        _, self.bucket_name, prefix = parse_store_uri(uri)
+
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+
+        self.prefix = prefix
+
+    def object_name(self, name):
+        """
+        Return the name of the object a file is stored as.
+        """
+        return self.prefix + name
+
+    def url(self, name):
+        """
+        Return the URI of the object a file is stored as.
+        """
+        return "{0}://{1}/{2}".format(self.scheme, self.bucket_name, self.object_name(name))
+
+    def can_copy(self, url):
+        """
+        Whether the object at the URL can be copied by the store itself.
+        """
+        return url.lower().startswith(self.scheme + '://')
+
+class S3Store(_Store):
+    """
+    The S3Store class stores files in an S3 bucket (or a bucket of an
+    S3-compatible service), with the credentials boto is configured with.
+    """
+    scheme = 's3'
+
+    def __init__(self, uri, endpoint_url=None, part_size=PART_SIZE):
+        """
+        Constructor for the S3Store class.
+        """
+        super(S3Store, self).__init__(uri)
+
+        from s3 import connect
+
+        self.part_size = part_size
+
+        self.connection = connect(endpoint_url)
+
+        self.bucket = self.connection.get_bucket(self.bucket_name)
+
+    # Return the MD5 checksum of an object, from its ETag or its metadata,
+    # or None if it isn't known.
+    # Arguments:
+    # key = the boto key of the object
+    def _key_md5(self, key):
+        etag = (key.etag or '').strip('"')
+
+        if etag and '-' not in etag:
+            return etag.lower()
+
+        return key.get_metadata(MD5_METADATA)
+
+    def has_object(self, name, md5=None):
+        """
+        Whether the file is already stored, with the given MD5 checksum if
+        one is given.
+        """
+        key = self.bucket.get_key(self.object_name(name))
+
+        if key is None:
+            return False
+
+        return md5 is None or self._key_md5(key) == md5
+
+    def copy(self, url, name, md5=None):
+        """
+        Copy the object at an s3:// URL to the store, server-side. If md5 is
+        given, the object is only copied if its checksum is known and
+        matches; returns False if it isn't known (the file must then be
+        streamed to be validated), and raises ChecksumMismatch if it differs.
+        Returns True once the object is copied.
+        """
+        self.logger.debug("In copy: %s", url)
+
+        _, source_bucket, source_name = parse_store_uri(url)
+
+        key = self.connection.get_bucket(source_bucket, validate=False).get_key(source_name)
+
+        if key is None:
+            raise Exception("No such S3 object: {}".format(url))
+
+        source_md5 = self._key_md5(key)
+
+        if md5 is not None:
+            if source_md5 is None:
+                self.logger.info("The checksum of %s isn't known. Streaming it.", url)
+                return False
+
+            if source_md5 != md5:
+                raise ChecksumMismatch("The ETag of {0} ({1}) doesn't match the MD5 checksum {2}."
+                                       .format(url, source_md5, md5))
+
+        metadata = {MD5_METADATA: source_md5} if source_md5 else {}
+
+        print("Copying {0} to {1} | total bytes = {2}".format(url, self.url(name), key.size))
+
+        if key.size <= COPY_LIMIT:
+            self.bucket.copy_key(self.object_name(name), source_bucket, source_name,
+                                 metadata=metadata)
+            return True
+
+        upload = self.bucket.initiate_multipart_upload(self.object_name(name),
+                                                       metadata=metadata)
+
+        try:
+            for part, start in enumerate(range(0, key.size, COPY_PART_SIZE), 1):
+                end = min(start + COPY_PART_SIZE, key.size) - 1
+                upload.copy_part_from_key(source_bucket, source_name, part, start, end)
+
+            upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
+
+        return True
+
+    def sink(self, name, md5=None):
+        """
+        Return a sink (see streaming.py) that uploads a file to the store.
+        md5 is recorded with the object, for later runs to find it.
+        """
+        return S3UploadSink(self.bucket, self.object_name(name), md5, self.part_size)
+
+class S3UploadSink(object):
+    """
+    A sink that uploads a file to S3 in a multipart upload, which is only
+    completed if the file is valid. Files smaller than a part are uploaded
+    in a single request.
+    """
+    def __init__(self, bucket, object_name, md5=None, part_size=PART_SIZE):
+        """
+        Constructor for the S3UploadSink class.
+        """
+        self._bucket = bucket
+        self._object_name = object_name
+        self._metadata = {MD5_METADATA: md5} if md5 else {}
+        self._part_size = part_size
+
+        self._buffer = bytearray()
+        self._upload = None
+        self._parts = 0
+
+    def _upload_part(self, data):
+        if self._upload is None:
+            logger.debug("Starting the upload of %s.", self._object_name)
+            self._upload = self._bucket.initiate_multipart_upload(
+                self._object_name, metadata=self._metadata
+            )
+
+        self._parts += 1
+        self._upload.upload_part_from_file(io.BytesIO(data), self._parts, size=len(data))
+
+    def write(self, data):
+        self._buffer += data
+
+        while len(self._buffer) >= self._part_size:
+            self._upload_part(bytes(self._buffer[:self._part_size]))
+            del self._buffer[:self._part_size]
+
+    def finish(self, valid):
+        if not valid:
+            if self._upload is not None:
+                self._upload.cancel_upload()
+
+            return False
+
+        try:
+            if self._upload is None:
+                key = self._bucket.new_key(self._object_name)
+
+                for name, value in self._metadata.items():
+                    key.set_metadata(name, value)
+
+                key.set_contents_from_string(bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+
+                self._upload.complete_upload()
+        except Exception as e:
+            logger.error("Unable to upload %s: %s", self._object_name, e)
+
+            if self._upload is not None:
+                self._upload.cancel_upload()
+
+            return False
+
+        return True
+
+class GCSStore(_Store):
+    """
+    The GCSStore class stores files in a Google Storage bucket.
+    """
+    scheme = 'gs'
+
+    def __init__(self, uri, client, part_size=PART_SIZE):
+        """
+        Constructor for the GCSStore class. client is the storage client.
+        """
+        super(GCSStore, self).__init__(uri)
+
+        self.part_size = part_size
+
+        self.client = client
+
+        self.bucket = client.bucket(self.bucket_name)
+
+    # Return the MD5 checksum of a blob, or None if it isn't known (such as
+    # for composite objects).
+    # Arguments:
+    # blob = the blob, with its metadata loaded
+    def _blob_md5(self, blob):
+        if not blob.md5_hash:
+            return None
+
+        return base64.b64decode(blob.md5_hash).hex()
+
+    def has_object(self, name, md5=None):
+        """
+        Whether the file is already stored, with the given MD5 checksum if
+        one is given.
+        """
+        blob = self.bucket.get_blob(self.object_name(name))
+
+        if blob is None:
+            return False
+
+        return md5 is None or self._blob_md5(blob) == md5
+
+    def copy(self, url, name, md5=None):
+        """
+        Copy the object at a gs:// URL to the store, server-side. If md5 is
+        given, the object is only copied if its checksum is known and
+        matches; returns False if it isn't known (the file must then be
+        streamed to be validated), and raises ChecksumMismatch if it differs.
+        Returns True once the object is copied.
+        """
+        self.logger.debug("In copy: %s", url)
+
+        _, source_bucket, source_name = parse_store_uri(url)
+
+        source = self.client.bucket(source_bucket).get_blob(source_name)
+
+        if source is None:
+            raise Exception("No such object: {}".format(url))
+
+        if md5 is not None:
+            source_md5 = self._blob_md5(source)
+
+            if source_md5 is None:
+                self.logger.info("The checksum of %s isn't known. Streaming it.", url)
+                return False
+
+            if source_md5 != md5:
+                raise ChecksumMismatch("The MD5 checksum of {0} ({1}) doesn't match {2}."
+                                       .format(url, source_md5, md5))
+
+        print("Copying {0} to {1} | total bytes = {2}".format(url, self.url(name), source.size))
+
+        destination = self.bucket.blob(self.object_name(name))
+
+        # Large objects take several calls to copy
+        token, _, _ = destination.rewrite(source)
+
+        while token is not None:
+            token, _, _ = destination.rewrite(source, token=token)
+
+        return True
+
+    def sink(self, name, md5=None):
+        """
+        Return a sink (see streaming.py) that uploads a file to the store.
+        """
+        return GCSUploadSink(self.bucket.blob(self.object_name(name)), md5, self.part_size)
+
+class GCSUploadSink(object):
+    """
+    A sink that uploads a file to Google Storage in a resumable upload,
+    which is only completed if the file is valid. Google Storage also checks
+    the upload against the MD5 checksum, if one is given.
+    """
+    def __init__(self, blob, md5=None, part_size=PART_SIZE):
+        """
+        Constructor for the GCSUploadSink class.
+        """
+        if md5:
+            blob.md5_hash = base64.b64encode(bytes.fromhex(md5)).decode('ascii')
+
+        self._blob = blob
+        self._part_size = part_size
+        self._writer = None
+
+    def write(self, data):
+        if self._writer is None:
+            logger.debug("Starting the upload of %s.", self._blob.name)
+            self._writer = self._blob.open('wb', chunk_size=self._part_size)
+
+        self._writer.write(data)
+
+    def finish(self, valid):
+        # An upload that isn't completed never creates the object
+        if not valid:
+            return False
+
+        try:
+            if self._writer is None:
+                self._blob.upload_from_string(b'')
+            else:
+                self._writer.close()
+        except Exception as e:
+            logger.error("Unable to upload %s: %s", self._blob.name, e)
+            return False
+
+        return True
@@ -0,0 +1,268 @@
+"""
+Sharing of downloaded files between the nodes of a cluster. A node serves the
+verified files of its destination directory to its peers over HTTP, looked up
+by their MD5 checksums, so that a file already downloaded by one node doesn't
+have to be pulled across the WAN again by the others.
+
+A file is served at /md5/<md5 checksum> only while the index of verified
+files (see stat_cache.py) says it still has that checksum. The files are
+served with their MD5 checksum as their ETag and support byte ranges, so that
+downloads from a peer can be resumed and segmented like any other HTTP
+download. Since the peers are only trusted as much as any other endpoint,
+the files fetched from them are validated against the manifest's checksum.
+"""
+
+import logging
+import os
+import re
+import threading
+
+from stat_cache import StatCache
+
+logger = logging.getLogger(__name__)
+
+# The path the files are served at, followed by their MD5 checksum
+PEER_PATH = '/md5/'
+
+MD5_RE = re.compile(r"^[0-9a-f]{32}$")
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def peer_url(peer, md5):
+    """
+    Return the URL of the file with the given MD5 checksum on a peer, given
+    as host:port.
+    """
+    return "http://{0}{1}{2}".format(peer, PEER_PATH, md5.lower())
+
+def parse_peers(peers):
+    """
+    Parse a comma separated list of peers, each given as host:port, into a
+    list. Raises ValueError for a peer without a valid port.
+    """
+    result = []
+
+    for peer in peers.split(','):
+        peer = peer.strip()
+
+        if not peer:
+            continue
+
+        host, _, port = peer.rpartition(':')
+
+        if not host or not port.isdigit():
+            raise ValueError("Invalid peer {}. Must be host:port.".format(peer))
+
+        result.append(peer)
+
+    return result
+
+class PeerCacheServer(object):
+    """
+    The PeerCacheServer class serves the verified files of one or more
+    directories to peers over HTTP, from a background thread.
+    """
+    def __init__(self, directories, port, address='127.0.0.1'):
+        """
+        Constructor for the PeerCacheServer class. directories is a directory
+        or a list of directories. The files are served on the interface with
+        the given address, without authentication, so it should only be
+        reachable from the cluster. The server starts at once.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        if isinstance(directories, str):
+            directories = [directories]
+
+        self.directories = [os.path.realpath(directory) for directory in directories]
+
+        self._stat_caches = [StatCache(directory) for directory in self.directories]
+
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                server._serve(self, send_body=False)
+
+            def do_GET(self):
+                server._serve(self, send_body=True)
+
+            def log_message(self, *args):
+                server.logger.debug("%s: %s", self.address_string(), args[0] % args[1:])
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+
+        self.logger.info("Serving %s to peers on %s:%s.", ", ".join(self.directories),
+                         address, self.port)
+
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def find(self, md5):
+        """
+        Return the path of the verified file with the given MD5 checksum, or
+        None if none of the directories have it.
+        """
+        for directory, stat_cache in zip(self.directories, self._stat_caches):
+            path = stat_cache.find(md5)
+
+            if path is None:
+                continue
+
+            # Only ever serve files inside the directory
+            path = os.path.realpath(path)
+
+            if os.path.commonpath([path, directory]) == directory:
+                return path
+
+        return None
+
+    # Answer a request for a file, with the whole file or a byte range of it.
+    # Arguments:
+    # handler = the BaseHTTPRequestHandler of the request
+    # send_body = whether to send the contents of the file (False for HEAD)
+    def _serve(self, handler, send_body):
+        path = handler.path.split('?')[0]
+
+        if not path.startswith(PEER_PATH):
+            handler.send_error(404)
+            return
+
+        md5 = path[len(PEER_PATH):].lower()
+
+        if not MD5_RE.match(md5):
+            handler.send_error(404)
+            return
+
+        file_path = self.find(md5)
+
+        if file_path is None:
+            handler.send_error(404)
+            return
+
+        etag = '"{0}"'.format(md5)
+
+        if handler.headers.get('If-None-Match') == etag:
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+            return
+
+        try:
+            file = open(file_path, 'rb')
+        except OSError:
+            handler.send_error(404)
+            return
+
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            start, end = 0, size
+
+            requested = self._get_range(handler.headers, etag, size)
+
+            if requested == "unsatisfiable":
+                handler.send_response(416)
+                handler.send_header('Content-Range', 'bytes */{0}'.format(size))
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+
+            if requested is not None:
+                start, end = requested
+                handler.send_response(206)
+                handler.send_header('Content-Range',
+                                    'bytes {0}-{1}/{2}'.format(start, end - 1, size))
+            else:
+                handler.send_response(200)
+
+            handler.send_header('Content-Type', 'application/octet-stream')
+            handler.send_header('Content-Length', str(end - start))
+            handler.send_header('Accept-Ranges', 'bytes')
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+
+            if not send_body:
+                return
+
+            file.seek(start)
+
+            try:
+                self._copy(file, handler.wfile, end - start)
+            except (ConnectionError, BrokenPipeError):
+                self.logger.debug("The peer hung up during %s.", file_path)
+
+    # Return the (start, end) byte range requested, end excluded, None to
+    # send the whole file, or "unsatisfiable".
+    # Arguments:
+    # headers = the headers of the request
+    # etag = the ETag of the file
+    # size = the size of the file
+    def _get_range(self, headers, etag, size):
+        requested = headers.get('Range')
+
+        if requested is None:
+            return None
+
+        # The file changed since the range was computed: send all of it
+        if_range = headers.get('If-Range')
+        if if_range is not None and if_range != etag:
+            return None
+
+        match = RANGE_RE.match(requested.strip())
+
+        # Multiple ranges aren't supported; the whole file will do
+        if match is None or match.group(1) == match.group(2) == '':
+            return None
+
+        if match.group(1) == '':
+            # The last N bytes
+            start = max(size - int(match.group(2)), 0)
+            end = size
+        else:
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else size
+
+            if end <= start:
+                return None
+
+        if start >= size:
+            return "unsatisfiable"
+
+        return start, min(end, size)
+
+    # Copy length bytes from one file object to another.
+    # Arguments:
+    # source = the file to read
+    # destination = the file to write
+    # length = the number of bytes to copy
+    def _copy(self, source, destination, length):
+        while length > 0:
+            data = source.read(min(length, 1024 * 1024))
+
+            if not data:
+                break
+
+            destination.write(data)
+            length -= len(data)
+
+    def serve_forever(self):
+        """
+        Block until the server is stopped (or the process interrupted).
+        """
+        self._thread.join()
+
+    def close(self):
+        """
+        Stop serving the files.
+        """
+        self._server.shutdown()
+        self._server.server_close()
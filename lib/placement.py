@@ -0,0 +1,195 @@
+"""
+Spreads the files of a manifest across several destination directories (for
+instance, one per disk) so that the writes of a run aren't limited by the
+bandwidth of a single disk.
+
+Every file is placed in one of the destinations by a placement policy:
+
+- 'free': the destination with the most free space, less the bytes of the
+  files being downloaded to it.
+- 'inflight': the destination with the fewest bytes being downloaded to it
+  right now, which spreads the concurrent writes evenly.
+- 'hash': the destination the id of the entry hashes to, which places an
+  entry in the same destination every time.
+
+The destination each manifest id was placed in is recorded in a placement
+index, stored in the first destination (in the same database as the index
+of verified files, see stat_cache.py), so that a file is always looked up,
+resumed or skipped where it was first placed. Additional policies can be
+added with register_policy().
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+
+from stat_cache import INDEX_NAME
+
+logger = logging.getLogger(__name__)
+
+def _free_bytes(destination, inflight):
+    return shutil.disk_usage(destination).free - inflight[destination]
+
+def most_free(mfile, destinations, inflight):
+    """
+    Place the file in the destination with the most free space left once
+    the files being downloaded are complete.
+    """
+    return max(destinations, key=lambda destination: _free_bytes(destination, inflight))
+
+def fewest_inflight(mfile, destinations, inflight):
+    """
+    Place the file in the destination with the fewest bytes being
+    downloaded to it, or the most free space among those.
+    """
+    return min(destinations, key=lambda destination: (
+        inflight[destination], -_free_bytes(destination, inflight)
+    ))
+
+def id_hash(mfile, destinations, inflight):
+    """
+    Place the file in the destination the id of the entry hashes to.
+    """
+    digest = int(hashlib.md5(mfile['id'].encode('utf-8')).hexdigest(), 16)
+
+    return destinations[digest % len(destinations)]
+
+POLICIES = {
+    'free': most_free,
+    'inflight': fewest_inflight,
+    'hash': id_hash
+}
+
+def register_policy(name, policy):
+    """
+    Make an additional placement policy available under the given name. A
+    policy is called with the manifest entry, the list of destinations and
+    a dictionary of the bytes being downloaded to each destination, and
+    returns one of the destinations.
+    """
+    logger.debug("In register_policy: %s", name)
+
+    POLICIES[name] = policy
+
+class Placement(object):
+    """
+    The Placement class chooses the destination of every file and keeps the
+    placement index. It is safe to use from several threads.
+    """
+    def __init__(self, destinations, policy='free'):
+        """
+        Constructor for the Placement class.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        if policy not in POLICIES:
+            raise ValueError("Unknown placement policy: {}".format(policy))
+
+        self.destinations = list(destinations)
+
+        self.policy = policy
+
+        self._lock = threading.Lock()
+
+        # The bytes being downloaded to each destination, and the
+        # reservations of the files being downloaded, keyed by id
+        self._inflight = {destination: 0 for destination in self.destinations}
+        self._reservations = {}
+
+        index_path = os.path.join(self.destinations[0], INDEX_NAME)
+        self.logger.debug("Opening index %s.", index_path)
+
+        self._conn = sqlite3.connect(index_path, check_same_thread=False)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS placement (" +
+                "id TEXT PRIMARY KEY, destination TEXT)"
+            )
+
+    def lookup(self, manifest_id):
+        """
+        Return the destination the manifest id was placed in, or None.
+        """
+        with self._lock:
+            return self._lookup(manifest_id)
+
+    def _lookup(self, manifest_id):
+        row = self._conn.execute(
+            "SELECT destination FROM placement WHERE id = ?", (manifest_id,)
+        ).fetchone()
+
+        return None if row is None else row[0]
+
+    def place(self, mfile, name):
+        """
+        Return the destination to download the manifest entry to, as a file
+        with the given name, and count its size as being downloaded there
+        until release() is called. An entry that was placed before stays
+        where it is, and so does a file already present in (or partially
+        downloaded to) one of the destinations.
+        """
+        self.logger.debug("In place: %s", mfile['id'])
+
+        with self._lock:
+            destination = self._lookup(mfile['id'])
+
+            if destination not in self.destinations:
+                destination = self._find(name)
+
+            if destination is None:
+                destination = POLICIES[self.policy](
+                    mfile, self.destinations, self._inflight
+                )
+
+                self.logger.debug("Placing %s in %s.", mfile['id'], destination)
+
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO placement VALUES (?, ?)",
+                    (mfile['id'], destination)
+                )
+
+            size = mfile.get('size') or 0
+
+            self._inflight[destination] += size
+            self._reservations[mfile['id']] = (destination, size)
+
+        return destination
+
+    # Return the destination that already holds the file, complete or
+    # partial, or None.
+    # Arguments:
+    # name = the name of the file
+    def _find(self, name):
+        for destination in self.destinations:
+            file_name = os.path.join(destination, name)
+
+            if os.path.exists(file_name) or os.path.exists(file_name + '.partial'):
+                return destination
+
+        return None
+
+    def release(self, manifest_id):
+        """
+        Stop counting the size of the entry as being downloaded.
+        """
+        with self._lock:
+            reservation = self._reservations.pop(manifest_id, None)
+
+            if reservation is not None:
+                self._inflight[reservation[0]] -= reservation[1]
+
+    def close(self):
+        """
+        Close the placement index.
+        """
+        self.logger.debug("In close.")
+
+        with self._lock:
+            self._conn.close()
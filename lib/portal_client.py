@@ -4,18 +4,35 @@
 # a manifest file (locally stored or at an HTTP endpoint)
 
 import argparse
+import atexit
+import datetime
+import json
 import logging
 import os
 import errno
+import shutil
 import sys
+from collections import Counter
 
 from manifest_processor import ManifestProcessor
+from object_store import is_store_uri, open_store, parse_store_uri
+from peer_cache import PeerCacheServer, parse_peers
+from placement import Placement, POLICIES as PLACEMENT_POLICIES
+from scheduling import POLICIES
+import sharding
 from convert_to_manifest import file_to_manifest
 from convert_to_manifest import url_to_manifest
 from convert_to_manifest import token_to_manifest
+from convert_to_manifest import manifest_to_file
 
 logger = logging.getLogger()
 
+# The descriptions of the failure codes other than those of every run (1 to 3)
+FAILURE_CODES = {
+    4: "download was cancelled, or not finished",
+    5: "file could not be passed to the --stream-to command, or stored in the bucket"
+}
+
 def obtain_password():
     """
     Interactively obtain the user's password (securely).
@@ -28,13 +45,13 @@ def obtain_password():
 
     return password
 
-def set_logging():
+def set_logging(stream=None):
     """
-    Setup logging.
+    Setup logging, to the given stream or to standard output.
     """
     root = logging.getLogger()
     root.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler(sys.stdout)
+    ch = logging.StreamHandler(stream or sys.stdout)
     ch.setLevel(logging.DEBUG)
     formatter = logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -46,18 +63,35 @@ def get_version():
     """
     Determine the version of the installed portal_client.
     """
-    import pkg_resources
-
     version = None
 
     try:
-        version = pkg_resources.get_distribution('portal_client').version
+        try:
+            from importlib.metadata import version as distribution_version
+        except ImportError:
+            import pkg_resources
+            version = pkg_resources.get_distribution('portal_client').version
+        else:
+            version = distribution_version('portal_client')
     except Exception:
         logger.warning("Unable to determine version.")
         version = "?"
 
     return version
 
+class VersionAction(argparse.Action):
+    """
+    Outputs the version and exits. The version is only looked up when the
+    option is actually given, as the lookup is slow.
+    """
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings=option_strings, dest=dest,
+                         default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser.exit(message="{0} {1}\n".format(parser.prog, get_version()))
+
 def parse_cli():
     """
     Establishes the CLI interface by defining the parameter names and
@@ -71,8 +105,8 @@ def parse_cli():
 
     parser.add_argument(
         '--version',
-        action='version',
-        version='%(prog)s ' + get_version()
+        action=VersionAction,
+        help="show program's version number and exit"
     )
 
     parser.add_argument(
@@ -81,6 +115,19 @@ def parse_cli():
         help='Location of a locally stored manifest file.'
     )
 
+    parser.add_argument(
+        '--manifest-cache',
+        type=str,
+        nargs='?',
+        const='',
+        required=False,
+        dest='manifest_cache',
+        help='Keep the parsed --manifest in a binary cache, which later ' + \
+             'runs load instead of parsing the file again, for as long as ' + \
+             'the file is unchanged. Optionally, the directory of the ' + \
+             'caches (defaults to ~/.cache/portal_client).'
+    )
+
     parser.add_argument(
         '-u', '--url',
         type=str,
@@ -124,10 +171,39 @@ def parse_cli():
     parser.add_argument(
         '-d', '--destination',
         type=str,
+        nargs='+',
         required=False,
-        default=".",
+        default=["."],
+        dest='destinations',
         help='Optional location to place all the downloads. ' + \
-             'Defaults to the current directory.'
+             'Defaults to the current directory. Several directories ' + \
+             '(for instance, on different disks) can be given to spread ' + \
+             'the files across them (see --placement). Can also be an ' + \
+             'S3 or Google Storage bucket, as s3://bucket/prefix or ' + \
+             'gs://bucket/prefix.'
+    )
+
+    parser.add_argument(
+        '--s3-endpoint-url',
+        type=str,
+        required=False,
+        default=None,
+        dest='s3_endpoint_url',
+        help='Optional URL of an S3-compatible service (such as ' + \
+             'http://localhost:9000) to use for s3:// URLs and ' + \
+             'destinations instead of Amazon S3.'
+    )
+
+    parser.add_argument(
+        '--placement',
+        type=str,
+        required=False,
+        default='free',
+        choices=sorted(PLACEMENT_POLICIES),
+        help='Optional policy that decides which of several destinations ' + \
+             'each file is placed in: the one with the most free space ' + \
+             '(free), the fewest bytes being downloaded to it (inflight), ' + \
+             'or the one its id hashes to (hash). Defaults to free.'
     )
 
     parser.add_argument(
@@ -159,6 +235,324 @@ def parse_cli():
              'failures. Defaults to 0.'
     )
 
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        required=False,
+        default=1,
+        help='Optional number of files to download concurrently. ' + \
+             'Defaults to 1.'
+    )
+
+    parser.add_argument(
+        '--scheduling',
+        type=str,
+        required=False,
+        default='manifest',
+        choices=sorted(POLICIES),
+        help='Optional order in which to start the downloads: "manifest" ' + \
+             '(the order of the manifest file), "largest-first", ' + \
+             '"smallest-first" or "interleaved" (largest and smallest ' + \
+             'alternating). Uses the size column of the manifest. ' + \
+             'Defaults to "manifest".'
+    )
+
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        help='Do not download anything. Instead, probe the endpoints of ' + \
+             'every file in the manifest and print a summary of the ' + \
+             'transfer that would be performed.'
+    )
+
+    parser.add_argument(
+        '--plan-workers',
+        type=int,
+        required=False,
+        default=16,
+        dest='plan_workers',
+        help='Optional number of concurrent metadata probes to perform ' + \
+             'when using --plan. Defaults to 16.'
+    )
+
+    parser.add_argument(
+        '--plan-rate',
+        type=float,
+        required=False,
+        default=10.0,
+        dest='plan_rate',
+        help='Optional transfer rate, in megabytes per second, to assume ' + \
+             'when estimating the transfer time with --plan. Defaults to 10.'
+    )
+
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='Do not download anything. Instead, check the files already ' + \
+             'in the destination against the MD5 checksums in the manifest.'
+    )
+
+    parser.add_argument(
+        '--verify-workers',
+        type=int,
+        required=False,
+        default=None,
+        dest='verify_workers',
+        help='Optional number of processes used to checksum files with ' + \
+             '--verify. Defaults to the number of CPUs.'
+    )
+
+    parser.add_argument(
+        '--repair-manifest',
+        type=str,
+        required=False,
+        dest='repair_manifest',
+        help='Optional path of a manifest file to write the missing and ' + \
+             'corrupted files found by --verify to. The file can then be ' + \
+             'used with --manifest to download those files again.'
+    )
+
+    parser.add_argument(
+        '--shard',
+        type=str,
+        required=False,
+        help='Optional shard of the manifest to process, in the form ' + \
+             '"i/N" (the i-th of N shards, counting from 1). Used to ' + \
+             'split a manifest across several nodes.'
+    )
+
+    parser.add_argument(
+        '--shard-strategy',
+        type=str,
+        required=False,
+        default='size',
+        choices=sharding.STRATEGIES,
+        dest='shard_strategy',
+        help='Optional way of assigning manifest entries to shards: ' + \
+             '"size" balances the shards by the size column, "hash" ' + \
+             'assigns entries by the hash of their id. Defaults to "size".'
+    )
+
+    parser.add_argument(
+        '--summary',
+        type=str,
+        required=False,
+        help='Optional path of a JSON file to write the results of the ' + \
+             'run to. The summaries of several shards can be combined ' + \
+             'with --merge-summaries.'
+    )
+
+    parser.add_argument(
+        '--merge-summaries',
+        type=str,
+        nargs='+',
+        required=False,
+        dest='merge_summaries',
+        help='Do not download anything. Instead, combine the given ' + \
+             'summary files written with --summary and report the overall ' + \
+             'result.'
+    )
+
+    parser.add_argument(
+        '--queue',
+        type=str,
+        nargs='?',
+        const='',
+        required=False,
+        help='Share the manifest with other portal_client processes ' + \
+             'through a work queue on a shared filesystem. Every process ' + \
+             'started with the same queue claims files from it until none ' + \
+             'are left. Optionally, the path of the queue database ' + \
+             '(defaults to a file in the destination directory).'
+    )
+
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        help='Only download the entries of the manifest that are new or ' + \
+             'changed since the manifest was last synced to the destination.'
+    )
+
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help='With --sync, remove the files of the entries that are no ' + \
+             'longer in the manifest.'
+    )
+
+    parser.add_argument(
+        '--lease-timeout',
+        type=int,
+        required=False,
+        default=300,
+        dest='lease_timeout',
+        help='Optional number of seconds after which a file claimed from ' + \
+             'the --queue by a process that stopped responding is claimed ' + \
+             'again by another process. Defaults to 300.'
+    )
+
+    parser.add_argument(
+        '--stream-to',
+        type=str,
+        required=False,
+        dest='stream_to',
+        help='Optional command to pipe each file into, instead of saving ' + \
+             'the files to the destination. The command is run through ' + \
+             'the shell once per file; {id} and {name} are replaced with ' + \
+             'the manifest ID and the file name. Files are still checked ' + \
+             'against their MD5 checksum once completely streamed.'
+    )
+
+    parser.add_argument(
+        '--stdout',
+        action='store_true',
+        help='Write the file to standard output instead of saving it to ' + \
+             'the destination. The manifest must contain a single file.'
+    )
+
+    parser.add_argument(
+        '--extract',
+        action='store_true',
+        help='Unpack tar archives and decompress gzip, bzip2 and xz ' + \
+             'compressed files next to them as soon as they are ' + \
+             'downloaded and validated, while the remaining files download.'
+    )
+
+    parser.add_argument(
+        '--post-hook',
+        type=str,
+        required=False,
+        dest='post_hook',
+        help='Optional command to run on every file as soon as it is ' + \
+             'downloaded and validated. The command is run through the ' + \
+             'shell; {path} and {id} are replaced with the path of the ' + \
+             'file and its manifest ID.'
+    )
+
+    parser.add_argument(
+        '--post-workers',
+        type=int,
+        required=False,
+        default=None,
+        dest='post_workers',
+        help='Optional number of processes used for --extract and ' + \
+             '--post-hook. Defaults to the number of CPUs.'
+    )
+
+    parser.add_argument(
+        '--timeout',
+        type=int,
+        required=False,
+        default=60,
+        help='Optional number of seconds to wait for an HTTP or FTP ' + \
+             'server to connect or to send more data. Defaults to 60.'
+    )
+
+    parser.add_argument(
+        '--fasp-sessions',
+        type=int,
+        required=False,
+        default=1,
+        dest='fasp_sessions',
+        help='Optional number of Aspera transfers that may run at the ' + \
+             'same time, when downloading several files at once. ' + \
+             'Defaults to 1.'
+    )
+
+    parser.add_argument(
+        '--fasp-rate',
+        type=str,
+        required=False,
+        default=None,
+        dest='fasp_rate',
+        help='Optional target rate of the Aspera transfers, such as 1G ' + \
+             '(in bits per second), shared by the concurrent sessions. ' + \
+             'Defaults to 300M.'
+    )
+
+    parser.add_argument(
+        '--segments',
+        type=int,
+        required=False,
+        default=1,
+        help='Optional number of byte ranges of a large file to download ' + \
+             'concurrently, for HTTP servers that support ranges and for ' + \
+             'S3. Defaults to 1 (no segmented downloads).'
+    )
+
+    parser.add_argument(
+        '--segment-size',
+        type=int,
+        required=False,
+        default=32,
+        dest='segment_size',
+        help='Optional size, in MB, of the byte ranges used by ' + \
+             '--segments. Only files larger than this are segmented. ' + \
+             'Defaults to 32.'
+    )
+
+    parser.add_argument(
+        '--fsync',
+        action='store_true',
+        help='Sync every downloaded file to disk as soon as its transfer ' + \
+             'is complete.'
+    )
+
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        required=False,
+        default=None,
+        dest='metrics_port',
+        help='Optional port to serve metrics of the downloads on, in the ' + \
+             'Prometheus text format, at http://127.0.0.1:PORT/metrics.'
+    )
+
+    parser.add_argument(
+        '--metrics-textfile',
+        type=str,
+        required=False,
+        default=None,
+        dest='metrics_textfile',
+        help='Optional file to write metrics of the downloads to every 15 ' + \
+             'seconds, in the Prometheus text format, for the textfile ' + \
+             'collector of the node exporter.'
+    )
+
+    parser.add_argument(
+        '--serve-peers',
+        type=int,
+        required=False,
+        default=None,
+        dest='serve_peers',
+        help='Optional port to serve the verified files of the destination ' + \
+             'on, to other nodes that list this one with --peers. Without ' + \
+             'a manifest, the files are served until the client is stopped.'
+    )
+
+    parser.add_argument(
+        '--serve-peers-address',
+        type=str,
+        required=False,
+        default='127.0.0.1',
+        dest='serve_peers_address',
+        help='Optional address of the interface to serve the files on with ' + \
+             '--serve-peers, such as the address of the node on the ' + \
+             'cluster network. The files are served without ' + \
+             'authentication to anyone who can reach it. Defaults to ' + \
+             '127.0.0.1 (this node only).'
+    )
+
+    parser.add_argument(
+        '--peers',
+        type=str,
+        required=False,
+        default=None,
+        help='Optional comma separated list of nodes (host:port) serving ' + \
+             'their files with --serve-peers, to get each file from before ' + \
+             'the URLs of the manifest.'
+    )
+
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -170,6 +564,9 @@ def parse_cli():
     # This is later populated if the user specifies the --user argument.
     args.password = None
 
+    # The indexes of the run are kept in the first destination
+    args.destination = args.destinations[0]
+
     return args
 
 def validate_cli(args, endpoints):
@@ -193,11 +590,25 @@ def validate_cli(args, endpoints):
                              "retrieving data with aspera/fasp.\n")
             cli_error = True
 
+        if args.fasp_rate is not None:
+            try:
+                aspera.parse_rate(args.fasp_rate)
+            except ValueError as e:
+                sys.stderr.write("{}\n".format(e))
+                cli_error = True
+
     if 'GS' in endpoints and (args.client_secrets is None or args.project_id is None):
         sys.stderr.write("Must specify both --google-client-secrets and " + \
                          "--google-project-id when retrieving data from Google.\n")
         cli_error = True
 
+    # The GCP client is only created once it is needed, so check the client
+    # secrets now rather than failing in the middle of the downloads.
+    if args.client_secrets is not None and \
+        not (os.path.isfile(args.client_secrets) and os.access(args.client_secrets, os.R_OK)):
+        sys.stderr.write("File {0} doesn't exist or isn't readable.\n".format(args.client_secrets))
+        cli_error = True
+
     if args.user is not None:
         password = obtain_password()
         args.password = password
@@ -206,9 +617,30 @@ def validate_cli(args, endpoints):
         logger.error("Aborting execution.")
         sys.exit(1)
 
-def retry_results_msg(file_count, failure_1, failure_2, failure_3):
+def start_metrics(mp, args):
     """
-    Outputs the results of those files that failed to download.
+    Count the transfers of the processor in a Metrics object, and serve the
+    metrics, or write them to a file, as requested with --metrics-port and
+    --metrics-textfile. The file is written a last time when the client exits.
+    """
+    logger.debug("In start_metrics.")
+
+    from metrics import Metrics, MetricsServer, TextfileWriter
+
+    metrics = Metrics()
+    mp.set_metrics(metrics)
+
+    if args.metrics_port is not None:
+        MetricsServer(metrics, args.metrics_port)
+
+    if args.metrics_textfile is not None:
+        writer = TextfileWriter(metrics, args.metrics_textfile)
+        atexit.register(writer.close)
+
+def retry_results_msg(file_count, counts):
+    """
+    Outputs the results of those files that failed to download. counts is a
+    dictionary of the number of files with each failure code.
     """
 
     msg = "Not all files (total of {0}) were downloaded successfully. Number of failures:\n" \
@@ -217,7 +649,201 @@ def retry_results_msg(file_count, failure_1, failure_2, failure_3):
         "{3} -- MD5 checksum failed for file (file is corrupted or the wrong MD5 is associated)"
 
     print()
-    print(msg.format(file_count, failure_1, failure_2, failure_3))
+    print(msg.format(file_count, counts.get(1, 0), counts.get(2, 0), counts.get(3, 0)))
+
+    # The codes that only some modes produce are only shown when they occur
+    for code, count in sorted(counts.items()):
+        if code in (0, 1, 2, 3) or not count:
+            continue
+
+        print("{0} -- {1}".format(count, FAILURE_CODES.get(code, "failed with code {}".format(code))))
+
+def plan_results_msg(plan, destinations, rate):
+    """
+    Outputs the summary of a --plan run. Returns True if every file can be
+    obtained and the destinations have enough free space, False otherwise.
+    """
+    logger.debug("In plan_results_msg.")
+
+    by_status = {'ok': [], 'present': [], 'no_url': [], 'unreachable': []}
+    by_endpoint = {}
+    transfer_bytes = 0
+    unknown_size = 0
+
+    for probe in plan:
+        by_status[probe['status']].append(probe)
+
+        if probe['status'] != 'ok':
+            continue
+
+        endpoint = by_endpoint.setdefault(probe['endpoint'], [0, 0])
+        endpoint[0] += 1
+
+        if probe['size'] is None:
+            unknown_size += 1
+        else:
+            remaining = max(probe['size'] - probe['partial'], 0)
+            endpoint[1] += remaining
+            transfer_bytes += remaining
+
+    # Destinations on the same filesystem share its free space
+    devices = {os.stat(destination).st_dev: destination for destination in destinations}
+    free_bytes = sum(shutil.disk_usage(destination).free for destination in devices.values())
+    destination = ", ".join(destinations)
+    seconds = transfer_bytes / (rate * 1000 * 1000)
+
+    print("Plan for {0} files:".format(len(plan)))
+    print("{0} -- to download".format(len(by_status['ok'])))
+    print("{0} -- already present in the destination".format(len(by_status['present'])))
+    print("{0} -- no valid URL in the manifest file".format(len(by_status['no_url'])))
+    print("{0} -- not accessible at any URL".format(len(by_status['unreachable'])))
+    print()
+
+    for name in sorted(by_endpoint):
+        print("{0}: {1} files, {2} bytes".format(
+            name, by_endpoint[name][0], by_endpoint[name][1]
+        ))
+
+    if unknown_size:
+        print("Size of {0} files could not be determined.".format(unknown_size))
+
+    print()
+    print("Total bytes to transfer: {0}".format(transfer_bytes))
+    print("Free space in {0}: {1}".format(destination, free_bytes))
+    print("Estimated transfer time at {0} MB/s: {1}".format(
+        rate, datetime.timedelta(seconds=int(seconds))
+    ))
+
+    for probe in by_status['no_url'] + by_status['unreachable']:
+        print("Unavailable: {0}".format(probe['id']))
+
+    ok = True
+
+    if transfer_bytes > free_bytes:
+        print("Not enough free space in {0}.".format(destination))
+        ok = False
+
+    if by_status['no_url'] or by_status['unreachable']:
+        ok = False
+
+    return ok
+
+def sync_results_msg(sync):
+    """
+    Outputs the changes found by a --sync run.
+    """
+    logger.debug("In sync_results_msg.")
+
+    for path in sync['pruned']:
+        print("Pruned: {0}".format(path))
+
+    msg = "Synced the manifest:\n" \
+        "{0} -- new entries\n" \
+        "{1} -- changed entries\n" \
+        "{2} -- entries whose file was missing\n" \
+        "{3} -- unchanged entries\n" \
+        "{4} -- entries no longer in the manifest ({5} files pruned)"
+
+    print(msg.format(
+        len(sync['added']),
+        len(sync['changed']),
+        len(sync['missing']),
+        sync['unchanged'],
+        len(sync['removed']),
+        len(sync['pruned'])
+    ))
+
+def verify_results_msg(verified):
+    """
+    Outputs the results of a --verify run. Returns the manifest entries that
+    are missing or corrupted.
+    """
+    logger.debug("In verify_results_msg.")
+
+    statuses = [status for _, status in verified]
+    repair = [mfile for mfile, status in verified if status in ('missing', 'mismatch')]
+
+    for mfile, status in verified:
+        if status == 'mismatch':
+            print("MD5 mismatch: {0}".format(mfile['id']))
+        elif status == 'missing':
+            print("Missing: {0}".format(mfile['id']))
+
+    msg = "Verified {0} files:\n" \
+        "{1} -- MD5 checksum matches\n" \
+        "{2} -- MD5 checksum failed for file\n" \
+        "{3} -- file is missing from the destination\n" \
+        "{4} -- no valid URL in the manifest file"
+
+    print()
+    print(msg.format(
+        len(statuses),
+        statuses.count('ok'),
+        statuses.count('mismatch'),
+        statuses.count('missing'),
+        statuses.count('no_url')
+    ))
+
+    return repair
+
+def get_manifest(args):
+    """
+    Build the manifest from whichever manifest source the user specified.
+    """
+    logger.debug("In get_manifest.")
+
+    manifest = {}
+
+    if args.manifest:
+        cache_dir = None
+
+        if args.manifest_cache is not None:
+            from manifest_cache import default_cache_dir
+            cache_dir = args.manifest_cache or default_cache_dir()
+
+        manifest = file_to_manifest(args.manifest, cache_dir=cache_dir)
+    elif args.url:
+        manifest = url_to_manifest(args.url)
+    elif args.token:
+        manifest = token_to_manifest(args.token)
+
+    if args.shard:
+        index, count = sharding.parse_shard(args.shard)
+        manifest = list(sharding.shard_manifest(
+            manifest, index, count, strategy=args.shard_strategy
+        ))
+
+    return manifest
+
+def merge_summaries(paths):
+    """
+    Combine the summary files of several runs and output the overall result.
+    Returns True if every file was downloaded successfully.
+    """
+    logger.debug("In merge_summaries.")
+
+    summaries = []
+
+    for path in paths:
+        with open(path) as summary_file:
+            summaries.append(json.load(summary_file))
+
+    merged = sharding.merge_summaries(summaries)
+    counts = merged['counts']
+
+    if not merged['failures']:
+        print("All {0} files were downloaded successfully.".format(merged['total']))
+        return True
+
+    for manifest_id, code in sorted(merged['failures'].items()):
+        print("Failed ({0}): {1}".format(code, manifest_id))
+
+    retry_results_msg(
+        merged['total'],
+        {int(code): count for code, count in counts.items()}
+    )
+
+    return False
 
 def main():
     """
@@ -226,7 +852,32 @@ def main():
     args = parse_cli()
 
     if args.debug:
-        set_logging()
+        # With --stdout, standard output only carries the data of the file
+        set_logging(sys.stderr if args.stdout else sys.stdout)
+
+    if args.merge_summaries:
+        if merge_summaries(args.merge_summaries):
+            sys.exit(0)
+
+        sys.exit(1)
+
+    if args.prune and not args.sync:
+        sys.stderr.write("Error: --prune requires --sync.\n")
+        sys.exit(1)
+
+    if args.shard:
+        try:
+            sharding.parse_shard(args.shard)
+        except ValueError as e:
+            sys.stderr.write("Error: {0}\n".format(e))
+            sys.exit(1)
+
+    if args.peers:
+        try:
+            peers = parse_peers(args.peers)
+        except ValueError as e:
+            sys.stderr.write("Error: {0}\n".format(e))
+            sys.exit(1)
 
     default_endpoint_priority = ['HTTP', 'FTP', 'S3']
     valid_endpoints = ['HTTP', 'FTP', 'S3', 'FASP', 'GS']
@@ -242,12 +893,35 @@ def main():
     else:
         endpoints = default_endpoint_priority
 
-    if args.destination != ".":
+    store_destination = is_store_uri(args.destination)
+
+    if store_destination:
         try:
-            os.makedirs(args.destination)
-        except OSError as exception:
-            if exception.errno != errno.EEXIST:
-                raise
+            parse_store_uri(args.destination)
+        except ValueError as e:
+            sys.stderr.write("Error: {0}\n".format(e))
+            sys.exit(1)
+
+        if len(args.destinations) > 1 or args.plan or args.verify or args.sync or \
+                args.queue is not None or args.serve_peers is not None or \
+                args.stream_to or args.stdout or args.extract or args.post_hook:
+            sys.stderr.write("Error: A bucket destination can only be used on " + \
+                             "its own, to download a manifest.\n")
+            sys.exit(1)
+
+        if args.destination.startswith('gs://') and \
+                (args.client_secrets is None or args.project_id is None):
+            sys.stderr.write("Must specify both --google-client-secrets and " + \
+                             "--google-project-id when storing data in Google.\n")
+            sys.exit(1)
+
+    for destination in args.destinations:
+        if destination != "." and not store_destination:
+            try:
+                os.makedirs(destination)
+            except OSError as exception:
+                if exception.errno != errno.EEXIST:
+                    raise
 
     validate_cli(args, endpoints)
 
@@ -273,34 +947,238 @@ def main():
         logger.debug("Turning off checksum validation.")
         mp.disable_validation()
 
-    while keep_trying:
-        manifest = {}
+    if args.fsync:
+        logger.debug("Syncing downloaded files to disk.")
+        mp.enable_fsync()
+
+    mp.set_timeout(args.timeout)
+
+    if args.s3_endpoint_url is not None:
+        mp.set_s3_endpoint_url(args.s3_endpoint_url)
+
+    if args.fasp_sessions > 1 or args.fasp_rate is not None:
+        mp.set_fasp_options(args.fasp_sessions, args.fasp_rate)
+
+    if args.segments > 1:
+        logger.debug("Downloading large files in %s segments.", args.segments)
+        mp.enable_segments(args.segments, args.segment_size * 1024 * 1024)
+
+    if args.metrics_port is not None or args.metrics_textfile is not None:
+        start_metrics(mp, args)
+
+    if store_destination and destination.startswith('gs://'):
+        mp.enable_gcp_writes()
+
+    # The authorization of GCP prompts for a code, which must happen before
+    # the downloads start rather than in the middle of the run
+    if 'GS' in endpoints or (store_destination and destination.startswith('gs://')):
+        logger.debug("Authorizing GCP.")
+        mp.authorize_gcp()
+
+    if len(args.destinations) > 1:
+        logger.debug("Placing the files in %s.", args.destinations)
+        mp.set_placement(Placement(args.destinations, policy=args.placement))
+
+    if args.peers:
+        logger.debug("Trying the peers %s first.", peers)
+        mp.set_peers(peers)
+
+    if args.serve_peers is not None:
+        server = PeerCacheServer(args.destinations, args.serve_peers,
+                                 address=args.serve_peers_address)
+
+        # Without a manifest, this node only serves its files
+        if not (args.manifest or args.url or args.token):
+            print("Serving the files of {0} to peers on {1}:{2}.".format(
+                ", ".join(args.destinations), args.serve_peers_address, server.port))
+
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+
+            sys.exit(0)
+
+    if store_destination:
+        logger.debug("Storing the manifest in %s.", destination)
+
+        store = open_store(destination, endpoint_url=args.s3_endpoint_url,
+                           gcp=mp.gcp_client)
+
+        while keep_trying:
+            manifest = get_manifest(args)
+
+            result = mp.upload_manifest(manifest, store, args.endpoint_priority,
+                                        workers=args.workers)
+
+            if result.count(0) == len(result):
+                keep_trying = False
+            else:
+                retry_results_msg(len(result), Counter(result))
+
+                if attempts == args.retries or result.count(1) == len(result):
+                    keep_trying = False
+                else:
+                    attempts += 1
+                    print("Initiating download attempt number {}...\n".format(attempts))
+
+    if args.plan:
+        logger.debug("Planning the download of the manifest.")
+
+        plan = mp.plan_manifest(
+            get_manifest(args),
+            destination,
+            args.endpoint_priority,
+            workers=args.plan_workers
+        )
+
+        if plan_results_msg(plan, args.destinations, args.plan_rate):
+            sys.exit(0)
+
+        sys.exit(1)
+
+    if args.verify:
+        logger.debug("Verifying the destination against the manifest.")
+
+        verified = mp.verify_manifest(
+            get_manifest(args),
+            destination,
+            args.endpoint_priority,
+            workers=args.verify_workers
+        )
+
+        repair = verify_results_msg(verified)
+
+        if args.repair_manifest:
+            manifest_to_file(repair, args.repair_manifest)
+            print("Wrote {0} entries to {1}.".format(len(repair), args.repair_manifest))
+
+        if repair:
+            sys.exit(1)
 
-        if args.manifest:
-            manifest = file_to_manifest(args.manifest)
-        elif args.url:
-            manifest = url_to_manifest(args.url)
-        elif args.token:
-            manifest = token_to_manifest(args.token)
+        sys.exit(0)
+
+    if args.stream_to or args.stdout:
+        logger.debug("Streaming the manifest.")
+
+        from streaming import ProcessSink, StdoutSink
+
+        manifest = get_manifest(args)
+        workers = args.workers
+
+        if args.stdout:
+            if len(manifest) != 1:
+                sys.stderr.write("Error: --stdout requires a manifest with a single file.\n")
+                sys.exit(1)
+
+            # Keep all other output away from the data
+            stdout = sys.stdout.buffer
+            sys.stdout = sys.stderr
+            workers = 1
+
+            def sink_factory(mfile):
+                return StdoutSink(stdout)
+        else:
+            def sink_factory(mfile):
+                name = mfile['urls'].split(',')[0].split('/')[-1]
+                return ProcessSink(args.stream_to, mfile['id'], name)
+
+        result = mp.stream_manifest(manifest, args.endpoint_priority,
+                                    sink_factory, workers=workers)
+
+        if result.count(0) != len(result):
+            retry_results_msg(len(result), Counter(result))
+            sys.exit(1)
+
+        sys.exit(0)
+
+    post_processor = None
+
+    if args.extract or args.post_hook:
+        from postprocess import PostProcessor
+
+        post_processor = PostProcessor(extract=args.extract, hook=args.post_hook,
+                                       workers=args.post_workers)
+        mp.set_post_processor(post_processor)
+
+    if args.queue is not None:
+        from work_queue import WorkQueue, QUEUE_NAME
+
+        queue_path = args.queue or os.path.join(destination, QUEUE_NAME)
+        logger.debug("Downloading from the work queue %s.", queue_path)
+
+        queue = WorkQueue(queue_path, lease_seconds=args.lease_timeout,
+                          max_attempts=args.retries + 1)
+        queue.populate(get_manifest(args))
+
+        mp.download_queue(queue, destination, args.endpoint_priority,
+                          workers=args.workers)
+
+        finished = queue.results()
+
+        # Entries left when the run is interrupted
+        for manifest_id in queue.unfinished():
+            print("Unfinished: {0}".format(manifest_id))
+            finished.append((manifest_id, 4))
+
+        queue.close()
+
+        manifest = [{'id': manifest_id} for manifest_id, _ in finished]
+        result = [code for _, code in finished]
+
+        if result.count(0) != len(result):
+            retry_results_msg(len(result), Counter(result))
+
+        keep_trying = False
+
+    if args.sync:
+        logger.debug("Syncing the manifest to %s.", destination)
+
+        # Every sync only retries the entries that failed in the last one
+        while keep_trying:
+            manifest = get_manifest(args)
+
+            sync = mp.sync_manifest(
+                manifest,
+                destination,
+                args.endpoint_priority,
+                workers=args.workers,
+                scheduling=args.scheduling,
+                prune=args.prune
+            )
+
+            sync_results_msg(sync)
+            result = sync['codes']
+
+            if result.count(0) == len(result):
+                keep_trying = False
+            else:
+                retry_results_msg(len(result), Counter(result))
+
+                if attempts == args.retries or result.count(1) == len(result):
+                    keep_trying = False
+                else:
+                    attempts += 1
+                    print("Initiating sync attempt number {}...\n".format(attempts))
+
+    while keep_trying:
+        manifest = get_manifest(args)
 
         logger.debug("About to start downloading manifest.")
 
         result = mp.download_manifest(
             manifest,
             destination,
-            args.endpoint_priority
+            args.endpoint_priority,
+            workers=args.workers,
+            scheduling=args.scheduling
         )
 
         if len(result) == 0 or result.count(0) == len(result):
             # No failures found
             keep_trying = False
         else:
-            retry_results_msg(
-                len(result),
-                result.count(1),
-                result.count(2),
-                result.count(3)
-            )
+            retry_results_msg(len(result), Counter(result))
 
             if attempts == args.retries:
                 keep_trying = False
@@ -312,5 +1190,17 @@ def main():
                 if result.count(1) == len(result):
                     keep_trying = False
 
+    if post_processor is not None:
+        logger.debug("Waiting for post-processing to finish.")
+
+        for manifest_id, error in post_processor.wait():
+            print("Post-processing of file ID {0} failed: {1}".format(manifest_id, error))
+
+    if args.summary:
+        logger.debug("Writing the summary to %s.", args.summary)
+
+        with open(args.summary, 'w') as summary_file:
+            json.dump(sharding.summarize(manifest, result, args.shard), summary_file, indent=2)
+
 if __name__ == '__main__':
     main()
@@ -1,9 +1,22 @@
 import os
+import json
 import logging
 from os import path
+import urllib.error
 import urllib.request
 import sys
 
+from segments import SEGMENT_SIZE, SegmentJournal, download_segments, has_journal
+from streaming import WriteBehindFile
+
+# Suffix of the sidecar file that records the validators (ETag and
+# Last-Modified) of the remote file a partial download was taken from.
+META_SUFFIX = '.meta'
+
+# Suffix of the file the validators are written to before they replace the
+# sidecar, which is left behind if a run dies in between.
+META_TMP_SUFFIX = META_SUFFIX + '.tmp'
+
 class PortalHTTP(object):
     def __init__(self, blocksize=100000):
         """
@@ -15,79 +28,265 @@ class PortalHTTP(object):
 
         self.blocksize = blocksize
 
+        # Optional callable invoked with the size of every block transferred
+        self.progress_callback = None
+
+        # Whether downloaded files are synced to disk once complete
+        self.fsync = False
+
+        # Seconds to wait for the server to connect or send more data
+        self.timeout = 60
+
+        # Files larger than a segment are downloaded in this many concurrent
+        # byte ranges (see segments.py), when the server supports ranges
+        self.segments = 1
+        self.segment_size = SEGMENT_SIZE
+
     def download_file(self, url, local_path):
+        """
+        Download the file at the URL to the local path. A partial local file
+        is resumed only if the remote file hasn't changed since it was
+        started: its ETag or Last-Modified date is sent in an If-Range
+        header, and if the server replies with the whole file instead of the
+        requested range, the download starts over. A local file that is
+        already complete is confirmed with a conditional request, which
+        transfers nothing if the remote file is unchanged.
+
+        Large files are downloaded in segments if enabled, or if the partial
+        file was started that way.
+        """
         self.logger.debug("In download_file. URL: {}".format(url))
 
         # If we only have part of a file, get the new start position
         current_byte = 0
 
         # Need to pull the size without the potential bytes buffer
-        remote_file_size = self._get_file_size(url)
+        headers = self._get_headers(url)
+        remote_file_size = int(headers['Content-Length'])
 
         if os.path.exists(local_path):
             current_byte = os.path.getsize(local_path)
 
-            if current_byte < remote_file_size:
-                self.logger.warn("The local file is smaller than the remote one.")
-                self._handle_chunked_download(url, local_path, current_byte, remote_file_size)
-            elif current_byte > remote_file_size:
-                self.logger.warn("The local file is LARGER than the remote one! Skipping.")
-            else:
-                # sizes must be equal
-                self.logger.info("File already present. Skipping.")
+        validators = self._load_validators(local_path)
+
+        if has_journal(local_path) or (
+                self.segments > 1 and remote_file_size > self.segment_size and
+                headers.get('Accept-Ranges') == 'bytes'):
+            self._handle_segmented_download(url, local_path, remote_file_size,
+                                            headers, validators)
+        elif current_byte == 0:
+            self._handle_chunked_download(url, local_path, 0, remote_file_size)
+        elif current_byte < remote_file_size:
+            self.logger.warn("The local file is smaller than the remote one.")
+            self._handle_chunked_download(url, local_path, current_byte,
+                                          remote_file_size, validators)
+        elif current_byte > remote_file_size:
+            self.logger.warn("The local file is LARGER than the remote one! " +
+                             "The remote file has changed. Starting over.")
+            self._handle_chunked_download(url, local_path, 0, remote_file_size)
+        elif validators:
+            # sizes are equal, so make sure it's still the same file
+            self._handle_chunked_download(url, local_path, current_byte,
+                                          remote_file_size, validators)
         else:
-            self._handle_chunked_download(url, local_path, current_byte, remote_file_size)
+            # sizes must be equal
+            self.logger.info("File already present. Skipping.")
+
+    def stream_file(self, url, writer):
+        """
+        Download the remote file, passing its contents to writer.write() as
+        they arrive instead of saving them to a local file.
+        """
+        self.logger.debug("In stream_file. URL: {}".format(url))
+
+        remote_file_size = self._get_file_size(url)
+
+        self._transfer(url, writer, 0, remote_file_size)
 
-    def _handle_chunked_download(self, url, file_name, current_byte, file_size):
+    def _handle_chunked_download(self, url, file_name, current_byte, file_size,
+                                 validators=None):
         self.logger.debug("In _handle_chunked_download: {}".format(url))
 
-        res = self._get_url_obj(url, current_byte)
+        res = self._get_url_obj(url, current_byte, validators,
+                                complete=current_byte == file_size)
 
-        blocksize = self.blocksize
+        if res == "error":
+            raise Exception("Unable to retrieve {}".format(url))
+
+        if res == "unchanged":
+            self.logger.info("File already present and unchanged. Skipping.")
+            return
+
+        if current_byte > 0 and res.status != 206:
+            # The server ignored the range because the remote file changed
+            # since the local one was started, and is sending all of it.
+            self.logger.warn("The remote file has changed. Starting over.")
+            current_byte = 0
+            file_size = int(res.info().get('Content-Length', file_size))
 
-        with open(file_name, 'ab') as file:
+        self._save_validators(file_name, res)
+
+        mode = 'ab' if current_byte > 0 else 'wb'
+
+        with WriteBehindFile(file_name, mode, fsync=self.fsync) as file:
 
             print(
                 "Downloading file via HTTP: {0} | total bytes = {1}"
                     .format(file_name, file_size)
             )
 
-            while True:
-                if blocksize > file_size:
-                    self._generate_status_message("block size greater than " + \
-                        "total file size. Pulling in entire file.")
+            self._transfer(url, file, current_byte, file_size, res)
+
+    # Download the file in segments fetched concurrently (see segments.py).
+    # Arguments:
+    # url = path to location of the file on the web
+    # file_name = path of the partial file
+    # file_size = the size of the remote file
+    # headers = the headers of the remote file
+    # validators = the validators recorded for a sequential partial file
+    def _handle_segmented_download(self, url, file_name, file_size, headers,
+                                   validators=None):
+        self.logger.debug("In _handle_segmented_download: {}".format(url))
+
+        validator = self._get_validator(headers.get('ETag'), headers.get('Last-Modified'))
 
-                buffer = self._get_buffer(res)
+        journal = SegmentJournal(file_name, file_size, self.segment_size, validator)
 
-                if not buffer: # note that only HTTP/S3 make it beyond this point
-                    break
+        if not journal.resumed and os.path.exists(file_name) and validators and \
+                validator is not None and validator == self._get_validator(
+                    validators.get('etag'), validators.get('last_modified')):
+            # Keep what a sequential download of the same file retrieved
+            journal.mark_prefix(os.path.getsize(file_name))
 
-                file.write(buffer)
+        # From now on, the journal tracks the remote file
+        self._discard_validators(file_name)
+
+        print(
+            "Downloading file via HTTP in {0} segments: {1} | total bytes = {2}"
+                .format(journal.count, file_name, file_size)
+        )
+
+        def fetch_range(start, end, write):
+            http_header = {'Range': 'bytes={0}-{1}'.format(start, end - 1)}
+
+            if validator is not None:
+                http_header['If-Range'] = validator
+
+            req = urllib.request.Request(url, headers=http_header)
 
-                current_byte += len(buffer)
+            with urllib.request.urlopen(req, timeout=self.timeout) as res:
+                if res.status != 206:
+                    raise Exception("The remote file {} has changed.".format(url))
 
-                msg = "{0}  [{1:.2f}%]".format(
-                    current_byte,
-                    current_byte * 100 / file_size
-                )
+                while True:
+                    buffer = self._get_buffer(res)
+
+                    if not buffer:
+                        break
+
+                    write(buffer)
+
+                    if self.progress_callback is not None:
+                        self.progress_callback(len(buffer))
+
+        download_segments(journal, fetch_range, max(self.segments, 1), self.fsync)
+
+    # Return the validator to send in an If-Range header: the ETag, unless it
+    # is a weak one, or the Last-Modified date. Returns None if neither can
+    # be used.
+    # Arguments:
+    # etag = the ETag of the remote file
+    # last_modified = the Last-Modified date of the remote file
+    def _get_validator(self, etag, last_modified):
+        if etag and not etag.startswith('W/'):
+            return etag
+
+        return last_modified or None
+
+    # Transfer the file, from the given position onwards, to a writable
+    # object (a local file or a stream).
+    # Arguments:
+    # url = path to location of the file on the web
+    # file = object the data is written to
+    # current_byte = the byte position to retrieve data from
+    # file_size = the size of the remote file
+    # res = the response to read from, if the request has already been made
+    def _transfer(self, url, file, current_byte, file_size, res=None):
+        self.logger.debug("In _transfer: {}".format(url))
 
-                self._generate_status_message(msg)
+        if res is None:
+            res = self._get_url_obj(url, current_byte)
+
+        if res == "error":
+            raise Exception("Unable to retrieve {}".format(url))
+
+        blocksize = self.blocksize
+
+        while True:
+            if blocksize > file_size:
+                self._generate_status_message("block size greater than " + \
+                    "total file size. Pulling in entire file.")
+
+            buffer = self._get_buffer(res)
+
+            if not buffer: # note that only HTTP/S3 make it beyond this point
+                break
+
+            file.write(buffer)
+
+            current_byte += len(buffer)
+
+            if self.progress_callback is not None:
+                self.progress_callback(len(buffer))
+
+            msg = "{0}  [{1:.2f}%]".format(
+                current_byte,
+                current_byte * 100 / file_size
+            )
+
+            self._generate_status_message(msg)
 
     # Get a network object of the file that can be iterated over.
     # Arguments:
     # url = path to location of the file on the web
     # current_byte = The byte position to retrieve data from
-    def _get_url_obj(self, url, current_byte):
+    # validators = the ETag and Last-Modified date of the local copy, if any.
+    #   When resuming, the range is only honoured if the remote file still
+    #   matches them.
+    # complete = whether the local copy is as large as the remote file, in
+    #   which case "unchanged" is returned if the remote file still matches
+    #   the validators
+    def _get_url_obj(self, url, current_byte, validators=None, complete=False):
         self.logger.debug("In _get_url_obj: {}".format(url))
 
         http_header = {}
         http_header['Range'] = 'bytes={0}-'.format(current_byte)
 
+        if validators:
+            validator = self._get_validator(validators.get('etag'),
+                                            validators.get('last_modified'))
+            if validator is not None:
+                http_header['If-Range'] = validator
+
+            # For a complete local file, there is no range left to request
+            if complete:
+                del http_header['Range']
+                http_header.pop('If-Range', None)
+
+                if validators.get('etag'):
+                    http_header['If-None-Match'] = validators['etag']
+                elif validators.get('last_modified'):
+                    http_header['If-Modified-Since'] = validators['last_modified']
+
         res = ""
 
         try:
             req = urllib.request.Request(url, headers=http_header)
-            res = urllib.request.urlopen(req)
+            res = urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return "unchanged"
+            res = ""
         except:
             res = ""
 
@@ -97,12 +296,96 @@ class PortalHTTP(object):
         # If made it here, no network object established
         return "error"
 
+    # Load the validators recorded for a partial file, or None. A temporary
+    # sidecar left by a run that died before replacing the validators is
+    # removed.
+    # Arguments:
+    # local_path = path of the partial file
+    def _load_validators(self, local_path):
+        try:
+            os.remove(local_path + META_TMP_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(local_path + META_SUFFIX) as meta:
+                return json.load(meta)
+        except (OSError, ValueError):
+            return None
+
+    # Record the validators of the remote file next to the partial file, so
+    # that a later run can check the remote file is unchanged before
+    # resuming. The sidecar is replaced atomically.
+    # Arguments:
+    # local_path = path of the partial file
+    # res = the response the partial file is written from
+    def _save_validators(self, local_path, res):
+        headers = res.info()
+
+        if res.status == 206:
+            # Content-Range is "bytes start-end/size"
+            size = headers.get('Content-Range', '').rpartition('/')[2]
+        else:
+            size = headers.get('Content-Length')
+
+        validators = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'size': int(size) if size and size.isdigit() else None
+        }
+
+        if not validators['etag'] and not validators['last_modified']:
+            self._discard_validators(local_path)
+            return
+
+        tmp_meta = local_path + META_TMP_SUFFIX
+
+        with open(tmp_meta, 'w') as meta:
+            json.dump(validators, meta)
+
+        os.replace(tmp_meta, local_path + META_SUFFIX)
+
+    # Remove the validators recorded for a partial file, along with the
+    # sidecar left by a run that died while replacing them.
+    # Arguments:
+    # local_path = path of the partial file
+    def _discard_validators(self, local_path):
+        for suffix in (META_SUFFIX, META_TMP_SUFFIX):
+            try:
+                os.remove(local_path + suffix)
+            except FileNotFoundError:
+                pass
+
     # Function to retrieve the file size.
     # Arguments:
     # url = path to location of file on the web
     def _get_file_size(self, url):
         self.logger.debug("In _get_file_size.")
-        return int(urllib.request.urlopen(url).info()['Content-Length'])
+
+        return int(self._get_headers(url)['Content-Length'])
+
+    # Function to retrieve the headers of the file.
+    # Arguments:
+    # url = path to location of file on the web
+    def _get_headers(self, url):
+        self.logger.debug("In _get_headers.")
+
+        # Use HEAD so that no payload is transferred just to learn the size
+        req = urllib.request.Request(url, method='HEAD')
+
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as res:
+                return res.info()
+        except urllib.error.HTTPError as e:
+            # Servers that don't support HEAD: only the headers of a GET
+            # are read, and the connection is closed before the body
+            if e.code not in (405, 501):
+                raise
+
+            self.logger.debug("HEAD is not supported for %s. Using GET.", url)
+
+        with urllib.request.urlopen(url, timeout=self.timeout) as res:
+            return res.info()
 
     # Function to retrieve a particular set of bytes from the file.
     # Arguments:
@@ -0,0 +1,192 @@
+"""
+Post-processing of downloaded files, such as unpacking archives, performed
+in a pool of worker processes as soon as each file has been downloaded and
+validated, so that the processing overlaps with the remaining downloads.
+"""
+
+import bz2
+import gzip
+import logging
+import lzma
+import os
+import shlex
+import shutil
+import subprocess
+import tarfile
+
+logger = logging.getLogger(__name__)
+
+# Suffixes of tar archives, which are unpacked into the directory they are in
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Suffixes of single compressed files, which are decompressed next to the
+# compressed file, without the suffix
+COMPRESSED_SUFFIXES = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open
+}
+
+def extract_file(path):
+    """
+    Unpack a tar archive, or decompress a gzip, bzip2 or xz compressed file,
+    next to the file itself. The original file is kept. Returns True if the
+    file was extracted and False if it isn't an archive.
+    """
+    logger.debug("In extract_file: %s", path)
+
+    directory = os.path.dirname(path)
+
+    if path.endswith(TAR_SUFFIXES):
+        with tarfile.open(path) as archive:
+            # Refuse members that would land outside of the directory, when
+            # this version of Python supports it.
+            if hasattr(tarfile, 'data_filter'):
+                archive.extractall(directory, filter='data')
+            else:
+                for member in archive:
+                    _check_member(member, directory)
+                    archive.extract(member, directory)
+
+        return True
+
+    for suffix, opener in COMPRESSED_SUFFIXES.items():
+        if path.endswith(suffix):
+            output = path[:-len(suffix)]
+            tmp_output = "{0}.partial".format(output)
+
+            with opener(path, 'rb') as compressed, open(tmp_output, 'wb') as decompressed:
+                shutil.copyfileobj(compressed, decompressed, 1024 * 1024)
+
+            os.replace(tmp_output, output)
+
+            return True
+
+    return False
+
+# Whether a path, once its links are resolved, is inside the directory.
+# Arguments:
+# path = the path to check
+# directory = the directory, with its links resolved
+def _inside(path, directory):
+    return os.path.commonpath([os.path.realpath(path), directory]) == directory
+
+# Raise an exception if a member of a tar archive would be extracted outside
+# of the directory, is a link to a path outside of it, or is a device. The
+# members are checked as they are extracted, so that the links extracted
+# before them are followed.
+# Arguments:
+# member = the TarInfo of the member
+# directory = the directory the archive is extracted to
+def _check_member(member, directory):
+    directory = os.path.realpath(directory)
+    target = os.path.join(directory, member.name)
+
+    if os.path.isabs(member.name) or not _inside(target, directory):
+        raise tarfile.TarError("{0} would be extracted outside of {1}."
+                               .format(member.name, directory))
+
+    if member.issym():
+        link = os.path.join(os.path.dirname(os.path.realpath(target)), member.linkname)
+    elif member.islnk():
+        link = os.path.join(directory, member.linkname)
+    else:
+        link = None
+
+    if link is not None and (os.path.isabs(member.linkname) or not _inside(link, directory)):
+        raise tarfile.TarError("{0} links to {1}, outside of {2}."
+                               .format(member.name, member.linkname, directory))
+
+    if member.isdev():
+        raise tarfile.TarError("{0} is a device.".format(member.name))
+
+def run_hook(command, path, manifest_id):
+    """
+    Run a user supplied command, through the shell, on a downloaded file.
+    {path} and {id} in the command are replaced with the (shell-quoted) path
+    of the file and its manifest ID. Raises an exception if the command fails.
+    """
+    logger.debug("In run_hook: %s", path)
+
+    command = command.format(path=shlex.quote(path), id=shlex.quote(manifest_id))
+
+    subprocess.run(command, shell=True, check=True)
+
+def post_process(path, manifest_id, extract, hook):
+    """
+    Perform the post-processing of a single file. Runs in a worker process.
+    Returns None on success, or a description of the error.
+    """
+    try:
+        if extract:
+            extract_file(path)
+
+        if hook is not None:
+            run_hook(hook, path, manifest_id)
+    except Exception as e:
+        return str(e)
+
+    return None
+
+class PostProcessor(object):
+    """
+    The PostProcessor class runs the post-processing of downloaded files in a
+    pool of worker processes.
+    """
+    def __init__(self, extract=False, hook=None, workers=None):
+        """
+        Constructor for the PostProcessor class.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self.extract = extract
+
+        self.hook = hook
+
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # The workers are started from download threads, while other threads
+        # may hold locks, so they aren't forked from this process.
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+        self._futures = []
+
+    def submit(self, path, manifest_id):
+        """
+        Queue the post-processing of a downloaded file.
+        """
+        self.logger.debug("In submit: %s", path)
+
+        future = self._executor.submit(post_process, path, manifest_id,
+                                       self.extract, self.hook)
+
+        self._futures.append((manifest_id, future))
+
+    def wait(self):
+        """
+        Wait for all the queued post-processing to finish. Returns a list of
+        (manifest ID, error) tuples for the files that could not be processed.
+        """
+        self.logger.debug("In wait.")
+
+        failures = []
+
+        for manifest_id, future in self._futures:
+            error = future.result()
+
+            if error is not None:
+                self.logger.error("Post-processing of %s failed: %s", manifest_id, error)
+                failures.append((manifest_id, error))
+
+        self._futures = []
+        self._executor.shutdown()
+
+        return failures
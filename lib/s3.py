@@ -1,15 +1,44 @@
 import os
+import hashlib
 import logging
 from os import path
 import sys
 
+from urllib.parse import urlparse
+
 import boto
+from boto.s3.connection import OrdinaryCallingFormat
 from boto.utils import get_instance_metadata
 
+from checksum import ChecksumMismatch
+from segments import SEGMENT_SIZE, SegmentJournal, download_segments, has_journal
+from streaming import WriteBehindFile
+
+def connect(endpoint_url=None, anon=False):
+    """
+    Establish a boto connection to S3, or to the S3-compatible service at
+    endpoint_url (such as http://localhost:9000). Unless anon is True, the
+    credentials are those boto finds in the environment or its config files.
+    """
+    if endpoint_url is None:
+        return boto.connect_s3(anon=anon)
+
+    endpoint = urlparse(endpoint_url)
+
+    # S3-compatible services rarely support bucket names in the host name
+    return boto.connect_s3(
+        anon=anon,
+        host=endpoint.hostname,
+        port=endpoint.port,
+        is_secure=endpoint.scheme == 'https',
+        calling_format=OrdinaryCallingFormat()
+    )
+
 class S3(object):
-    def __init__(self, blocksize=100000):
+    def __init__(self, blocksize=100000, endpoint_url=None):
         """
-        Constructor for the S3 class.
+        Constructor for the S3 class. endpoint_url is the URL of an
+        S3-compatible service to use instead of Amazon S3.
         """
         self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
 
@@ -17,10 +46,36 @@ class S3(object):
 
         self.blocksize = blocksize
 
+        # Optional callable invoked with the size of every block transferred
+        self.progress_callback = None
+
+        # Whether downloaded files are synced to disk once complete
+        self.fsync = False
+
+        # Objects larger than a segment are downloaded in this many
+        # concurrent byte ranges (see segments.py)
+        self.segments = 1
+        self.segment_size = SEGMENT_SIZE
+
         # Estalish an anonymous connection to S3 with boto
-        self.connection = boto.connect_s3(anon=True)
+        self.connection = connect(endpoint_url, anon=True)
 
-    def download_file(self, s3_remote_path, local_path):
+    def download_file(self, s3_remote_path, local_path, expected_md5=None):
+        """
+        Download an S3 object to the local path, resuming a partial download
+        if the local file already holds part of it.
+
+        If expected_md5 is given and the object's ETag is its MD5 checksum
+        (true of objects that weren't uploaded in multiple parts), the two are
+        compared before anything is downloaded, raising an exception if they
+        differ. A download that starts from the beginning is then checksummed
+        as it arrives, and True is returned if it matched the ETag, so that
+        the file doesn't need to be read again to validate it. Returns False
+        when the download couldn't be validated this way.
+
+        Large objects are downloaded in segments if enabled, or if the partial
+        file was started that way.
+        """
         self.logger.debug("In download_file.")
 
         if not s3_remote_path.startswith('s3://'):
@@ -29,11 +84,30 @@ class S3(object):
         # If we only have part of a file, get the new start position
         current_byte = 0
 
+        key = self._s3_get_key(s3_remote_path)
+
+        if not key:
+            raise Exception("No such S3 object: {}".format(s3_remote_path))
+
         # Need to pull the size without the potential bytes buffer
-        remote_file_size = self._get_file_size(s3_remote_path)
+        remote_file_size = key.size
         self.logger.debug("Remote file size: {}".format(remote_file_size))
 
-        if os.path.exists(local_path):
+        server_md5 = None
+
+        if expected_md5 is not None:
+            server_md5 = self._key_md5(key)
+
+            if server_md5 is not None and server_md5 != expected_md5:
+                raise ChecksumMismatch("The ETag of {0} ({1}) doesn't match the MD5 checksum {2}."
+                                       .format(s3_remote_path, server_md5, expected_md5))
+
+        md5 = None
+
+        if has_journal(local_path) or (
+                self.segments > 1 and remote_file_size > self.segment_size):
+            self._handle_segmented_download(s3_remote_path, local_path, key)
+        elif os.path.exists(local_path):
             current_byte = os.path.getsize(local_path)
 
             if current_byte < remote_file_size:
@@ -45,43 +119,155 @@ class S3(object):
                 # sizes must be equal
                 self.logger.info("File already present. Skipping.")
         else:
-            self._handle_chunked_download(s3_remote_path, local_path, current_byte, remote_file_size)
+            if server_md5 is not None:
+                md5 = hashlib.md5()
 
+            self._handle_chunked_download(s3_remote_path, local_path, current_byte,
+                                          remote_file_size, md5=md5)
 
-    def _handle_chunked_download(self, url, tmp_file_name, current_byte, file_size):
-        self.logger.debug("In _handle_chunked_download.")
+        validated = md5 is not None and md5.hexdigest() == server_md5
+        self.logger.debug("Validated against the ETag? %s", validated)
 
-        res = self._get_url_obj(url)
+        return validated
 
-        blocksize = self.blocksize
+    # Return the MD5 checksum of the object from its ETag, or None if the
+    # ETag isn't an MD5 checksum (the ETag of an object uploaded in several
+    # parts contains a '-').
+    # Arguments:
+    # key = the boto key of the object
+    def _key_md5(self, key):
+        etag = (key.etag or '').strip('"')
+
+        if not etag or '-' in etag:
+            return None
+
+        return etag.lower()
+
+    def server_md5(self, s3_remote_path):
+        """
+        Return the MD5 checksum of the S3 object according to its ETag, or
+        None if the ETag is not a plain MD5 checksum.
+        """
+        self.logger.debug("In server_md5.")
+
+        return self._key_md5(self._s3_get_key(s3_remote_path))
+
+    def stream_file(self, s3_remote_path, writer):
+        """
+        Download the S3 object, passing its contents to writer.write() as
+        they arrive instead of saving them to a local file.
+        """
+        self.logger.debug("In stream_file.")
+
+        if not s3_remote_path.startswith('s3://'):
+            raise Exception("Invalid Amazon S3 path. Must start with s3://")
+
+        remote_file_size = self._get_file_size(s3_remote_path)
 
-        with open(tmp_file_name, 'ab') as filehandle:
+        self._transfer(s3_remote_path, writer, 0, remote_file_size)
+
+    def _handle_chunked_download(self, url, tmp_file_name, current_byte, file_size, md5=None):
+        self.logger.debug("In _handle_chunked_download.")
+
+        with WriteBehindFile(tmp_file_name, 'ab', fsync=self.fsync) as filehandle:
             print(
                 "Downloading file from AWS S3: {0} | total bytes = {1}"
                     .format(tmp_file_name, file_size)
             )
 
-            while True:
-                if blocksize > file_size:
-                    self._generate_status_message("block size greater than " + \
-                        "total file size, pulling in entire file.")
+            self._transfer(url, filehandle, current_byte, file_size, md5=md5)
+
+    # Download the object in segments fetched concurrently (see segments.py).
+    # Arguments:
+    # url = path to location of file on Amazon S3
+    # tmp_file_name = path of the partial file
+    # key = the boto key of the object
+    def _handle_segmented_download(self, url, tmp_file_name, key):
+        self.logger.debug("In _handle_segmented_download.")
+
+        journal = SegmentJournal(tmp_file_name, key.size, self.segment_size, key.etag)
+
+        if not journal.resumed and os.path.exists(tmp_file_name):
+            # A sequential partial download has no record of the object it
+            # was taken from, so it can't be trusted.
+            self.logger.info("Discarding the partial download of %s.", url)
 
-                buf = self._get_buffer(res, current_byte, file_size, filehandle)
+        print(
+            "Downloading file from AWS S3 in {0} segments: {1} | total bytes = {2}"
+                .format(journal.count, tmp_file_name, key.size)
+        )
+
+        def fetch_range(start, end, write):
+            # Keys hold the state of their requests, so each segment has its own
+            segment_key = self._s3_get_key(url)
+
+            if segment_key is None or segment_key.etag != key.etag:
+                raise Exception("The S3 object {} has changed.".format(url))
+
+            while start < end:
+                range_end = min(start + self.blocksize, end) - 1
+
+                buf = segment_key.get_contents_as_string(
+                    headers={'Range': 'bytes={0}-{1}'.format(start, range_end)}
+                )
 
-                # Note: only HTTP and S3 make it beyond this point
                 if not buf:
                     break
 
-                filehandle.write(buf)
+                write(buf)
 
-                current_byte += len(buf)
+                start += len(buf)
 
-                msg = "{0}  [{1:.2f}%]".format(
-                    current_byte,
-                    current_byte * 100 / file_size
-                )
+                if self.progress_callback is not None:
+                    self.progress_callback(len(buf))
+
+        download_segments(journal, fetch_range, max(self.segments, 1), self.fsync)
+
+    # Transfer the object, from the given position onwards, to a writable
+    # object (a local file or a stream).
+    # Arguments:
+    # url = path to location of file on Amazon S3
+    # filehandle = object the data is written to
+    # current_byte = the byte position to retrieve data from
+    # file_size = the size of the object
+    # md5 = optional hashlib object updated with the data as it arrives
+    def _transfer(self, url, filehandle, current_byte, file_size, md5=None):
+        self.logger.debug("In _transfer.")
+
+        res = self._get_url_obj(url)
+
+        if res == "error":
+            raise Exception("Unable to retrieve {}".format(url))
+
+        blocksize = self.blocksize
+
+        while True:
+            if blocksize > file_size:
+                self._generate_status_message("block size greater than " + \
+                    "total file size, pulling in entire file.")
+
+            buf = self._get_buffer(res, current_byte, file_size, filehandle)
+
+            # Note: only HTTP and S3 make it beyond this point
+            if not buf:
+                break
+
+            filehandle.write(buf)
+
+            if md5 is not None:
+                md5.update(buf)
+
+            current_byte += len(buf)
+
+            if self.progress_callback is not None:
+                self.progress_callback(len(buf))
+
+            msg = "{0}  [{1:.2f}%]".format(
+                current_byte,
+                current_byte * 100 / file_size
+            )
 
-                self._generate_status_message(msg)
+            self._generate_status_message(msg)
 
     # Function to retrieve a particular set of bytes from the file.
     # Arguments:
@@ -0,0 +1,100 @@
+"""
+Scheduling policies that determine the order in which the entries of a
+manifest are downloaded. When several files are downloaded concurrently, the
+order matters: starting the largest files first keeps a single straggler from
+deciding how long the whole run takes, while starting the smallest files first
+yields many completed files quickly.
+
+A policy is a function that accepts the manifest list and returns a new list
+with the same entries in the order they should be started. Entries without a
+known size (for instance, manifests generated from a token) are always placed
+after the entries with a known size. Additional policies can be added with
+register_policy().
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _size_key(mfile):
+    size = mfile.get('size')
+
+    return -1 if size is None else size
+
+def _split_unknown(manifest):
+    known = [mfile for mfile in manifest if mfile.get('size') is not None]
+    unknown = [mfile for mfile in manifest if mfile.get('size') is None]
+
+    return known, unknown
+
+def manifest_order(manifest):
+    """
+    Download the entries in the order they are listed in the manifest.
+    """
+    return list(manifest)
+
+def largest_first(manifest):
+    """
+    Download the largest entries first, which minimizes the makespan when
+    the files are spread across several workers.
+    """
+    known, unknown = _split_unknown(manifest)
+
+    return sorted(known, key=_size_key, reverse=True) + unknown
+
+def smallest_first(manifest):
+    """
+    Download the smallest entries first, for quick partial results.
+    """
+    known, unknown = _split_unknown(manifest)
+
+    return sorted(known, key=_size_key) + unknown
+
+def interleaved(manifest):
+    """
+    Alternate between the largest and the smallest remaining entries, so that
+    large and small files are mixed across the run.
+    """
+    known, unknown = _split_unknown(manifest)
+    ordered = sorted(known, key=_size_key, reverse=True)
+
+    result = []
+    low = 0
+    high = len(ordered) - 1
+
+    while low <= high:
+        result.append(ordered[low])
+
+        if low != high:
+            result.append(ordered[high])
+
+        low += 1
+        high -= 1
+
+    return result + unknown
+
+POLICIES = {
+    'manifest': manifest_order,
+    'largest-first': largest_first,
+    'smallest-first': smallest_first,
+    'interleaved': interleaved
+}
+
+def register_policy(name, policy):
+    """
+    Make an additional scheduling policy available under the given name.
+    """
+    logger.debug("In register_policy: %s", name)
+
+    POLICIES[name] = policy
+
+def scheduling_policy(name):
+    """
+    Return the scheduling policy function registered under the given name.
+    """
+    logger.debug("In scheduling_policy: %s", name)
+
+    if name not in POLICIES:
+        raise ValueError("Unknown scheduling policy: {}".format(name))
+
+    return POLICIES[name]
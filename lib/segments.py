@@ -0,0 +1,280 @@
+"""
+Segmented downloads: a large file is split into fixed-size segments (byte
+ranges) that are fetched concurrently and written at their offsets in the
+partial file.
+
+Since the segments complete out of order, the size of the partial file no
+longer says how much of it has been downloaded. Instead, a journal kept next
+to the partial file (in a file with the JOURNAL_SUFFIX) records which
+segments are complete, as a bitmap. The journal is rewritten atomically every
+time a segment completes, so after a crash or kill the download resumes by
+fetching only the segments that are missing.
+
+The journal also records the size of the remote file and a validator (such as
+its ETag). If either no longer matches the remote file, the journal is
+discarded and the download starts over.
+"""
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from streaming import BoundedWriter
+
+logger = logging.getLogger(__name__)
+
+# Suffix of the journal of a partial file
+JOURNAL_SUFFIX = '.segments'
+
+# The default size of a segment, in bytes
+SEGMENT_SIZE = 32 * 1024 * 1024
+
+class _SegmentAborted(Exception):
+    """
+    Raised in a segment to stop it because another segment failed.
+    """
+
+class SegmentJournal(object):
+    """
+    The SegmentJournal class records which segments of a partial file are
+    complete. It is safe to use from several threads.
+    """
+    def __init__(self, path, size, segment_size=SEGMENT_SIZE, validator=None):
+        """
+        Constructor for the SegmentJournal class. path is the partial file.
+        An existing journal is loaded if it was written for the same size,
+        segment size and validator; otherwise, the journal starts empty.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self.path = path
+
+        self.size = size
+
+        self.segment_size = segment_size
+
+        self.validator = validator
+
+        self.count = max((size + segment_size - 1) // segment_size, 1)
+
+        self._lock = threading.Lock()
+
+        self._done = bytearray((self.count + 7) // 8)
+
+        self.resumed = self._load()
+
+    @property
+    def journal_path(self):
+        return self.path + JOURNAL_SUFFIX
+
+    def _load(self):
+        try:
+            with open(self.journal_path) as journal:
+                state = json.load(journal)
+        except (OSError, ValueError):
+            return False
+
+        if state.get('size') != self.size or \
+                state.get('segment_size') != self.segment_size or \
+                state.get('validator') != self.validator:
+            self.logger.info("The remote file has changed since %s was started.",
+                             self.path)
+            return False
+
+        done = bytes.fromhex(state.get('done', ''))
+
+        if len(done) != len(self._done):
+            return False
+
+        self._done[:] = done
+
+        return True
+
+    def _save(self):
+        state = {
+            'size': self.size,
+            'segment_size': self.segment_size,
+            'validator': self.validator,
+            'done': self._done.hex(),
+            'completed': self._completed_bytes()
+        }
+
+        tmp_journal = self.journal_path + '.tmp'
+
+        with open(tmp_journal, 'w') as journal:
+            json.dump(state, journal)
+
+        os.replace(tmp_journal, self.journal_path)
+
+    def segment(self, index):
+        """
+        Return the (start, end) byte range of a segment, end excluded.
+        """
+        start = index * self.segment_size
+
+        return start, min(start + self.segment_size, self.size)
+
+    def is_done(self, index):
+        return bool(self._done[index // 8] & (1 << (index % 8)))
+
+    def missing(self):
+        """
+        Return the indexes of the segments that aren't complete.
+        """
+        with self._lock:
+            return [index for index in range(self.count) if not self.is_done(index)]
+
+    def _completed_bytes(self):
+        return sum(
+            end - start for start, end in
+            (self.segment(index) for index in range(self.count) if self.is_done(index))
+        )
+
+    def save(self):
+        """
+        Write the journal, before any of the segments are downloaded.
+        """
+        with self._lock:
+            self._save()
+
+    def mark_prefix(self, nbytes):
+        """
+        Mark the segments entirely within the first nbytes of the file as
+        complete, for a partial file that was downloaded sequentially.
+        """
+        with self._lock:
+            for index in range(self.count):
+                if self.segment(index)[1] > nbytes:
+                    break
+
+                self._done[index // 8] |= 1 << (index % 8)
+
+            self._save()
+
+    def mark_done(self, index):
+        """
+        Record that a segment is complete.
+        """
+        with self._lock:
+            self._done[index // 8] |= 1 << (index % 8)
+            self._save()
+
+    def discard(self):
+        """
+        Remove the journal, once the file is complete.
+        """
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+
+def has_journal(path):
+    """
+    Whether the partial file at path is being downloaded in segments.
+    """
+    return os.path.exists(path + JOURNAL_SUFFIX)
+
+def partial_bytes(path):
+    """
+    Return the number of bytes already downloaded into a partial file,
+    whether it was downloaded sequentially or in segments.
+    """
+    if not os.path.exists(path):
+        return 0
+
+    if has_journal(path):
+        try:
+            with open(path + JOURNAL_SUFFIX) as journal:
+                return json.load(journal).get('completed', 0)
+        except (OSError, ValueError):
+            return 0
+
+    return os.path.getsize(path)
+
+def download_segments(journal, fetch_range, workers, fsync=False):
+    """
+    Download the segments of the file that the journal doesn't record as
+    complete, with up to workers segments in flight at once, then remove
+    the journal.
+
+    fetch_range(start, end, write) must retrieve the bytes from start to end
+    (excluded) of the remote file and pass them, in order, to write(). Each
+    segment's data is written at its offset in the file by a write-behind
+    thread, and the segment is recorded in the journal once its data is on
+    disk (synced first if fsync is True). If a segment fails, the other
+    segments stop and the exception is raised; the journal keeps the
+    segments that completed.
+    """
+    logger.debug("In download_segments: %s", journal.path)
+
+    # The journal must exist before the partial file is extended, or the
+    # extended file would pass for a complete sequential download.
+    journal.save()
+
+    mode = 'r+b' if os.path.exists(journal.path) else 'wb'
+
+    with open(journal.path, mode) as file:
+        # Make room for segments written past the end of the partial file
+        if os.fstat(file.fileno()).st_size != journal.size:
+            file.truncate(journal.size)
+
+        fd = file.fileno()
+
+        failed = threading.Event()
+
+        def download(index):
+            if failed.is_set():
+                return
+
+            start, end = journal.segment(index)
+            offset = start
+
+            def consume(data):
+                nonlocal offset
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+
+            writer = BoundedWriter(consume)
+
+            def write(data):
+                if failed.is_set():
+                    raise _SegmentAborted()
+
+                writer.write(data)
+
+            try:
+                fetch_range(start, end, write)
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                writer.close()
+
+            if offset != end:
+                failed.set()
+                raise Exception("Segment {0}-{1} of {2} is incomplete ({3} bytes)."
+                                .format(start, end, journal.path, offset - start))
+
+            if fsync:
+                os.fdatasync(fd)
+
+            journal.mark_done(index)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(download, index) for index in journal.missing()]
+
+            errors = [future.exception() for future in futures]
+
+    errors = [
+        error for error in errors
+        if error is not None and not isinstance(error, _SegmentAborted)
+    ]
+
+    if errors:
+        raise errors[0]
+
+    journal.discard()
@@ -0,0 +1,196 @@
+"""
+A Python API for downloading manifests from other programs. Rather than
+returning failure codes once the whole manifest is done, a DownloadSession
+yields a DownloadResult for every file as soon as that file is finished, so
+that the caller can start working on it while the rest of the manifest is
+still being downloaded. Example:
+
+    session = DownloadSession(destination='/data', workers=4)
+
+    for result in session.download(manifest):
+        if result.ok:
+            analyze(result.path)
+
+The manifest can be any iterable of manifest entries (dictionaries with the
+keys 'id', 'md5', 'urls' and optionally 'size'), including a generator that
+produces them lazily.
+"""
+
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from scheduling import scheduling_policy
+
+logger = logging.getLogger(__name__)
+
+class DownloadCancelled(Exception):
+    """
+    Raised by a transfer when the downloads have been cancelled.
+    """
+
+class DownloadResult(object):
+    """
+    The outcome of the download of one manifest entry.
+    """
+    __slots__ = ('id', 'path', 'endpoint', 'url', 'bytes', 'duration', 'status')
+
+    # The statuses, which are the failure codes used by download_manifest()
+    SUCCESS = 0
+    NO_URL = 1
+    UNREACHABLE = 2
+    CHECKSUM_FAILED = 3
+    CANCELLED = 4
+    SINK_FAILED = 5
+
+    def __init__(self, manifest_id, path=None, endpoint=None, url=None,
+                 nbytes=0, duration=0.0, status=None):
+        """
+        Constructor for the DownloadResult class.
+        """
+        self.id = manifest_id
+
+        # The local path of the file
+        self.path = path
+
+        # The endpoint (protocol) and url the file was obtained from, if it
+        # had to be transferred
+        self.endpoint = endpoint
+        self.url = url
+
+        # The number of bytes transferred and the time taken, in seconds
+        self.bytes = nbytes
+        self.duration = duration
+
+        self.status = status
+
+    @property
+    def ok(self):
+        return self.status == DownloadResult.SUCCESS
+
+    def __repr__(self):
+        return "DownloadResult(id={0!r}, path={1!r}, endpoint={2!r}, " \
+            "bytes={3}, duration={4:.2f}, status={5})".format(
+                self.id, self.path, self.endpoint, self.bytes,
+                self.duration, self.status
+            )
+
+class DownloadSession(object):
+    """
+    The DownloadSession class downloads manifests, yielding the result of
+    each file in the order the files finish.
+    """
+    def __init__(self, destination='.', priorities='', workers=1,
+                 scheduling='manifest', processor=None, sink_factory=None):
+        """
+        Constructor for the DownloadSession class. Unless a ManifestProcessor
+        is provided, one is created with its default settings. If a
+        sink_factory is provided, files are streamed into the sink it returns
+        for each manifest entry (see streaming.py) instead of being saved to
+        the destination.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        # A processor passed in may be used again once the session is over,
+        # so it is only cancelled on request
+        self._owns_processor = processor is None
+
+        if processor is None:
+            from manifest_processor import ManifestProcessor
+            processor = ManifestProcessor()
+
+        self.processor = processor
+
+        self.destination = destination
+
+        self.priorities = priorities
+
+        self.workers = workers
+
+        self.scheduling = scheduling
+
+        self.sink_factory = sink_factory
+
+        self._cancelled = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._owns_processor:
+            self.cancel()
+        else:
+            self._cancelled.set()
+
+    def cancel(self):
+        """
+        Stop the session. No further files are started, and the transfers in
+        progress are interrupted (their partial files are kept so that a
+        later run can resume them). This also cancels the processor of the
+        session, which should not be used for further downloads. Leaving the
+        session's context only cancels the processor if the session created
+        it; a processor passed in just has no further files started.
+        """
+        self.logger.debug("In cancel.")
+
+        self._cancelled.set()
+        self.processor.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def download(self, manifest):
+        """
+        Download the entries of the manifest, yielding a DownloadResult for
+        each one as it finishes. With the 'manifest' scheduling policy, the
+        entries are read from the iterable only as workers become available;
+        other policies need to see the whole manifest first.
+        """
+        self.logger.debug("In download.")
+
+        if self.scheduling == 'manifest':
+            entries = iter(manifest)
+        else:
+            entries = iter(scheduling_policy(self.scheduling)(list(manifest)))
+
+        self.processor._set_workers(self.workers)
+
+        # Keep a few entries queued per worker, but no more, so that a lazy
+        # manifest is consumed at the pace of the downloads.
+        max_pending = self.workers * 2
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+
+            def submit():
+                while not self.cancelled and len(pending) < max_pending:
+                    mfile = next(entries, None)
+
+                    if mfile is None:
+                        break
+
+                    if self.sink_factory is None:
+                        future = executor.submit(
+                            self.processor._download_manifest_file,
+                            mfile, self.destination, self.priorities
+                        )
+                    else:
+                        future = executor.submit(
+                            self.processor.stream_manifest_file,
+                            mfile, self.priorities, self.sink_factory
+                        )
+
+                    pending.add(future)
+
+            submit()
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield future.result()
+
+                submit()
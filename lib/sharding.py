@@ -0,0 +1,149 @@
+"""
+Splits a manifest into shards so that several nodes can each download a
+part of it, and combines the per-shard run summaries afterwards.
+
+Every node is given the same manifest and its own shard, in the form "i/N"
+(the i-th of N shards, counting from 1). The assignment of an entry to a
+shard depends only on the entries themselves, never on the node or on the
+order of the rows, so the shards never overlap and together they cover the
+whole manifest. Two strategies are available:
+
+- 'hash': an entry belongs to the shard its id hashes to. The manifest can
+  be filtered as it is read, without holding it in memory.
+- 'size': the entries are dealt out, largest first, to whichever shard has
+  the fewest bytes so far, balancing the shards by the size column. This
+  needs the whole manifest. Entries without a size fall back to 'hash'.
+"""
+
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ('size', 'hash')
+
+def parse_shard(spec):
+    """
+    Parse a shard specification of the form "i/N" into a (i, N) tuple.
+    """
+    logger.debug("In parse_shard: %s", spec)
+
+    try:
+        index, count = [int(part) for part in spec.split('/')]
+    except ValueError:
+        raise ValueError("Invalid shard {}. Must be of the form i/N.".format(spec))
+
+    if count < 1 or index < 1 or index > count:
+        raise ValueError("Invalid shard {}. Must be between 1/N and N/N.".format(spec))
+
+    return index, count
+
+def _id_hash(manifest_id):
+    return int(hashlib.md5(manifest_id.encode('utf-8')).hexdigest(), 16)
+
+def shard_of(manifest_id, count):
+    """
+    Return the shard (counting from 1) that the id hashes to.
+    """
+    return _id_hash(manifest_id) % count + 1
+
+def hash_shard(manifest, index, count):
+    """
+    Yield the entries of the manifest whose id hashes to the shard.
+    """
+    logger.debug("In hash_shard: %s/%s", index, count)
+
+    for mfile in manifest:
+        if shard_of(mfile['id'], count) == index:
+            yield mfile
+
+def size_shard(manifest, index, count):
+    """
+    Return the entries of the manifest assigned to the shard when the entries
+    are balanced across the shards by size.
+    """
+    logger.debug("In size_shard: %s/%s", index, count)
+
+    manifest = list(manifest)
+    sized = [mfile for mfile in manifest if mfile.get('size') is not None]
+
+    # Ties are broken by the hash of the id so that every node computes the
+    # same assignment regardless of the order of the rows.
+    sized.sort(key=lambda mfile: (-mfile['size'], _id_hash(mfile['id'])))
+
+    loads = [0] * count
+    assigned = set()
+
+    for mfile in sized:
+        shard = loads.index(min(loads))
+        loads[shard] += mfile['size']
+
+        if shard + 1 == index:
+            assigned.add(mfile['id'])
+
+    return [
+        mfile for mfile in manifest
+        if mfile['id'] in assigned or
+        (mfile.get('size') is None and shard_of(mfile['id'], count) == index)
+    ]
+
+def shard_manifest(manifest, index, count, strategy='size'):
+    """
+    Return the entries of the manifest that belong to the shard.
+    """
+    logger.debug("In shard_manifest.")
+
+    if strategy == 'hash':
+        return hash_shard(manifest, index, count)
+
+    if strategy == 'size':
+        return size_shard(manifest, index, count)
+
+    raise ValueError("Unknown sharding strategy: {}".format(strategy))
+
+def summarize(manifest, result, shard=None):
+    """
+    Build the summary of a run from the manifest and the failure codes
+    returned by download_manifest() for it. The summary records the number of
+    files with each code and the code of every file that failed.
+    """
+    logger.debug("In summarize.")
+
+    counts = {}
+    failures = {}
+
+    for mfile, code in zip(manifest, result):
+        counts[str(code)] = counts.get(str(code), 0) + 1
+
+        if code != 0:
+            failures[mfile['id']] = code
+
+    return {
+        'shard': shard,
+        'total': len(result),
+        'counts': counts,
+        'failures': failures
+    }
+
+def merge_summaries(summaries):
+    """
+    Combine the summaries of several runs (typically, one per shard) into one.
+    """
+    logger.debug("In merge_summaries.")
+
+    merged = {
+        'shard': None,
+        'total': 0,
+        'counts': {},
+        'failures': {}
+    }
+
+    for summary in summaries:
+        merged['total'] += summary['total']
+
+        for code, count in summary['counts'].items():
+            merged['counts'][code] = merged['counts'].get(code, 0) + count
+
+        merged['failures'].update(summary['failures'])
+
+    return merged
@@ -0,0 +1,138 @@
+"""
+Keeps a small index, stored in the destination directory, of the files whose
+MD5 checksums have been verified. Along with the checksum, the size,
+modification time and inode of each file are recorded at the time it was
+verified. As long as those still match, the file can be trusted without
+checksumming it again; files that changed since (for instance, truncated by
+a crash or modified by hand) have to be checksummed again.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+
+# The name of the index database in the destination directory.
+INDEX_NAME = '.portal_client.db'
+
+class StatCache(object):
+    """
+    The StatCache class records and looks up verified files of a destination.
+    """
+    def __init__(self, destination):
+        """
+        Constructor for the StatCache class.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self._destination = destination
+
+        # The connection is shared by the download workers.
+        self._lock = threading.Lock()
+
+        index_path = os.path.join(destination, INDEX_NAME)
+        self.logger.debug("Opening index %s.", index_path)
+
+        self._conn = sqlite3.connect(index_path, check_same_thread=False)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS stat_cache (" +
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, " +
+                "inode INTEGER, md5 TEXT)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS stat_cache_md5 ON stat_cache (md5)"
+            )
+
+    @property
+    def destination(self):
+        return self._destination
+
+    def _key(self, file_path):
+        # Paths are stored relative to the destination.
+        return os.path.relpath(file_path, self._destination)
+
+    def is_verified(self, file_path, md5):
+        """
+        Determine if the file was previously verified to have the given MD5
+        checksum and has not changed since.
+        """
+        self.logger.debug("In is_verified: %s", file_path)
+
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, inode, md5 FROM stat_cache WHERE path = ?",
+                (self._key(file_path),)
+            ).fetchone()
+
+        verified = row is not None and \
+            tuple(row) == (stat.st_size, stat.st_mtime_ns, stat.st_ino, md5)
+
+        self.logger.debug("Verified? %s", verified)
+
+        return verified
+
+    def record(self, file_path, md5):
+        """
+        Record that the file has just been verified to have the given MD5
+        checksum.
+        """
+        self.logger.debug("In record: %s", file_path)
+
+        stat = os.stat(file_path)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stat_cache VALUES (?, ?, ?, ?, ?)",
+                (self._key(file_path), stat.st_size, stat.st_mtime_ns,
+                 stat.st_ino, md5)
+            )
+
+    def find(self, md5):
+        """
+        Return the path of a verified file with the given MD5 checksum that
+        has not changed since it was verified, or None if there is none.
+        """
+        self.logger.debug("In find: %s", md5)
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM stat_cache WHERE md5 = ?", (md5,)
+            ).fetchall()
+
+        for (key,) in rows:
+            file_path = os.path.join(self._destination, key)
+
+            if self.is_verified(file_path, md5):
+                return file_path
+
+        return None
+
+    def forget(self, file_path):
+        """
+        Remove any record of the file.
+        """
+        self.logger.debug("In forget: %s", file_path)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM stat_cache WHERE path = ?",
+                (self._key(file_path),)
+            )
+
+    def close(self):
+        """
+        Close the index.
+        """
+        self.logger.debug("In close.")
+
+        with self._lock:
+            self._conn.close()
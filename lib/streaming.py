@@ -0,0 +1,250 @@
+"""
+Support for streaming downloaded data into a consumer (a "sink") instead of
+saving it to a file in the destination directory.
+
+A sink is any object with two methods:
+
+- write(data): called with each block of the file, in order.
+- finish(valid): called once the whole file has been passed to write(), or
+  when the transfer failed. valid is True if the file was transferred
+  completely and its MD5 checksum matched. Returns True if the sink
+  processed the file successfully.
+
+Blocks are handed from the thread reading the network to the sink through a
+BoundedWriter, so that a slow sink doesn't stall the network reads until its
+(bounded) queue of blocks is full, at which point the reads wait for the sink
+to catch up. Downloads saved to local files go through a WriteBehindFile,
+which does the same for the disk writes.
+"""
+
+import logging
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+class BoundedWriter(object):
+    """
+    A file-like object that passes the blocks written to it to a consumer
+    function running in a separate thread. At most max_pending blocks are
+    queued; write() blocks while the queue is full. If batch_bytes is set,
+    the blocks waiting in the queue are joined, up to that many bytes, and
+    passed to the consumer together.
+    """
+    def __init__(self, consumer, max_pending=16, batch_bytes=None):
+        """
+        Constructor for the BoundedWriter class.
+        """
+        self._consumer = consumer
+
+        self._queue = queue.Queue(maxsize=max_pending)
+
+        self._batch_bytes = batch_bytes
+
+        # The first exception raised by the consumer, if any
+        self._error = None
+
+        self.bytes_written = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        finished = False
+
+        while not finished:
+            data = self._queue.get()
+
+            if data is None:
+                break
+
+            if self._batch_bytes is not None:
+                blocks = [data]
+                size = len(data)
+
+                # Take whatever else is already waiting, without blocking
+                while size < self._batch_bytes:
+                    try:
+                        block = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    if block is None:
+                        finished = True
+                        break
+
+                    blocks.append(block)
+                    size += len(block)
+
+                if len(blocks) > 1:
+                    data = b''.join(blocks)
+
+            # After a failure, keep draining the queue so writers never block
+            if self._error is None:
+                try:
+                    self._consumer(data)
+                except Exception as e:
+                    logger.error("Consumer failed: %s", e)
+                    self._error = e
+
+    @property
+    def error(self):
+        """
+        The exception raised by the consumer, or None if it hasn't failed.
+        """
+        return self._error
+
+    def write(self, data):
+        """
+        Queue a block for the consumer, waiting while the queue is full.
+        Raises the consumer's exception if it has failed.
+        """
+        if self._error is not None:
+            raise self._error
+
+        self._queue.put(bytes(data))
+        self.bytes_written += len(data)
+
+        return len(data)
+
+    def close(self):
+        """
+        Wait for the consumer to process every queued block. Raises the
+        consumer's exception if it failed.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+class WriteBehindFile(BoundedWriter):
+    """
+    A local file written by a separate thread, so that the thread reading the
+    network keeps reading while the disk catches up (up to max_pending
+    blocks behind). Blocks that pile up while the disk is busy are written
+    together. If fsync is True, the file is synced to disk when it is closed.
+    """
+    def __init__(self, path, mode='ab', max_pending=16, batch_bytes=8 * 1024 * 1024,
+                 fsync=False):
+        """
+        Constructor for the WriteBehindFile class.
+        """
+        self._file = open(path, mode)
+
+        self._fsync = fsync
+
+        super(WriteBehindFile, self).__init__(
+            self._file.write, max_pending=max_pending, batch_bytes=batch_bytes
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+
+        # Keep what was received, but don't hide the original exception
+        try:
+            self.close()
+        except Exception as e:
+            logger.error("Unable to write %s: %s", self._file.name, e)
+
+    def close(self):
+        """
+        Wait for every queued block to be written, then close the file.
+        Raises the exception of the write that failed, if any.
+        """
+        if self._file.closed:
+            return
+
+        try:
+            super(WriteBehindFile, self).close()
+
+            self._file.flush()
+
+            if self._fsync:
+                os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+
+class CallbackSink(object):
+    """
+    A sink that passes each block to a Python callable. An optional second
+    callable is given the validity of the file once it is complete, and may
+    return False to report that processing it failed.
+    """
+    def __init__(self, on_data, on_finish=None):
+        """
+        Constructor for the CallbackSink class.
+        """
+        self._on_data = on_data
+        self._on_finish = on_finish
+
+    def write(self, data):
+        self._on_data(data)
+
+    def finish(self, valid):
+        if self._on_finish is None:
+            return valid
+
+        return self._on_finish(valid) is not False and valid
+
+class ProcessSink(object):
+    """
+    A sink that pipes the file into the standard input of a command. The
+    command is run through the shell once per file, after replacing {id} and
+    {name} with the manifest ID and the file name (both shell-quoted).
+    """
+    def __init__(self, command, manifest_id, name):
+        """
+        Constructor for the ProcessSink class.
+        """
+        self.command = command.format(
+            id=shlex.quote(manifest_id), name=shlex.quote(name)
+        )
+
+        logger.debug("Starting: %s", self.command)
+
+        self._process = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self._process.stdin.write(data)
+
+    def finish(self, valid):
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        returncode = self._process.wait()
+
+        if returncode != 0:
+            logger.error("Command '%s' exited with %s.", self.command, returncode)
+
+        return valid and returncode == 0
+
+class StdoutSink(object):
+    """
+    A sink that writes the file to the standard output of the client.
+    """
+    def __init__(self, stream=None):
+        """
+        Constructor for the StdoutSink class.
+        """
+        self._stream = stream if stream is not None else sys.stdout.buffer
+
+    def write(self, data):
+        self._stream.write(data)
+
+    def finish(self, valid):
+        self._stream.flush()
+
+        return valid
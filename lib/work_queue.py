@@ -0,0 +1,215 @@
+"""
+A work queue, stored in an SQLite database on a shared filesystem, that lets
+several portal_client processes (on one or more nodes) download a single
+manifest together. Each process claims one entry at a time, so faster nodes
+simply claim more entries, and the manifest drains at the combined speed of
+all of them.
+
+Claimed entries are leased for a limited time. A process renews the leases of
+the entries it is working on while it works, so an entry whose lease expires
+belonged to a process that crashed or was killed, and is claimed again by
+another process. The filesystem holding the database must support POSIX file
+locking.
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+# The name of the queue database when it is kept in the destination directory.
+QUEUE_NAME = '.portal_client_queue.db'
+
+class WorkQueue(object):
+    """
+    The WorkQueue class claims, renews and completes manifest entries in a
+    queue shared by several processes.
+    """
+    def __init__(self, path, lease_seconds=300, max_attempts=1):
+        """
+        Constructor for the WorkQueue class.
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self._path = path
+
+        self.lease_seconds = lease_seconds
+
+        # Entries that fail are returned to the queue until they have been
+        # attempted this many times.
+        self.max_attempts = max_attempts
+
+        # Identifies the leases held by this process
+        self.owner = "{0}:{1}:{2}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+        )
+
+        # The connection is shared by the download workers of this process.
+        self._lock = threading.Lock()
+
+        self.logger.debug("Opening queue %s.", path)
+
+        # Transactions are managed explicitly, and other processes holding
+        # the database lock are waited on rather than failing.
+        self._conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS queue (" +
+                "id TEXT PRIMARY KEY, md5 TEXT, size INTEGER, urls TEXT, " +
+                "state TEXT NOT NULL DEFAULT 'pending', owner TEXT, " +
+                "lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, " +
+                "code INTEGER)"
+            )
+
+    @property
+    def path(self):
+        return self._path
+
+    def populate(self, manifest):
+        """
+        Add the entries of the manifest to the queue. Entries already in the
+        queue (added by this or another process) are left as they are.
+        """
+        self.logger.debug("In populate.")
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO queue (id, md5, size, urls) VALUES (?, ?, ?, ?)",
+                    ((mfile['id'], mfile['md5'], mfile.get('size'), mfile['urls'])
+                     for mfile in manifest)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def claim(self):
+        """
+        Lease the next available entry, returning it as a manifest entry, or
+        None if no entry is available.
+        """
+        self.logger.debug("In claim.")
+
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+
+            try:
+                row = self._conn.execute(
+                    "SELECT id, md5, size, urls FROM queue WHERE state = 'pending' " +
+                    "OR (state = 'leased' AND lease_expires < ?) ORDER BY rowid LIMIT 1",
+                    (now,)
+                ).fetchone()
+
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE queue SET state = 'leased', owner = ?, " +
+                        "lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                        (self.owner, now + self.lease_seconds, row[0])
+                    )
+
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+
+        self.logger.debug("Claimed %s.", row[0])
+
+        return {'id': row[0], 'md5': row[1], 'size': row[2], 'urls': row[3]}
+
+    def renew(self):
+        """
+        Extend the leases of all the entries held by this process.
+        """
+        self.logger.debug("In renew.")
+
+        with self._lock:
+            self._conn.execute(
+                "UPDATE queue SET lease_expires = ? WHERE owner = ? AND state = 'leased'",
+                (time.time() + self.lease_seconds, self.owner)
+            )
+
+    def complete(self, manifest_id, code):
+        """
+        Record the failure code (see ManifestProcessor.download_manifest) of a
+        claimed entry. Entries that failed for a reason other than lacking a
+        valid URL are returned to the queue while they have attempts left.
+        Returns False, without recording anything, if the lease of this
+        process expired and the entry was claimed by another.
+        """
+        self.logger.debug("In complete: %s (%s)", manifest_id, code)
+
+        with self._lock:
+            if code == 0:
+                state = 'done'
+            elif code == 1:
+                state = 'failed'
+            else:
+                attempts = self._conn.execute(
+                    "SELECT attempts FROM queue WHERE id = ?", (manifest_id,)
+                ).fetchone()[0]
+
+                state = 'pending' if attempts < self.max_attempts else 'failed'
+
+            # Only the owner of the lease may finish the entry
+            updated = self._conn.execute(
+                "UPDATE queue SET state = ?, code = ?, owner = NULL, " +
+                "lease_expires = NULL WHERE id = ? AND owner = ? AND state = 'leased'",
+                (state, code, manifest_id, self.owner)
+            ).rowcount
+
+        if not updated:
+            self.logger.warning("The lease of %s was lost to another process. " +
+                                "Not recording its result.", manifest_id)
+
+        return updated > 0
+
+    def unfinished(self):
+        """
+        Return the ids of the entries that are neither done nor failed: those
+        waiting to be claimed, and those leased by this or another process.
+        """
+        self.logger.debug("In unfinished.")
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM queue WHERE state IN ('pending', 'leased') ORDER BY rowid"
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
+    def results(self):
+        """
+        Return a list of (id, code) tuples for the entries that are finished,
+        whether by this process or another.
+        """
+        self.logger.debug("In results.")
+
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, code FROM queue WHERE state IN ('done', 'failed') ORDER BY rowid"
+            ).fetchall()
+
+    def close(self):
+        """
+        Close the queue.
+        """
+        self.logger.debug("In close.")
+
+        with self._lock:
+            self._conn.close()
@@ -22,7 +22,7 @@ setup(
     install_requires=[
         'boto >= 2.49.0',
         'google-auth-oauthlib >= 0.2.0',
-        'google-cloud-storage >= 1.13.2'
+        'google-cloud-storage >= 1.38.0'
     ],
     packages=[''],
     package_dir={'': 'lib'},